@@ -0,0 +1,63 @@
+"""
+Đo thời gian render 1 thẻ CCCD (chạy trực tiếp, không qua process pool):
+    python bench_cccd.py [số_lần]
+So sánh cách vẽ viền cũ (8 lượt lệch + 1 lượt tô) với stroke 1 lượt, và các encoder.
+"""
+import io
+import sys
+import time
+
+from PIL import Image, ImageDraw
+
+import cccd_render
+
+def _sample_layers():
+    bg = io.BytesIO()
+    Image.effect_noise((1920, 1080), 40).convert("RGB").save(bg, "JPEG", quality=90)
+    avatar = io.BytesIO()
+    Image.new("RGBA", (128, 128), (220, 80, 80, 255)).save(avatar, "PNG")
+    return (cccd_render.build_background_layer(bg.getvalue()),
+            cccd_render.build_avatar_layer(avatar.getvalue()))
+
+def _gif_background():
+    # Nền GIF (mode P) lớn: đi đường convert rồi reduce() trong decode_image
+    bg = io.BytesIO()
+    Image.effect_noise((1920, 1080), 40).convert("P").save(bg, "GIF")
+    return bg.getvalue()
+
+def _old_outline(draw, text, position, font):
+    x, y = position
+    for ox, oy in [(-2, 0), (2, 0), (0, -2), (0, 2), (-2, -2), (2, -2), (-2, 2), (2, 2)]:
+        draw.text((x + ox, y + oy), text, font=font, fill="black")
+    draw.text((x, y), text, font=font, fill="white")
+
+def _bench(label, fn, n):
+    fn()  # làm nóng
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    print(f"{label:<32} {(time.perf_counter() - start) / n * 1000:8.2f} ms")
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    cccd_render._init_worker()
+    layer, avatar = _sample_layers()
+    args = ("Người chơi", "123456789012345678", 12345, 12, "Trúc Cơ", 42.5, 20475)
+    font = cccd_render._get_font(13)
+
+    gif = _gif_background()
+    _bench("layer nền từ GIF 1920x1080", lambda: cccd_render.build_background_layer(gif), max(1, n // 20))
+
+    canvas = Image.new("RGBA", cccd_render.CCCD_SIZE)
+    draw = ImageDraw.Draw(canvas)
+    _bench("tiêu đề, viền 9 lượt", lambda: _old_outline(draw, cccd_render.HEADER_TEXT, (100, 20), font), n)
+    _bench("tiêu đề, stroke 1 lượt", lambda: cccd_render.draw_text_with_outline(
+        draw, cccd_render.HEADER_TEXT, (100, 20), font), n)
+
+    for fmt in ("PNG", "WEBP"):
+        cccd_render.CCCD_FORMAT = fmt
+        size = len(cccd_render.render_cccd(layer, avatar, *args))
+        _bench(f"render_cccd {fmt} ({size // 1024} KB)", lambda: cccd_render.render_cccd(layer, avatar, *args), n)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import io
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageDraw, ImageFont
+
+# === RENDER CCCD TRONG PROCESS POOL ===
+# Giải mã, resize, ghép ảnh, vẽ chữ và encode ảnh đều chạy ở process riêng (không giữ GIL
+# của event loop). Các hàm dưới đây chạy trong worker nên chỉ nhận/trả bytes + kiểu cơ bản.
+# Nền được dựng sẵn 1 lần thành layer 400x225 đã ghép overlay tĩnh (logo server, tiêu đề,
+# khung thanh tiến độ), avatar thành layer 120x120 (bytes RGBA thô); main.py giữ các layer
+# này trong image_cache.decoded_cache.
+
+CCCD_RENDER_VERSION = 2  # tăng khi đổi bố cục/cách vẽ để bỏ các ảnh CCCD đã cache
+CCCD_SIZE = (400, 225)
+AVATAR_SIZE = (120, 120)
+LOGO_SIZE = (80, 80)
+CCCD_WORKERS = int(os.getenv("CCCD_WORKERS", str(min(2, os.cpu_count() or 1))))
+# Encoder: PNG (compress_level 0-9, thấp = nhanh hơn, file to hơn) hoặc WEBP (quality, lossless)
+CCCD_FORMAT = os.getenv("CCCD_FORMAT", "PNG").upper()
+CCCD_PNG_COMPRESS_LEVEL = int(os.getenv("CCCD_PNG_COMPRESS_LEVEL", "3"))
+CCCD_WEBP_QUALITY = int(os.getenv("CCCD_WEBP_QUALITY", "90"))
+CCCD_WEBP_LOSSLESS = os.getenv("CCCD_WEBP_LOSSLESS", "0") == "1"
+CCCD_FILENAME = "cccd.webp" if CCCD_FORMAT == "WEBP" else "cccd.png"
+
+HEADER_TEXT = "CỘNG HÒA XÃ HỘI CHỦ NGHĨA MEME\n          Độc lập - Tự do - Hạnh phúc\n\n                 CĂN CƯỚC CƯ DÂN"
+BAR_BOX = (160, 185, 360, 205)  # khung thanh tiến độ học vấn
+
+_FONT_CACHE = {}
+_LOGO = None
+_OVERLAY = None
+
+def format_currency(amount):
+    try:
+        return f"{int(amount):,}".replace(",", " ")
+    except Exception:
+        return str(amount)
+
+def draw_text_with_outline(draw, text, position, font, outline_color="black", fill_color="white"):
+    # Viền bằng stroke của FreeType: 1 lượt vẽ thay cho 8 lượt lệch + 1 lượt tô.
+    # Pillow cộng 2*stroke_width vào chiều cao mỗi dòng => bớt ở spacing (mặc định 4) cho khớp bố cục cũ
+    stroke = 2
+    draw.text(position, text, font=font, fill=fill_color, stroke_width=stroke, stroke_fill=outline_color,
+              spacing=4 - 2 * stroke)
+
+def _get_font(sz: int):
+    key = ("Roboto-Black.ttf", sz)
+    if key in _FONT_CACHE:
+        return _FONT_CACHE[key]
+    try:
+        font = ImageFont.truetype("Roboto-Black.ttf", sz)
+    except IOError:
+        font = ImageFont.load_default()
+    _FONT_CACHE[key] = font
+    return font
+
+def _static_overlay():
+    """Phần không đổi giữa các thẻ (logo, tiêu đề, khung thanh tiến độ) vẽ sẵn trên nền trong suốt."""
+    global _OVERLAY
+    if _OVERLAY is None:
+        overlay = Image.new("RGBA", CCCD_SIZE, (0, 0, 0, 0))
+        if _LOGO:
+            overlay.paste(_LOGO, (10, 10), mask=_LOGO)
+        draw = ImageDraw.Draw(overlay)
+        draw_text_with_outline(draw, HEADER_TEXT, (100, 20), _get_font(13))
+        draw.rectangle(BAR_BOX, outline="black", width=3)
+        _OVERLAY = overlay
+    return _OVERLAY
+
+def _init_worker():
+    """Chạy 1 lần khi worker khởi động: nạp sẵn logo server, font và overlay tĩnh."""
+    global _LOGO
+    try:
+        _LOGO = Image.open("1.png").convert("RGBA").resize(LOGO_SIZE)
+    except Exception:
+        _LOGO = None
+    _get_font(12)
+    _get_font(13)
+    _static_overlay()
+
+_REDUCE_MODES = {"L", "LA", "RGB", "RGBA", "RGBa", "La", "I", "F", "CMYK"}
+
+def decode_image(data: bytes, size=None):
+    """
+    Giải mã ảnh thành RGBA; có size thì giải mã thẳng về gần kích thước đó rồi resize đúng size.
+    - JPEG: draft mode, libjpeg giải mã ở tỉ lệ 1/2, 1/4, 1/8 (vẫn >= size), không dựng ảnh gốc.
+    - Định dạng khác (PNG/WebP/GIF): reduce() theo hệ số nguyên trước khi resize; mode reduce()
+      không nhận (P, 1, I;16...) thì convert RGBA trước.
+    """
+    img = Image.open(io.BytesIO(data))
+    if size is None:
+        return img.convert("RGBA")
+    if img.format == "JPEG":
+        img.draft("RGB", size)
+    else:
+        factor = min(img.width // size[0], img.height // size[1])
+        if factor >= 2:
+            if img.mode not in _REDUCE_MODES:
+                img = img.convert("RGBA")
+            img = img.reduce(factor)
+    img = img.convert("RGBA")
+    if img.size != tuple(size):
+        img = img.resize(size, reducing_gap=2.0)
+    return img
+
+def build_background_layer(bg_bytes: bytes) -> bytes:
+    """Ảnh nền gốc -> layer 400x225 RGBA đã ghép overlay tĩnh (bytes thô để cache & gửi qua process)."""
+    layer = decode_image(bg_bytes, CCCD_SIZE)
+    layer.alpha_composite(_static_overlay())
+    return layer.tobytes()
+
+def build_avatar_layer(avatar_bytes: bytes) -> bytes:
+    """Ảnh avatar gốc -> layer 120x120 RGBA (bytes thô)."""
+    return decode_image(avatar_bytes, AVATAR_SIZE).tobytes()
+
+def _render_cccd_canvas(canvas, user_name, user_id, smart, level, role_name,
+                        progress_pct, next_smart):
+    # Tiêu đề, logo và khung thanh tiến độ đã có sẵn trong layer nền (_static_overlay)
+    draw = ImageDraw.Draw(canvas)
+    font_small = _get_font(12)
+    font_large = _get_font(13)
+
+    # Thông tin cơ bản
+    draw_text_with_outline(
+        draw,
+        f"Tên: {user_name}\nID: {user_id}\nHọc vấn: {format_currency(smart)}\n"
+        f"lv: {format_currency(level)}\nTrình độ: {role_name}",
+        (160, 85), font_large
+    )
+
+    # Thanh tiến độ học vấn
+    pct = max(0.0, min(1.0, (progress_pct or 0) / 100.0))
+    bar_left, bar_top, bar_right, bar_bottom = BAR_BOX
+    inner_left, inner_top = bar_left + 3, bar_top + 3
+    inner_right = inner_left + int((bar_right - bar_left - 6) * pct)
+    inner_bottom = bar_bottom - 3
+    if inner_right > inner_left:
+        draw.rectangle((inner_left, inner_top, inner_right, inner_bottom), fill="#1E90FF")
+    draw_text_with_outline(draw, f"{smart}/{next_smart}", (inner_left + 2, inner_top), font_small)
+
+def render_cccd(layer: bytes, avatar_layer: bytes, user_name, user_id, smart, level, role_name,
+                progress_pct, next_smart) -> bytes:
+    """Ghép layer avatar lên layer nền, vẽ thông tin và trả về ảnh đã encode (CCCD_FORMAT)."""
+    canvas = Image.frombytes("RGBA", CCCD_SIZE, layer)
+    avatar = Image.frombytes("RGBA", AVATAR_SIZE, avatar_layer)
+    canvas.paste(avatar, (20, 85), mask=avatar)
+    _render_cccd_canvas(canvas, user_name, user_id, smart, level, role_name, progress_pct, next_smart)
+    return encode_card(canvas)
+
+def encode_card(canvas) -> bytes:
+    bio = io.BytesIO()
+    if CCCD_FORMAT == "WEBP":
+        canvas.save(bio, "WEBP", quality=CCCD_WEBP_QUALITY, lossless=CCCD_WEBP_LOSSLESS, method=4)
+    else:
+        canvas.save(bio, "PNG", compress_level=CCCD_PNG_COMPRESS_LEVEL)
+    return bio.getvalue()
+
+# ---- Pool (chỉ dùng ở process chính) ----
+_pool = None
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: worker không thừa hưởng event loop / socket của bot như fork
+        _pool = ProcessPoolExecutor(
+            max_workers=CCCD_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+    return _pool
+
+async def run_render(fn, *args):
+    """Chạy fn(*args) trong process pool; pool hỏng (worker chết) thì dựng lại và thử 1 lần nữa."""
+    global _pool
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_get_pool(), fn, *args)
+    except BrokenProcessPool:
+        _pool = None
+        return await loop.run_in_executor(_get_pool(), fn, *args)
+
+def shutdown_render_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,146 @@
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from data_handler import users_col, config_col, guarded_update
+
+# === COOLDOWN CÁC LỆNH ===
+# Khai báo tập trung: field lưu lần dùng cuối (BSON datetime, UTC), thời gian chờ, item bỏ qua chờ.
+# "daily": hết chờ lúc nửa đêm (giờ máy chủ) sau lần nhận cuối, thay vì sau N giây.
+# Hạn chờ được nhớ trong RAM (_expiry) => lệnh đang chờ bị từ chối ngay, không đọc Mongo.
+COOLDOWNS: Dict[str, Dict[str, Any]] = {
+    "daily": {"field": "last_daily", "daily": True},
+    "beg":   {"field": "last_beg", "seconds": 3 * 60},
+    "rob":   {"field": "last_rob", "seconds": 3600, "skip_item": ":fast_forward: Skip"},
+    "orob":  {"field": "last_rob", "seconds": 3600},  # chung thời gian chờ với rob
+    "hunt":  {"field": "last_hunt", "seconds": 5 * 60},
+    "op":    {"field": "last_op", "seconds": 5 * 60},
+    "study": {"field": "last_study", "seconds": 5 * 60},
+    "gacha": {"field": "last_gacha", "seconds": 3600},
+}
+
+# Định dạng chuỗi cũ (trước khi lưu bằng datetime); last_daily là ngày theo giờ máy chủ
+_LEGACY_FORMAT = "%Y-%m-%d %H:%M:%S"
+_LEGACY_DAILY_FORMAT = "%Y-%m-%d"
+
+COOLDOWN_CACHE_MAX = int(os.getenv("COOLDOWN_CACHE_MAX", "20000"))
+_expiry: "OrderedDict[Tuple[str, str], float]" = OrderedDict()  # (field, user_id) -> epoch hết chờ, cũ nhất trước
+
+cooldown_stats = {"memory_rejects": 0, "db_checks": 0, "skips": 0}
+
+def _to_datetime(value: Any, field: str) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        # Mongo trả datetime naive theo UTC
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str):
+        try:
+            if field == "last_daily":
+                return datetime.strptime(value, _LEGACY_DAILY_FORMAT).astimezone()
+            return datetime.strptime(value, _LEGACY_FORMAT).replace(tzinfo=timezone.utc)
+        except ValueError:
+            return None  # chuỗi lỗi => coi như chưa dùng lần nào
+    return None
+
+def _expires_at(name: str, last: datetime) -> datetime:
+    cfg = COOLDOWNS[name]
+    if cfg.get("daily"):
+        next_day = last.astimezone().date() + timedelta(days=1)
+        return datetime.combine(next_day, datetime.min.time()).astimezone()
+    return last + timedelta(seconds=cfg["seconds"])
+
+def _remember(field: str, user_id: str, expires: datetime) -> None:
+    now = time.time()
+    key = (field, user_id)
+    if expires.timestamp() <= now:
+        _expiry.pop(key, None)
+        return
+    if key not in _expiry and len(_expiry) >= COOLDOWN_CACHE_MAX:
+        for old in [k for k, exp in _expiry.items() if exp <= now]:
+            del _expiry[old]
+        while len(_expiry) >= COOLDOWN_CACHE_MAX:
+            _expiry.popitem(last=False)  # bỏ bản nhớ lâu nhất: lệnh sau chỉ phải đọc Mongo
+    _expiry[key] = expires.timestamp()
+    _expiry.move_to_end(key)
+
+def last_used(name: str, doc: Optional[Dict[str, Any]]) -> Optional[datetime]:
+    """Thời điểm dùng lệnh lần cuối (datetime UTC có tz), đọc được cả chuỗi định dạng cũ."""
+    field = COOLDOWNS[name]["field"]
+    return _to_datetime((doc or {}).get(field), field)
+
+def cached_remaining(name: str, user_id: str) -> float:
+    """Số giây còn phải chờ theo bộ nhớ (0 nếu không biết / đã hết). Không chạm Mongo."""
+    exp = _expiry.get((COOLDOWNS[name]["field"], user_id))
+    left = exp - time.time() if exp else 0
+    if left > 0:
+        cooldown_stats["memory_rejects"] += 1
+        return left
+    return 0
+
+def remaining(name: str, user_id: str, doc: Optional[Dict[str, Any]]) -> float:
+    """Số giây còn phải chờ theo document user (và ghi nhớ hạn chờ vào RAM)."""
+    cooldown_stats["db_checks"] += 1
+    last = last_used(name, doc)
+    if last is None:
+        return 0
+    expires = _expires_at(name, last)
+    _remember(COOLDOWNS[name]["field"], user_id, expires)
+    return max(0.0, (expires - datetime.now(timezone.utc)).total_seconds())
+
+def mark_used(name: str, user_id: str, now: Optional[datetime] = None) -> Dict[str, datetime]:
+    """Bắt đầu thời gian chờ; trả về {field: now} để $set (hoặc gán vào document) khi ghi user."""
+    now = now or datetime.now(timezone.utc)
+    field = COOLDOWNS[name]["field"]
+    _remember(field, user_id, _expires_at(name, now))
+    return {field: now}
+
+async def consume_skip(name: str, user_id: str) -> bool:
+    """Dùng 1 item bỏ qua thời gian chờ (nếu lệnh có và user còn item). Trừ item có điều kiện, atomic."""
+    item = COOLDOWNS[name].get("skip_item")
+    if not item:
+        return False
+    doc = await guarded_update(user_id, {f"items.{item}": {"$gte": 1}}, {"$inc": {f"items.{item}": -1}})
+    if doc is None:
+        return False
+    cooldown_stats["skips"] += 1
+    _expiry.pop((COOLDOWNS[name]["field"], user_id), None)
+    return True
+
+_COOLDOWN_MIGRATION_ID = "cooldown_datetime_migration"
+_migrated = False
+
+async def migrate_cooldown_fields() -> int:
+    """
+    Đổi các field last_* còn lưu dạng chuỗi sang BSON datetime, chạy trên server
+    ($dateFromString, chuỗi lỗi thành null). Các field không có index => quét cả collection,
+    nên chỉ chạy 1 lần: đánh dấu xong trong config_col (mỗi process chỉ hỏi 1 lần, kể cả khi
+    on_ready chạy lại lúc reconnect).
+    """
+    global _migrated
+    if _migrated:
+        return 0
+    if await config_col.find_one({"_id": _COOLDOWN_MIGRATION_ID}, {"_id": 1}):
+        _migrated = True
+        return 0
+    local_tz = datetime.now().astimezone().strftime("%z")
+    total = 0
+    for field in sorted({cfg["field"] for cfg in COOLDOWNS.values()}):
+        if field == "last_daily":
+            fmt, tz = _LEGACY_DAILY_FORMAT, local_tz
+        else:
+            fmt, tz = _LEGACY_FORMAT, "UTC"
+        result = await users_col.update_many(
+            {field: {"$type": "string"}},
+            [{"$set": {field: {"$dateFromString": {
+                "dateString": f"${field}", "format": fmt, "timezone": tz, "onError": None
+            }}}}]
+        )
+        total += result.modified_count
+    await config_col.update_one(
+        {"_id": _COOLDOWN_MIGRATION_ID},
+        {"$set": {"done_at": datetime.now(timezone.utc), "modified": total}},
+        upsert=True
+    )
+    _migrated = True
+    return total
@@ -1,119 +1,901 @@
-import os
-from typing import Any, Dict, Optional
-
-from pymongo import MongoClient, ASCENDING
-from datetime import datetime, timedelta
-from discord.ext import tasks
-
-# === KẾT NỐI MONGO ===
-MONGO_URI = os.getenv("MONGO_URI")
-if not MONGO_URI:
-    raise RuntimeError("Thiếu biến môi trường MONGO_URI")
-
-_client = MongoClient(MONGO_URI)
-
-db = _client["discord_bot"]
-users_col = db["users"]
-config_col = db["config"]
-backgrounds_col = db["backgrounds"]
-
-# _id index đã có sẵn và luôn unique => KHÔNG tạo lại!
-# users_col.create_index([("_id", ASCENDING)], unique=True)  # ❌ GÂY LỖI
-
-# Tối ưu một số truy vấn phổ biến (không bắt buộc)
-for f in ("points", "company_balance", "smart"):
-    try:
-        users_col.create_index([(f, ASCENDING)])
-    except Exception:
-        pass
-
-# === USER HELPERS ===
-def get_user(user_id: str) -> Optional[Dict[str, Any]]:
-    user = users_col.find_one({"_id": user_id})
-    return user
-
-def create_user(user_id: str, default_data: Optional[Dict[str, Any]] = None) -> None:
-    if get_user(user_id) is None:
-        # === Chỉ số TextFight mặc định ===
-        default_textfight = {
-            "hp": 10000,          # máu hiện tại
-            "max_hp": 10000,      # giới hạn máu
-            "mana": 600,          # mana hiện tại
-            "max_mana": 600,      # giới hạn mana
-            "ad": 40,             # sát thương vật lý
-            "ap": 0,              # sức mạnh phép
-            "armor": 0,           # giáp
-            "magic_resist": 0,    # kháng phép
-            "crit_rate": 0.3,     # 30%
-            "crit_damage": 2.0,   # 200%
-            "attack_speed": 0.5,  # tốc đánh
-            "lifesteal": 0.0,     # hút máu %
-            "amplify": 0.0,       # khuếch đại %
-            "resistance": 0.0     # chống chịu %
-        }
-
-        # Khi tạo, đặt HP/Mana hiện tại = Max
-        default_textfight["hp"] = default_textfight["max_hp"]
-        default_textfight["mana"] = default_textfight["max_mana"]
-
-        # === Dữ liệu người chơi cơ bản ===
-        doc = default_data or {
-            "_id": user_id,
-            "points": 0,
-            "items": {},
-            "smart": 0,
-            "streak": 0,
-            "TextFight": default_textfight
-        }
-
-        doc["_id"] = user_id
-        users_col.insert_one(doc)
-
-def update_user(user_id: str, update_dict: Dict[str, Any]) -> None:
-    if not update_dict:
-        return
-    has_operator = any(k.startswith("$") for k in update_dict.keys())
-    update_payload = update_dict if has_operator else {"$set": update_dict}
-    users_col.update_one({"_id": user_id}, update_payload, upsert=True)
-
-# === JACKPOT HELPERS ===
-def get_jackpot() -> Optional[int]:
-    doc = config_col.find_one({"_id": "jackpot"})
-    return doc["value"] if doc and "value" in doc else None
-
-def update_jackpot(amount: int) -> None:
-    config_col.update_one({"_id": "jackpot"}, {"$inc": {"value": int(amount)}}, upsert=True)
-
-def set_jackpot(value: int) -> None:
-    config_col.update_one({"_id": "jackpot"}, {"$set": {"value": int(value)}}, upsert=True)
-
-@tasks.loop(hours=1)
-async def auto_halve_jackpot():
-    """Tự động chia đôi jackpot mỗi 1 giờ."""
-    try:
-        doc = config_col.find_one({"_id": "global_jackpot"}, {"value": 1})
-        if not doc:
-            # Nếu chưa có document jackpot, khởi tạo
-            config_col.insert_one({"_id": "global_jackpot", "value": 0})
-            return
-
-        current_value = doc.get("value", 0)
-        if current_value <= 0:
-            return  # Không cần chia nếu jackpot rỗng hoặc âm
-
-        new_value = int(current_value / 2)
-
-        config_col.update_one(
-            {"_id": "global_jackpot"},
-            {
-                "$set": {
-                    "value": new_value,
-                    "last_decay_time": datetime.datetime.now()
-                }
-            }
-        )
-
-        print(f"[Jackpot] Đã tự động chia đôi jackpot: {current_value} → {new_value}")
-
-    except Exception as e:
-        print(f"[Jackpot] ❌ Lỗi trong auto_halve_jackpot: {e}")
\ No newline at end of file
+import os
+import copy
+import asyncio
+import time
+import uuid
+import zlib
+import socket
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from pymongo import AsyncMongoClient, ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from datetime import datetime, timedelta, timezone
+from discord.ext import tasks
+
+from metrics import mongo_listener, timed_task
+
+# === KẾT NỐI MONGO ===
+MONGO_URI = os.getenv("MONGO_URI")
+if not MONGO_URI:
+    raise RuntimeError("Thiếu biến môi trường MONGO_URI")
+
+# Driver async của PyMongo: mọi truy vấn đều được await, không chặn event loop của bot.
+_client = AsyncMongoClient(MONGO_URI, event_listeners=[mongo_listener])
+
+db = _client["discord_bot"]
+users_col = db["users"]
+config_col = db["config"]
+backgrounds_col = db["backgrounds"]
+
+# _id index đã có sẵn và luôn unique => KHÔNG tạo lại!
+# users_col.create_index([("_id", ASCENDING)], unique=True)  # ❌ GÂY LỖI
+
+async def ensure_indexes() -> None:
+    """Tối ưu một số truy vấn phổ biến (không bắt buộc). Gọi 1 lần khi bot khởi động."""
+    for f in ("points", "company_balance", "smart"):
+        try:
+            await users_col.create_index([(f, ASCENDING)])
+        except Exception:
+            pass
+    # Partial index cho job sinh tử (fight.auto_check_life_and_death): chỉ chứa user đang 0 HP / đang chết
+    partial = (
+        ("text_fight.hp", {"text_fight.hp": {"$lte": 0}}, "dead_hp_partial"),
+        ("death_time", {"death": True}, "death_time_partial"),
+    )
+    for f, expr, name in partial:
+        try:
+            await users_col.create_index([(f, ASCENDING)], name=name, partialFilterExpression=expr)
+        except Exception as e:
+            print(f"[MongoDB] ⚠️ Không tạo được index {name}: {e}")
+
+# === USER CACHE (write-behind) ===
+# Giữ document của user vừa hoạt động trong RAM (LRU + TTL). Lệnh đọc lặp lại không tốn
+# round trip; thay đổi được ghi lại theo từng field rồi flush gộp bằng bulk_write.
+USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", "5000"))     # số user tối đa trong cache
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))    # giây, giới hạn độ cũ của bản cache
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "2"))  # giây giữa 2 lần flush
+
+_UPDATE_OPS = ("$set", "$inc", "$unset")
+_MISSING = object()
+
+class _CachedUser:
+    __slots__ = ("doc", "loaded_at", "pending")
+
+    def __init__(self, doc: Dict[str, Any]):
+        self.doc = doc
+        self.loaded_at = time.monotonic()
+        self.pending: Dict[str, Dict[str, Any]] = {op: {} for op in _UPDATE_OPS}
+
+    @property
+    def dirty(self) -> bool:
+        return any(self.pending.values())
+
+_user_cache: "OrderedDict[str, _CachedUser]" = OrderedDict()
+# user_id -> Future của lần flush đang ghi dở (entry đã "sạch" nhưng DB chưa có các thay đổi đó)
+_inflight_flush: Dict[str, asyncio.Future] = {}
+user_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "flushes": 0, "flushed_users": 0}
+
+def _path_get(doc: Dict[str, Any], path: str, default: Any = None) -> Any:
+    cur: Any = doc
+    for part in path.split("."):
+        if isinstance(cur, dict) and part in cur:
+            cur = cur[part]
+        elif isinstance(cur, list) and part.isdigit() and int(part) < len(cur):
+            cur = cur[int(part)]
+        else:
+            return default
+    return cur
+
+def _path_parent(doc: Dict[str, Any], path: str, create: bool):
+    """Trả về (container, key) của path, tạo dict trung gian nếu create=True."""
+    parts = path.split(".")
+    cur: Any = doc
+    for part in parts[:-1]:
+        if isinstance(cur, list) and part.isdigit():
+            idx = int(part)
+            if idx >= len(cur):
+                if not create:
+                    return None, None
+                cur.extend([None] * (idx + 1 - len(cur)))
+            if cur[idx] is None and create:
+                cur[idx] = {}
+            cur = cur[idx]
+        elif isinstance(cur, dict):
+            if part not in cur or cur[part] is None:
+                if not create:
+                    return None, None
+                cur[part] = {}
+            cur = cur[part]
+        else:
+            return None, None
+    return cur, parts[-1]
+
+def _apply_update(doc: Dict[str, Any], update: Dict[str, Any]) -> None:
+    """Áp dụng $set/$inc/$unset (đường dẫn dạng a.b.c) lên document trong RAM, giống Mongo."""
+    for path, value in update.get("$set", {}).items():
+        parent, key = _path_parent(doc, path, create=True)
+        if isinstance(parent, list):
+            idx = int(key)
+            if idx >= len(parent):
+                parent.extend([None] * (idx + 1 - len(parent)))
+            parent[idx] = copy.deepcopy(value)
+        elif parent is not None:
+            parent[key] = copy.deepcopy(value)
+    for path, delta in update.get("$inc", {}).items():
+        parent, key = _path_parent(doc, path, create=True)
+        if isinstance(parent, dict):
+            parent[key] = parent.get(key, 0) + delta
+    for op, pick in (("$max", max), ("$min", min)):
+        for path, value in update.get(op, {}).items():
+            parent, key = _path_parent(doc, path, create=True)
+            if isinstance(parent, dict):
+                parent[key] = pick(parent[key], value) if key in parent else value
+    for path in update.get("$unset", {}):
+        parent, key = _path_parent(doc, path, create=False)
+        if isinstance(parent, dict):
+            parent.pop(key, None)
+        elif isinstance(parent, list) and key.isdigit() and int(key) < len(parent):
+            parent[int(key)] = None
+
+def _paths_overlap(a: str, b: str) -> bool:
+    return a == b or a.startswith(b + ".") or b.startswith(a + ".")
+
+def _merge_pending(entry: _CachedUser, update: Dict[str, Any]) -> None:
+    """
+    Gộp update (đã áp lên entry.doc) vào danh sách field chờ flush.
+    - Cùng path, cùng toán tử: $inc cộng dồn, $set/$unset ghi đè.
+    - Path chồng nhau (vd items và items.X, hoặc $set rồi $inc): thay cả nhánh bằng $set
+      giá trị hiện tại trong cache để Mongo không báo xung đột path.
+    """
+    pending = entry.pending
+    for op in _UPDATE_OPS:
+        for path, value in update.get(op, {}).items():
+            conflicts = [
+                p for o in _UPDATE_OPS for p in pending[o]
+                if _paths_overlap(p, path) and not (p == path and o == op)
+            ]
+            if conflicts:
+                top = min(conflicts + [path], key=len)
+                for o in _UPDATE_OPS:
+                    for p in [p for p in pending[o] if _paths_overlap(p, top)]:
+                        del pending[o][p]
+                current = _path_get(entry.doc, top, _MISSING)
+                if current is _MISSING:
+                    pending["$unset"][top] = ""
+                else:
+                    pending["$set"][top] = copy.deepcopy(current)
+            elif op == "$inc":
+                pending["$inc"][path] = pending["$inc"].get(path, 0) + value
+            elif op == "$set":
+                pending["$set"][path] = copy.deepcopy(value)
+            else:
+                pending["$unset"][path] = ""
+
+def _take_pending(entry: _CachedUser) -> Dict[str, Any]:
+    update = {op: fields for op, fields in entry.pending.items() if fields}
+    entry.pending = {op: {} for op in _UPDATE_OPS}
+    return update
+
+def _restore_pending(entry: _CachedUser, update: Dict[str, Any]) -> None:
+    """Flush lỗi: đặt lại phần chưa ghi, các thay đổi mới hơn được gộp phía sau."""
+    newer = _take_pending(entry)
+    _merge_pending(entry, update)
+    _merge_pending(entry, newer)
+
+def _evict_users() -> None:
+    """Bỏ các user sạch (không còn field chờ ghi) đã hết TTL hoặc vượt USER_CACHE_MAX."""
+    now = time.monotonic()
+    for uid in [u for u, e in _user_cache.items() if not e.dirty and now - e.loaded_at > USER_CACHE_TTL]:
+        del _user_cache[uid]
+        user_cache_stats["evictions"] += 1
+    overflow = len(_user_cache) - USER_CACHE_MAX
+    if overflow > 0:
+        for uid in [u for u, e in _user_cache.items() if not e.dirty][:overflow]:
+            del _user_cache[uid]
+            user_cache_stats["evictions"] += 1
+
+def _mark_flushed(entries) -> None:
+    """Flush xong: DB khớp với bản cache => tính TTL lại từ bây giờ (không đọc lại user đang nóng)."""
+    now = time.monotonic()
+    for entry in entries:
+        entry.loaded_at = now
+
+def _begin_flush(user_ids) -> asyncio.Future:
+    done = asyncio.get_running_loop().create_future()
+    for uid in user_ids:
+        _inflight_flush[uid] = done
+    return done
+
+def _end_flush(user_ids, done: asyncio.Future) -> None:
+    for uid in user_ids:
+        if _inflight_flush.get(uid) is done:
+            del _inflight_flush[uid]
+    done.set_result(None)
+
+async def _wait_flushed(user_id: str) -> None:
+    """Chờ các lần flush đang ghi dở của user xong (DB đã có mọi thay đổi đã rời cache)."""
+    while (done := _inflight_flush.get(user_id)) is not None:
+        await asyncio.shield(done)
+
+async def flush_users() -> int:
+    """Ghi toàn bộ field đang chờ bằng 1 lệnh bulk_write. Trả về số user đã flush."""
+    batch = []
+    for uid, entry in _user_cache.items():
+        if entry.dirty:
+            batch.append((uid, entry, _take_pending(entry)))
+    if not batch:
+        return 0
+    uids = [uid for uid, _, _ in batch]
+    done = _begin_flush(uids)
+    try:
+        return await _write_batch(batch)
+    finally:
+        _end_flush(uids, done)
+
+async def _write_batch(batch) -> int:
+    try:
+        await users_col.bulk_write(
+            [UpdateOne({"_id": uid}, update, upsert=True) for uid, _, update in batch],
+            ordered=False
+        )
+    except BulkWriteError as e:
+        # ordered=False: các lệnh khác đã được ghi, chỉ đặt lại lệnh lỗi (nếu không $inc sẽ bị cộng 2 lần)
+        failed = {err["index"] for err in e.details.get("writeErrors", [])}
+        for i in sorted(failed):
+            uid, entry, update = batch[i]
+            _user_cache.setdefault(uid, entry)
+            _restore_pending(entry, update)
+        _mark_flushed(entry for i, (_, entry, _) in enumerate(batch) if i not in failed)
+        if e.details.get("writeConcernErrors"):
+            raise
+        print(f"[UserCache] ❌ {len(failed)}/{len(batch)} user ghi lỗi, sẽ thử lại: "
+              f"{e.details['writeErrors'][0].get('errmsg') if failed else ''}")
+        user_cache_stats["flushes"] += 1
+        user_cache_stats["flushed_users"] += len(batch) - len(failed)
+        return len(batch) - len(failed)
+    except Exception:
+        # Lỗi trước khi server trả kết quả (mất kết nối...): coi như chưa ghi gì
+        for uid, entry, update in batch:
+            _user_cache.setdefault(uid, entry)
+            _restore_pending(entry, update)
+        raise
+    _mark_flushed(entry for _, entry, _ in batch)
+    user_cache_stats["flushes"] += 1
+    user_cache_stats["flushed_users"] += len(batch)
+    return len(batch)
+
+async def flush_user(user_id: str) -> None:
+    """Ghi ngay phần đang chờ của 1 user (trước khi ghi thẳng vào Mongo, bỏ qua cache)."""
+    await _wait_flushed(user_id)
+    entry = _user_cache.get(user_id)
+    if entry is None or not entry.dirty:
+        return
+    update = _take_pending(entry)
+    done = _begin_flush([user_id])
+    try:
+        await users_col.update_one({"_id": user_id}, update, upsert=True)
+    except Exception:
+        _restore_pending(entry, update)
+        raise
+    finally:
+        _end_flush([user_id], done)
+    _mark_flushed([entry])
+
+def apply_cached(user_id: str, update: Dict[str, Any]) -> None:
+    """Đồng bộ bản cache sau khi đã ghi thẳng update vào Mongo (không đánh dấu chờ ghi)."""
+    entry = _user_cache.get(user_id)
+    if entry is not None:
+        _apply_update(entry.doc, update)
+        _notify_user(user_id, entry.doc)
+
+def forget_user(user_id: str) -> None:
+    """Bỏ bản cache sạch của user (vd sau update dạng pipeline không mô phỏng được trong RAM)."""
+    entry = _user_cache.get(user_id)
+    if entry is not None and not entry.dirty:
+        del _user_cache[user_id]
+
+def forget_users_where(predicate: Callable[[Dict[str, Any]], bool]) -> int:
+    """Bỏ mọi bản cache sạch thoả predicate(doc) (sau update_many không biết trước các id bị đổi)."""
+    uids = [uid for uid, e in _user_cache.items() if not e.dirty and predicate(e.doc)]
+    for uid in uids:
+        del _user_cache[uid]
+    return len(uids)
+
+@tasks.loop(seconds=USER_FLUSH_INTERVAL)
+@timed_task("user_cache_flush")
+async def user_cache_flusher():
+    """Flush định kỳ các thay đổi đang chờ và dọn cache."""
+    try:
+        await flush_users()
+    except Exception as e:
+        print(f"[UserCache] ❌ Lỗi flush: {e}")
+    _evict_users()
+
+# === THEO DÕI THAY ĐỔI ===
+# Listener nhận (user_id, document sau khi đổi) mỗi khi biết giá trị mới của user
+# (ghi qua cache, guarded_update, apply_cached). Dùng cho bảng xếp hạng giữ trong RAM.
+_user_listeners: List[Callable[[str, Dict[str, Any]], None]] = []
+
+def add_user_listener(listener: Callable[[str, Dict[str, Any]], None]) -> None:
+    _user_listeners.append(listener)
+
+def _notify_user(user_id: str, doc: Dict[str, Any]) -> None:
+    for listener in _user_listeners:
+        try:
+            listener(user_id, doc)
+        except Exception as e:
+            print(f"[UserCache] ❌ Lỗi listener {getattr(listener, '__name__', listener)}: {e}")
+
+# === USER HELPERS ===
+async def get_user(user_id: str) -> Optional[Dict[str, Any]]:
+    """Đọc user (ưu tiên cache). Trả về bản sao để lệnh sửa thoải mái rồi gọi update_user."""
+    entry = _user_cache.get(user_id)
+    if entry is not None and (entry.dirty or time.monotonic() - entry.loaded_at <= USER_CACHE_TTL):
+        _user_cache.move_to_end(user_id)
+        user_cache_stats["hits"] += 1
+        return copy.deepcopy(entry.doc)
+
+    user_cache_stats["misses"] += 1
+    await _wait_flushed(user_id)  # đọc trước khi flush dở ghi xong sẽ thấy bản cũ hơn cache
+    started = time.monotonic()
+    user = await users_col.find_one({"_id": user_id})
+    if user is None:
+        return None
+    entry = _user_cache.get(user_id)
+    if entry is not None and (entry.dirty or user_id in _inflight_flush or entry.loaded_at >= started):
+        # Có lệnh khác đã ghi / flush / nạp lại cache trong lúc chờ Mongo: giữ bản cache
+        return copy.deepcopy(entry.doc)
+    _user_cache[user_id] = _CachedUser(user)
+    _user_cache.move_to_end(user_id)
+    if len(_user_cache) > USER_CACHE_MAX:
+        _evict_users()
+    return copy.deepcopy(user)
+
+async def create_user(user_id: str, default_data: Optional[Dict[str, Any]] = None) -> None:
+    if await get_user(user_id) is None:
+        # === Chỉ số TextFight mặc định ===
+        default_textfight = {
+            "hp": 10000,          # máu hiện tại
+            "max_hp": 10000,      # giới hạn máu
+            "mana": 600,          # mana hiện tại
+            "max_mana": 600,      # giới hạn mana
+            "ad": 40,             # sát thương vật lý
+            "ap": 0,              # sức mạnh phép
+            "armor": 0,           # giáp
+            "magic_resist": 0,    # kháng phép
+            "crit_rate": 0.3,     # 30%
+            "crit_damage": 2.0,   # 200%
+            "attack_speed": 0.5,  # tốc đánh
+            "lifesteal": 0.0,     # hút máu %
+            "amplify": 0.0,       # khuếch đại %
+            "resistance": 0.0     # chống chịu %
+        }
+
+        # Khi tạo, đặt HP/Mana hiện tại = Max
+        default_textfight["hp"] = default_textfight["max_hp"]
+        default_textfight["mana"] = default_textfight["max_mana"]
+
+        # === Dữ liệu người chơi cơ bản ===
+        doc = default_data or {
+            "_id": user_id,
+            "points": 0,
+            "items": {},
+            "smart": 0,
+            "streak": 0,
+            "TextFight": default_textfight
+        }
+
+        doc["_id"] = user_id
+        await users_col.insert_one(doc)
+
+def _is_number(v: Any) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+# === DỌN ITEM SỐ LƯỢNG 0 NGAY LÚC GHI ===
+def _item_paths(update: Dict[str, Any]) -> List[str]:
+    """Các path items.X mà update có thể làm về 0 (trừ số lượng hoặc gán lại)."""
+    paths = [p for p, v in update.get("$inc", {}).items() if p.startswith("items.") and v < 0]
+    paths += [p for p in update.get("$set", {}) if p == "items" or p.startswith("items.")]
+    return paths
+
+def _zero_item_paths(doc: Optional[Dict[str, Any]], update: Dict[str, Any]) -> List[str]:
+    """Các item.X có số lượng <= 0 sau khi áp update."""
+    zero = []
+    for path in _item_paths(update):
+        if path == "items":
+            zero += [f"items.{k}" for k, v in (_path_get(doc or {}, "items") or {}).items()
+                     if _is_number(v) and v <= 0]
+            continue
+        value = _path_get(doc or {}, path)
+        if _is_number(value) and value <= 0:
+            zero.append(path)
+    return zero
+
+async def _prune_zero_items(user_id: str, doc: Optional[Dict[str, Any]], update: Dict[str, Any]) -> None:
+    """Sau 1 lệnh ghi thẳng vào Mongo: $unset các item vừa về <= 0 (kèm điều kiện, tránh xoá nhầm)."""
+    for path in _zero_item_paths(doc, update):
+        await users_col.update_one({"_id": user_id, path: {"$lte": 0}}, {"$unset": {path: ""}})
+        apply_cached(user_id, {"$unset": {path: ""}})
+        parent, key = _path_parent(doc, path, create=False)
+        if isinstance(parent, dict):
+            parent.pop(key, None)
+
+def diff_update(original: Dict[str, Any], new: Dict[str, Any], prefix: str = "",
+                full_doc: bool = True) -> Dict[str, Dict[str, Any]]:
+    """
+    Tính update tối thiểu để biến original thành new:
+    - số thay đổi → $inc phần chênh lệch (cộng dồn an toàn với lệnh khác)
+    - dict con (items, text_fight...) → so sánh từng key, chỉ ghi key đổi
+    - giá trị khác → $set; key bị xoá → $unset (top-level chỉ khi new là document đầy đủ)
+    """
+    update: Dict[str, Dict[str, Any]] = {}
+    for key, value in new.items():
+        if not prefix and key == "_id":
+            continue
+        path = f"{prefix}{key}"
+        old = original.get(key, _MISSING)
+        if old is _MISSING:
+            update.setdefault("$set", {})[path] = value
+        elif isinstance(old, dict) and isinstance(value, dict):
+            for op, fields in diff_update(old, value, f"{path}.", True).items():
+                update.setdefault(op, {}).update(fields)
+        elif _is_number(old) and _is_number(value):
+            if value != old:
+                update.setdefault("$inc", {})[path] = value - old
+        elif old != value:
+            update.setdefault("$set", {})[path] = value
+    if full_doc:
+        for key in original:
+            if key not in new and not (not prefix and key == "_id"):
+                update.setdefault("$unset", {})[f"{prefix}{key}"] = ""
+    return update
+
+async def update_user(user_id: str, update_dict: Dict[str, Any],
+                      original: Optional[Dict[str, Any]] = None) -> None:
+    """
+    Ghi thay đổi của user.
+    - update_dict dạng toán tử ($set/$inc/...): dùng nguyên.
+    - update_dict dạng document: so với original (bản đọc bằng get_user trước khi sửa, mặc định
+      là bản cache) rồi chỉ ghi phần khác biệt ($inc cho số, $set/$unset theo từng key).
+    - User đang trong cache: áp vào cache + ghi nhận field thay đổi, flush sau (write-behind).
+      Không có trong cache: ghi thẳng vào Mongo.
+    """
+    if not update_dict:
+        return
+    has_operator = any(k.startswith("$") for k in update_dict.keys())
+    entry = _user_cache.get(user_id)
+
+    if has_operator:
+        update_payload = update_dict
+    else:
+        base = original if original is not None else (entry.doc if entry is not None else None)
+        if base is None:
+            # Không có bản gốc để so: $set các field được truyền vào như trước
+            update_payload = {"$set": {k: v for k, v in update_dict.items() if k != "_id"}}
+        else:
+            # Chỉ document đầy đủ (có _id, lấy từ get_user) mới được suy ra $unset top-level
+            update_payload = diff_update(base, update_dict, full_doc="_id" in update_dict)
+        if not any(update_payload.values()):
+            return
+
+    if entry is not None and set(update_payload) <= set(_UPDATE_OPS):
+        _apply_update(entry.doc, update_payload)
+        _merge_pending(entry, update_payload)
+        # Item về 0 thì xoá luôn khỏi túi (thay vì để job quét dọn sau)
+        zero = _zero_item_paths(entry.doc, update_payload)
+        if zero:
+            prune = {"$unset": {path: "" for path in zero}}
+            _apply_update(entry.doc, prune)
+            _merge_pending(entry, prune)
+        _user_cache.move_to_end(user_id)
+        _notify_user(user_id, entry.doc)
+        return
+
+    if entry is not None:
+        # Toán tử không mô phỏng được trong RAM: ghi phần chờ trước, rồi bỏ bản cache
+        while entry.dirty:
+            await flush_user(user_id)
+        await _wait_flushed(user_id)
+        _user_cache.pop(user_id, None)
+    item_paths = _item_paths(update_payload) if set(update_payload) <= set(_UPDATE_OPS) else []
+    if not item_paths:
+        await users_col.update_one({"_id": user_id}, update_payload, upsert=True)
+        return
+    # Có trừ item: lấy lại đúng các item đó (projection) để xoá nếu về 0
+    doc = await users_col.find_one_and_update(
+        {"_id": user_id}, update_payload, upsert=True,
+        projection={path: 1 for path in item_paths}, return_document=ReturnDocument.AFTER
+    )
+    await _prune_zero_items(user_id, doc, update_payload)
+
+# === ATOMIC ECONOMY OPS ===
+# Kiểm tra số dư và ghi trong cùng 1 find_one_and_update có điều kiện: 1 round trip,
+# lệnh khác không thể chen vào giữa lúc đọc và lúc ghi (không mất cập nhật).
+
+def _refresh_cached(user_id: str, doc: Dict[str, Any], update: Dict[str, Any]) -> None:
+    entry = _user_cache.get(user_id)
+    if entry is not None and (entry.dirty or user_id in _inflight_flush):
+        # Có thay đổi chờ ghi / đang ghi dở (phát sinh trong lúc await): doc từ DB có thể thiếu
+        # chúng => chỉ áp thêm update vào bản cache, không thay cả document
+        _apply_update(entry.doc, update)
+        return
+    _user_cache[user_id] = _CachedUser(copy.deepcopy(doc))
+    _user_cache.move_to_end(user_id)
+
+async def guarded_update(user_id: str, conditions: Dict[str, Any],
+                         update: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Cập nhật user nếu document thỏa conditions (filter Mongo, vd {"points": {"$gte": 100}}).
+    Trả về document sau khi cập nhật, hoặc None nếu không thỏa / không tồn tại.
+    """
+    await flush_user(user_id)  # ghi phần cache đang chờ trước để không đè lên nhau
+    doc = await users_col.find_one_and_update(
+        {"_id": user_id, **conditions}, update, return_document=ReturnDocument.AFTER
+    )
+    if doc is not None:
+        _refresh_cached(user_id, doc, update)
+        await _prune_zero_items(user_id, doc, update)
+        _notify_user(user_id, doc)
+    return doc
+
+async def buy_item(user_id: str, item_name: str, quantity: int, total_price: int,
+                   init_company: bool = False) -> Optional[Dict[str, Any]]:
+    """Trừ total_price điểm và cộng quantity item nếu đủ tiền."""
+    update: Dict[str, Any] = {"$inc": {"points": -total_price, f"items.{item_name}": quantity}}
+    if init_company:
+        # Tạo công ty mới (balance 0, bắt đầu tính thị trường từ bây giờ) nếu chưa có;
+        # $max/$min giữ nguyên giá trị cũ khi đã có công ty
+        update["$max"] = {"company_balance": 0, "company_seed": company_seed(user_id)}
+        update["$min"] = {"company_updated_at": utc_now_ms()}
+    return await guarded_update(user_id, {"points": {"$gte": total_price}}, update)
+
+async def sell_item(user_id: str, item_name: str, quantity: int,
+                    total_price: int) -> Optional[Dict[str, Any]]:
+    """Trừ quantity item và cộng total_price điểm nếu đủ hàng."""
+    return await guarded_update(
+        user_id,
+        {f"items.{item_name}": {"$gte": quantity}},
+        {"$inc": {"points": total_price, f"items.{item_name}": -quantity}}
+    )
+
+async def adjust_points(user_id: str, delta: int, min_balance: int = 0) -> Optional[Dict[str, Any]]:
+    """Cộng/trừ điểm nếu số dư hiện tại >= min_balance (vd tiền cược)."""
+    return await guarded_update(user_id, {"points": {"$gte": min_balance}}, {"$inc": {"points": delta}})
+
+async def transfer_points(from_id: str, to_id: str, amount: int, check_balance: bool = True) -> bool:
+    """Chuyển điểm giữa 2 user: trừ có điều kiện rồi cộng cho người nhận (hoàn lại nếu lỗi)."""
+    conditions = {"points": {"$gte": amount}} if check_balance else {}
+    if await guarded_update(from_id, conditions, {"$inc": {"points": -amount}}) is None:
+        return False
+    if await guarded_update(to_id, {}, {"$inc": {"points": amount}}) is None:
+        await guarded_update(from_id, {}, {"$inc": {"points": amount}})
+        return False
+    return True
+
+# === CÔNG TY: giá trị tính lười (lazy) ===
+# Không ghi lại company_balance mỗi phút nữa. Mỗi công ty lưu:
+#   company_balance     số dư tại thời điểm company_updated_at
+#   company_updated_at  lần cuối giá trị được tính & ghi
+#   company_seed        seed thị trường riêng của user
+# Giá trị hiện tại = số dư * biến động mỗi phút (-5% → +5%, suy ra từ seed + số phút) * 0.9 mỗi
+# mốc giờ đi qua (thuế). Chỉ ghi lại (re-base) khi có lệnh chạm vào công ty.
+COMPANY_TICK_SECONDS = 60
+COMPANY_TAX_SECONDS = 3600
+COMPANY_TAX_RATE = 0.10
+
+def utc_now_ms() -> datetime:
+    """Giờ UTC làm tròn tới mili giây (độ chính xác của BSON date) để so sánh bằng được."""
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+def _as_utc(dt: Any) -> Optional[datetime]:
+    if not isinstance(dt, datetime):
+        return None
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+
+def company_seed(user_id: str, doc: Optional[Dict[str, Any]] = None) -> int:
+    seed = (doc or {}).get("company_seed")
+    return int(seed) if isinstance(seed, int) else zlib.crc32(str(user_id).encode())
+
+def _company_percents(seed: int, first_tick: int, last_tick: int) -> np.ndarray:
+    """% biến động (-5..5) của các phút [first_tick, last_tick], tất định theo seed (splitmix64)."""
+    x = np.arange(first_tick, last_tick + 1, dtype=np.uint64)
+    x ^= np.uint64((seed * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF)
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return (x % np.uint64(11)).astype(np.int64) - 5
+
+def company_value_at(balance: int, seed: int, since: datetime, until: datetime) -> int:
+    """Giá trị công ty tại until, biết số dư tại since."""
+    start, end = since.timestamp(), until.timestamp()
+    if balance <= 0 or end <= start:
+        return max(0, int(balance))
+    first_tick = int(start // COMPANY_TICK_SECONDS) + 1
+    last_tick = int(end // COMPANY_TICK_SECONDS)
+    value = float(balance)
+    if last_tick >= first_tick:
+        value *= float(np.prod(1 + _company_percents(seed, first_tick, last_tick) / 100))
+    taxes = int(end // COMPANY_TAX_SECONDS) - int(start // COMPANY_TAX_SECONDS)
+    if taxes > 0:
+        value *= (1 - COMPANY_TAX_RATE) ** taxes
+    return max(0, int(value))
+
+def company_balance_now(doc: Optional[Dict[str, Any]], now: Optional[datetime] = None) -> Optional[int]:
+    """Giá trị công ty hiện tại của document user (None nếu không có công ty)."""
+    if not doc or doc.get("company_balance") is None:
+        return None
+    since = _as_utc(doc.get("company_updated_at"))
+    if since is None:
+        # Dữ liệu cũ chưa có mốc thời gian: coi như vừa tính xong
+        return int(doc["company_balance"])
+    return company_value_at(int(doc["company_balance"]), company_seed(doc["_id"], doc),
+                            since, now or datetime.now(timezone.utc))
+
+def company_version(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Điều kiện khóa lạc quan: số dư + mốc thời gian chưa bị lệnh khác re-base."""
+    return {
+        field: doc[field] if field in doc else {"$exists": False}
+        for field in ("company_balance", "company_updated_at")
+    }
+
+async def rebase_company(user_id: str, new_balance: Callable[[int], Optional[int]],
+                         conditions: Optional[Dict[str, Any]] = None,
+                         inc: Optional[Dict[str, Any]] = None) -> Tuple[Optional[Dict[str, Any]], int]:
+    """
+    Tính giá trị công ty hiện tại, new_balance(current) trả về số dư mới (None = từ chối),
+    rồi ghi số dư + mốc thời gian mới (kèm inc/conditions) trong 1 thao tác có điều kiện.
+    Trả về (document sau khi ghi hoặc None, giá trị công ty trước khi ghi).
+    """
+    doc = await get_user(user_id)
+    current = 0
+    for _ in range(3):
+        if doc is None:
+            return None, current
+        now = utc_now_ms()
+        current = company_balance_now(doc, now) or 0
+        target = new_balance(current)
+        if target is None:
+            return None, current
+        update: Dict[str, Any] = {"$set": {
+            "company_balance": max(0, int(target)),
+            "company_updated_at": now,
+            "company_seed": company_seed(user_id, doc),
+        }}
+        if inc:
+            update["$inc"] = inc
+        result = await guarded_update(user_id, {**(conditions or {}), **company_version(doc)}, update)
+        if result is not None:
+            return result, current
+        # Không khớp: hoặc thiếu điều kiện (vd không đủ điểm), hoặc bản cache đã cũ → đọc lại
+        fresh = await users_col.find_one({"_id": user_id})
+        if fresh is None or company_version(fresh) == company_version(doc):
+            return None, current
+        _refresh_cached(user_id, fresh, {})
+        doc = fresh
+    return None, current
+
+async def invest_company(user_id: str, amount: int, company_item: str) -> Optional[Dict[str, Any]]:
+    """Chuyển điểm vào công ty nếu có công ty và đủ điểm."""
+    doc, _ = await rebase_company(
+        user_id, lambda current: current + amount,
+        conditions={"points": {"$gte": amount}, f"items.{company_item}": {"$exists": True}},
+        inc={"points": -amount}
+    )
+    return doc
+
+async def withdraw_company(user_id: str, amount: int) -> Optional[Dict[str, Any]]:
+    """Rút điểm từ công ty nếu giá trị công ty hiện tại đủ."""
+    doc, _ = await rebase_company(
+        user_id, lambda current: current - amount if current >= amount else None,
+        inc={"points": amount}
+    )
+    return doc
+
+# === JACKPOT HELPERS ===
+# Hũ jackpot là 1 document nóng (mọi ván $tx đều đọc/ghi). Process giữ lease của document
+# (lease_owner / lease_until) thì giữ giá trị trong RAM: đọc, cộng, ăn hũ đều tức thì và
+# atomic (không có await giữa đọc và ghi), phần chênh lệch được gộp lại và ghi bằng 1 lần $inc
+# mỗi JACKPOT_FLUSH_INTERVAL giây (lần ghi đó cũng gia hạn lease) và khi tắt bot. Hũ đứng yên
+# thì không ghi, chỉ gia hạn khi lease sắp hết (JACKPOT_RENEW_MARGIN giây).
+# Process không giữ lease (nhiều bot dùng chung DB) thì đọc/ghi thẳng Mongo như cũ; mỗi lần
+# flush, process giữ lease lấy lại giá trị trong DB nên hấp thụ các thay đổi đó.
+#
+# Hũ tự chia đôi mỗi JACKPOT_HALVE_SECONDS (mặc định 1 giờ) theo công thức, không cần job nền:
+# giá trị thật = value >> (số mốc chia đôi đã qua kể từ last_decay). Tính lúc đọc; chỉ chủ lease
+# ghi lại phần đã chia (kèm last_decay mới) trong lần flush kế tiếp.
+JACKPOT_FLUSH_INTERVAL = float(os.getenv("JACKPOT_FLUSH_INTERVAL", "5"))
+JACKPOT_LEASE_SECONDS = float(os.getenv("JACKPOT_LEASE_SECONDS", "30"))
+JACKPOT_HALVE_SECONDS = float(os.getenv("JACKPOT_HALVE_SECONDS", "3600"))
+JACKPOT_RENEW_MARGIN = float(os.getenv("JACKPOT_RENEW_MARGIN", str(2 * JACKPOT_FLUSH_INTERVAL)))
+_JACKPOT_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_jackpot_value = 0
+_jackpot_last_decay: Optional[datetime] = None
+_jackpot_pending = 0      # chênh lệch chưa ghi xuống DB
+_jackpot_pending_decay: Optional[datetime] = None  # last_decay khớp với phần chia đôi đã gộp vào _jackpot_pending
+_jackpot_lease_until = 0.0  # epoch (đồng hồ local) còn được coi là chủ lease
+
+def jackpot_decayed(value: int, last_decay: Optional[datetime], now: datetime) -> Tuple[int, datetime]:
+    """(giá trị sau khi chia đôi theo số mốc đã qua, mốc chia đôi gần nhất). Hũ rỗng/âm giữ nguyên."""
+    if last_decay is None:
+        return value, now
+    if last_decay.tzinfo is None:
+        last_decay = last_decay.replace(tzinfo=timezone.utc)  # datetime từ Mongo là UTC
+    halvings = int((now - last_decay).total_seconds() // JACKPOT_HALVE_SECONDS)
+    if halvings <= 0:
+        return value, last_decay
+    if value > 0:
+        value = value >> min(halvings, 64)
+    return value, last_decay + timedelta(seconds=halvings * JACKPOT_HALVE_SECONDS)
+
+def _jackpot_decay_stage(now: datetime) -> Dict[str, Any]:
+    """
+    Stage pipeline làm đúng như jackpot_decayed ngay trên server: chia đôi value theo số mốc
+    đã qua và dời last_decay. Mọi lệnh ghi không qua lease đều chạy stage này trước để phần
+    tiền cộng vào sau mốc không bị chia đôi oan ở lần đọc sau.
+    """
+    period_ms = int(JACKPOT_HALVE_SECONDS * 1000)
+    last = {"$ifNull": ["$last_decay", now]}
+    halvings = {"$max": [0, {"$floor": {"$divide": [{"$subtract": [now, last]}, period_ms]}}]}
+    value = {"$ifNull": ["$value", 0]}
+    return {"$set": {
+        "value": {"$cond": [
+            {"$gt": [value, 0]},
+            {"$toLong": {"$floor": {"$divide": [value, {"$pow": [2, halvings]}]}}},
+            value,
+        ]},
+        "last_decay": {"$add": [last, {"$multiply": [halvings, period_ms]}]},
+    }}
+
+async def _jackpot_write(value_expr: Any, now: Optional[datetime] = None) -> None:
+    """Ghi thẳng (không giữ lease): chia đôi phần đang nợ rồi đặt value = value_expr, 1 lệnh atomic."""
+    now = now or datetime.now(timezone.utc)
+    await config_col.update_one(
+        {"_id": "jackpot"},
+        [_jackpot_decay_stage(now), {"$set": {"value": value_expr}}],
+        upsert=True
+    )
+
+def _owns_jackpot() -> bool:
+    return time.time() < _jackpot_lease_until
+
+def _jackpot_add_local(amount: int) -> None:
+    global _jackpot_value, _jackpot_pending
+    _jackpot_value += amount
+    _jackpot_pending += amount
+
+def _decay_local() -> None:
+    global _jackpot_last_decay, _jackpot_pending_decay
+    previous = _jackpot_last_decay
+    value, _jackpot_last_decay = jackpot_decayed(_jackpot_value, _jackpot_last_decay, datetime.now(timezone.utc))
+    if previous is not None and _jackpot_last_decay != previous:
+        # Phần chia đôi nằm trong _jackpot_pending => last_decay mới phải được ghi cùng nó
+        _jackpot_pending_decay = _jackpot_last_decay
+    if value != _jackpot_value:
+        _jackpot_add_local(value - _jackpot_value)
+
+async def get_jackpot() -> Optional[int]:
+    if _owns_jackpot():
+        _decay_local()
+        return _jackpot_value
+    doc = await config_col.find_one({"_id": "jackpot"}, {"value": 1, "last_decay": 1})
+    if not doc or "value" not in doc:
+        return None
+    return jackpot_decayed(doc["value"], doc.get("last_decay"), datetime.now(timezone.utc))[0]
+
+async def update_jackpot(amount: int) -> None:
+    if _owns_jackpot():
+        _decay_local()
+        _jackpot_add_local(int(amount))
+        return
+    await _jackpot_write({"$add": ["$value", int(amount)]})
+
+async def set_jackpot(value: int) -> None:
+    if _owns_jackpot():
+        _decay_local()
+        _jackpot_add_local(int(value) - _jackpot_value)
+        return
+    await _jackpot_write(int(value))
+
+async def take_jackpot() -> int:
+    """Lấy toàn bộ jackpot và đặt về 0 trong 1 thao tác (2 người không thể cùng ăn 1 hũ)."""
+    if _owns_jackpot():
+        _decay_local()
+        value = _jackpot_value
+        if value <= 0:
+            return 0
+        _jackpot_add_local(-value)
+        return value
+    now = datetime.now(timezone.utc)
+    doc = await config_col.find_one_and_update(
+        {"_id": "jackpot", "value": {"$gt": 0}},
+        [_jackpot_decay_stage(now), {"$set": {"value": 0}}],
+        return_document=ReturnDocument.BEFORE
+    )
+    if not doc:
+        return 0
+    # Cùng mốc now với stage trên server => đúng số tiền đã bị lấy khỏi hũ
+    return jackpot_decayed(int(doc["value"]), doc.get("last_decay"), now)[0]
+
+async def flush_jackpot(release: bool = False) -> bool:
+    """
+    Ghi phần chênh lệch đang chờ bằng 1 lần $inc, đồng thời lấy/gia hạn lease (release=True: trả lease,
+    dùng khi tắt bot). Trả về True nếu process đang giữ lease sau lần gọi này.
+    """
+    global _jackpot_value, _jackpot_last_decay, _jackpot_pending, _jackpot_lease_until, _jackpot_pending_decay
+    owned = _owns_jackpot()
+    if owned:
+        _decay_local()  # ghi luôn phần đã chia đôi
+        idle = not _jackpot_pending and _jackpot_pending_decay is None
+        if idle and not release and _jackpot_lease_until - time.time() > JACKPOT_RENEW_MARGIN:
+            return True  # không có gì để ghi, lease còn lâu mới hết
+    delta, _jackpot_pending = _jackpot_pending, 0
+    # Có thể khác None cả khi lease đã mất: delta gồm phần chia đôi đã làm ở RAM lúc còn lease
+    decay_mark, _jackpot_pending_decay = _jackpot_pending_decay, None
+    now = datetime.now(timezone.utc)
+    started = time.time()
+    if release:
+        update: Dict[str, Any] = {"$unset": {"lease_owner": "", "lease_until": ""}}
+    else:
+        update = {"$set": {
+            "lease_owner": _JACKPOT_OWNER,
+            "lease_until": now + timedelta(seconds=JACKPOT_LEASE_SECONDS),
+        }}
+    if owned or decay_mark is not None:
+        update.setdefault("$set", {})["last_decay"] = _jackpot_last_decay if owned else decay_mark
+    if delta:
+        update["$inc"] = {"value": delta}
+    lease_free = {"$or": [
+        {"lease_owner": _JACKPOT_OWNER},
+        {"lease_owner": {"$exists": False}},
+        {"lease_until": {"$lt": now}},
+    ]}
+    try:
+        try:
+            doc = await config_col.find_one_and_update(
+                {"_id": "jackpot", **lease_free}, update,
+                upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            doc = None  # document đã có và lease đang thuộc process khác
+        if doc is None:
+            _jackpot_lease_until = 0.0
+            if decay_mark is not None:
+                # delta đã gồm phần chia đôi tới decay_mark: không cho stage trên server chia lần nữa
+                await config_col.update_one(
+                    {"_id": "jackpot"},
+                    {"$inc": {"value": delta}, "$max": {"last_decay": decay_mark}},
+                    upsert=True
+                )
+            elif delta:
+                await _jackpot_write({"$add": ["$value", delta]}, now)
+            return False
+    except Exception:
+        _jackpot_pending += delta  # ghi lỗi: giữ lại để lần sau ghi tiếp
+        if _jackpot_pending_decay is None:
+            _jackpot_pending_decay = decay_mark
+        raise
+    # Giá trị DB (đã gồm cả thay đổi của process khác) + thay đổi phát sinh trong lúc chờ ghi
+    _jackpot_value = int(doc.get("value", 0)) + _jackpot_pending
+    last_decay = doc.get("last_decay")
+    if last_decay is not None and last_decay.tzinfo is None:
+        last_decay = last_decay.replace(tzinfo=timezone.utc)
+    # Document cũ chưa có last_decay: bắt đầu đếm từ bây giờ (ghi xuống ở lần flush sau)
+    _jackpot_last_decay = last_decay or now
+    # Hết hạn local sớm hơn hạn trong DB 1 nhịp flush để không bao giờ dùng lease đã hết
+    _jackpot_lease_until = 0.0 if release else started + JACKPOT_LEASE_SECONDS - JACKPOT_FLUSH_INTERVAL
+    return not release
+
+@tasks.loop(seconds=JACKPOT_FLUSH_INTERVAL)
+@timed_task("jackpot_flush")
+async def jackpot_flusher():
+    """Flush định kỳ jackpot + gia hạn (hoặc giành lại) lease."""
+    try:
+        await flush_jackpot()
+    except Exception as e:
+        print(f"[Jackpot] ❌ Lỗi flush: {e}")
@@ -2,9 +2,13 @@
 from typing import Optional, List, Dict
 import json
 import os
+import time
 from datetime import datetime, timedelta, timezone
 from discord.ext import tasks
-from data_handler import get_user, users_col
+from data_handler import get_user, users_col, apply_cached, guarded_update, forget_users_where
+from pymongo import ReturnDocument
+from scheduler import schedule_at
+from metrics import timed_task
 import numbers
 
 # === LOAD SHOP DATA ===
@@ -62,19 +66,19 @@ def _ensure_dt_aware(dt):
     return dt.astimezone(timezone.utc)
 
 # === MONGO FUNCTIONS ===
-def get_user_textfight(user_id: str) -> Dict:
+async def get_user_textfight(user_id: str) -> Dict:
     """
     Lấy bản sao (in-memory) của text_fight user hoặc khởi tạo mặc định nếu chưa có.
     Trả về dict độc lập (copy) để không sửa trực tiếp object đọc từ PyMongo cursor.
     """
-    doc = users_col.find_one({"_id": user_id}, {"text_fight": 1})
+    doc = await users_col.find_one({"_id": user_id}, {"text_fight": 1})
     tf = (doc.get("text_fight") if doc else None) or {}
     # Bổ sung trường mới nếu thiếu (không ghi ra DB ở đây, sẽ ghi khi cần)
     for k, v in DEFAULT_TEXTFIGHT.items():
         tf.setdefault(k, v)
     return tf.copy()
 
-def update_textfight(user_id: str, data: Dict):
+async def update_textfight(user_id: str, data: Dict):
     """
     Cập nhật 1 hoặc nhiều chỉ số fight.
     - data là dict của các trường bên trong text_fight, ví dụ {"hp": 5000, "mana": 300}
@@ -84,61 +88,132 @@ def update_textfight(user_id: str, data: Dict):
         return
     try:
         update_data = {f"text_fight.{k}": v for k, v in data.items()}
-        users_col.update_one({"_id": user_id}, {"$set": update_data}, upsert=False)
+        await users_col.update_one({"_id": user_id}, {"$set": update_data}, upsert=False)
+        apply_cached(user_id, {"$set": update_data})
     except Exception as e:
         print(f"[MongoDB] ❌ Lỗi cập nhật text_fight cho {user_id}: {e}")
 
-def modify_hp(user_id: str, delta: int):
+async def modify_hp(user_id: str, delta: int):
     """Thay đổi HP (cộng/trừ), hạn chế trong [0, max_hp]. Trả về giá trị HP mới."""
-    tf = get_user_textfight(user_id)
+    tf = await get_user_textfight(user_id)
     try:
         hp = _to_number(tf.get("hp", 0))
         max_hp = _to_number(tf.get("max_hp", DEFAULT_TEXTFIGHT["max_hp"]))
         new_hp = max(0, min(hp + int(delta), int(max_hp)))
-        update_textfight(user_id, {"hp": new_hp})
+        await update_textfight(user_id, {"hp": new_hp})
+        if new_hp <= 0:
+            await record_death(user_id)
         return new_hp
     except Exception as e:
         print(f"[modify_hp] Lỗi cho {user_id}: {e}")
         return tf.get("hp", 0)
 
-def modify_mana(user_id: str, delta: int):
+async def modify_mana(user_id: str, delta: int):
     """Thay đổi mana (cộng/trừ), hạn chế trong [0, max_mana]. Trả về mana mới."""
-    tf = get_user_textfight(user_id)
+    tf = await get_user_textfight(user_id)
     try:
         mana = _to_number(tf.get("mana", 0))
         max_mana = _to_number(tf.get("max_mana", DEFAULT_TEXTFIGHT["max_mana"]))
         new_mana = max(0, min(mana + int(delta), int(max_mana)))
-        update_textfight(user_id, {"mana": new_mana})
+        await update_textfight(user_id, {"mana": new_mana})
         return new_mana
     except Exception as e:
         print(f"[modify_mana] Lỗi cho {user_id}: {e}")
         return tf.get("mana", 0)
 
-def reset_textfight(user_id: str):
+async def reset_textfight(user_id: str):
     """Đặt lại toàn bộ chỉ số về mặc định (ghi đè)."""
     try:
-        users_col.update_one({"_id": user_id}, {"$set": {"text_fight": DEFAULT_TEXTFIGHT}}, upsert=True)
+        await users_col.update_one({"_id": user_id}, {"$set": {"text_fight": DEFAULT_TEXTFIGHT}}, upsert=True)
+        apply_cached(user_id, {"$set": {"text_fight": DEFAULT_TEXTFIGHT}})
     except Exception as e:
         print(f"[reset_textfight] Lỗi cho {user_id}: {e}")
 
 # === EQUIPMENT MANAGEMENT ===
-def _get_equips(user_id: str) -> List[Optional[str]]:
+async def _get_equips(user_id: str) -> List[Optional[str]]:
     """Trả về danh sách 3 ô trang bị (None nếu trống). Luôn trả về list độ dài EQUIP_SLOTS."""
-    doc = users_col.find_one({"_id": user_id}, {"fight_equips": 1}) or {}
+    doc = await users_col.find_one({"_id": user_id}, {"fight_equips": 1}) or {}
     equips = doc.get("fight_equips") or []
     # normalize length
     equips = (equips + [None] * EQUIP_SLOTS)[:EQUIP_SLOTS]
     return equips
 
-def _set_equips(user_id: str, equips: List[Optional[str]]):
+async def _set_equips(user_id: str, equips: List[Optional[str]]):
     """Ghi danh sách trang bị (EQUIP_SLOTS phần tử)."""
     if not isinstance(equips, list) or len(equips) != EQUIP_SLOTS:
         raise ValueError(f"fight_equips phải là list gồm {EQUIP_SLOTS} phần tử")
     try:
-        users_col.update_one({"_id": user_id}, {"$set": {"fight_equips": equips}}, upsert=True)
+        await users_col.update_one({"_id": user_id}, {"$set": {"fight_equips": equips}}, upsert=True)
+        apply_cached(user_id, {"$set": {"fight_equips": equips}})
     except Exception as e:
         print(f"[_set_equips] Lỗi khi set equips cho {user_id}: {e}")
 
+def _normalize_equips(equips) -> List[Optional[str]]:
+    return ((equips if isinstance(equips, list) else []) + [None] * EQUIP_SLOTS)[:EQUIP_SLOTS]
+
+# === EQUIP / UNEQUIP ATOMIC ===
+# Trừ/cộng item và đặt/xoá ô trang bị trong CÙNG 1 lệnh có điều kiện (guarded_update):
+# lệnh khác chen vào (equip 2 lần, bán item...) làm điều kiện sai => không ghi, đọc lại rồi thử lại.
+
+async def equip_item(user_id: str, item_key: str, item_name: str):
+    """
+    Trang bị item_key vào ô trống đầu tiên, trừ 1 item_name trong túi.
+    Trả về (ô 0-based, None) nếu thành công, hoặc (None, lý do) với lý do "no_item" / "full" / "busy".
+    """
+    doc = await get_user(user_id) or {}
+    for _ in range(3):
+        if _to_number((doc.get("items") or {}).get(item_name, 0)) < 1:
+            return None, "no_item"
+        raw = doc.get("fight_equips")
+        equips = _normalize_equips(raw)
+        if None not in equips:
+            return None, "full"
+        slot = equips.index(None)
+        conditions = {f"items.{item_name}": {"$gte": 1}}
+        update = {"$inc": {f"items.{item_name}": -1}}
+        if isinstance(raw, list) and len(raw) == EQUIP_SLOTS:
+            conditions[f"fight_equips.{slot}"] = None  # ô vẫn còn trống
+            update["$set"] = {f"fight_equips.{slot}": item_key}
+        else:
+            # Chưa có mảng trang bị / mảng sai độ dài: ghi cả mảng, điều kiện là mảng vẫn như lúc đọc
+            # (không dùng {"fight_equips": None} vì điều kiện đó cũng khớp mảng có phần tử null)
+            conditions["fight_equips"] = raw if isinstance(raw, list) else {"$not": {"$type": "array"}}
+            equips[slot] = item_key
+            update["$set"] = {"fight_equips": equips}
+        if await guarded_update(user_id, conditions, update) is not None:
+            return slot, None
+        doc = await users_col.find_one({"_id": user_id}, {"items": 1, "fight_equips": 1}) or {}
+    return None, "busy"
+
+async def unequip_item(user_id: str, slot: int, item_key: str, item_name: str) -> bool:
+    """Tháo item_key khỏi ô slot (0-based) và trả 1 item_name vào túi. False nếu ô không còn chứa item đó."""
+    doc = await guarded_update(
+        user_id,
+        {f"fight_equips.{slot}": item_key},
+        {"$set": {f"fight_equips.{slot}": None}, "$inc": {f"items.{item_name}": 1}}
+    )
+    return doc is not None
+
+# === HP ATOMIC ===
+async def apply_hp_delta(user_id: str, delta: int, max_hp: Optional[float] = None) -> Optional[int]:
+    """
+    Cộng/trừ HP ngay trên server (pipeline update, tính từ HP hiện tại chứ không từ bản đọc trước),
+    giới hạn trong [0, max_hp] (max_hp mặc định là text_fight.max_hp). Trả về HP mới, None nếu không có user.
+    """
+    hp = {"$ifNull": ["$text_fight.hp", DEFAULT_TEXTFIGHT["hp"]]}
+    cap = max_hp if max_hp is not None else {"$ifNull": ["$text_fight.max_hp", DEFAULT_TEXTFIGHT["max_hp"]]}
+    doc = await users_col.find_one_and_update(
+        {"_id": user_id},
+        [{"$set": {"text_fight.hp": {"$max": [0, {"$min": [cap, {"$add": [hp, int(delta)]}]}]}}}],
+        projection={"text_fight.hp": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if doc is None:
+        return None
+    new_hp = doc["text_fight"]["hp"]
+    apply_cached(user_id, {"$set": {"text_fight.hp": new_hp}})
+    return new_hp
+
 # === ITEM AND BONUS HELPERS ===
 def _item_display(item_key: Optional[str]) -> str:
     """Hiển thị vật phẩm dạng icon + tên."""
@@ -147,13 +222,12 @@ def _item_display(item_key: Optional[str]) -> str:
     item = shop_data.get(item_key, {})
     return f"{item.get('icon', '')} {item.get('name', item_key)}".strip()
 
-def _gear_bonuses(item_key: str) -> Dict[str, float]:
+def _compute_gear_bonuses(item: Dict) -> Dict[str, float]:
     """
     Lấy dictionary bonuses từ item:
     - gộp cả "stats" và "effects" nếu có
     - chuyển giá trị không hợp lệ thành 0
     """
-    item = shop_data.get(item_key, {})
     bonuses = {}
     for source in (item.get("stats", {}), item.get("effects", {})):
         if not isinstance(source, dict):
@@ -163,25 +237,39 @@ def _gear_bonuses(item_key: str) -> Dict[str, float]:
             bonuses[k] = bonuses.get(k, 0) + val
     return bonuses
 
+# Bảng bonus của mọi item, tính 1 lần lúc load shop_data (gọi lại nếu shop_data thay đổi)
+_GEAR_BONUS_TABLE: Dict[str, Dict[str, float]] = {}
+
+def compile_gear_bonuses() -> None:
+    global _GEAR_BONUS_TABLE
+    _GEAR_BONUS_TABLE = {
+        key: _compute_gear_bonuses(item) for key, item in shop_data.items() if isinstance(item, dict)
+    }
+
+compile_gear_bonuses()
+
+def _gear_bonuses(item_key: str) -> Dict[str, float]:
+    """Bonus của 1 item (tra bảng đã tính sẵn; không được sửa dict trả về)."""
+    return _GEAR_BONUS_TABLE.get(item_key, {})
+
 def _aggregate_bonuses(equips: List[Optional[str]]) -> Dict[str, float]:
     """Gộp tổng bonus từ danh sách equips (không ghi DB)."""
     total = {}
     for key in equips:
         if not key:
             continue
-        bonuses = _gear_bonuses(key)
-        for stat, value in bonuses.items():
+        for stat, value in _gear_bonuses(key).items():
             total[stat] = total.get(stat, 0) + value
     return total
 
-def apply_stat_bonus(user_id: str, bonus: Dict[str, float] = None, include_equips: bool = False):
+async def apply_stat_bonus(user_id: str, bonus: Dict[str, float] = None, include_equips: bool = False):
     """
     Áp dụng các bonus 'non-equip' trực tiếp vào text_fight (ghi vĩnh viễn).
     - bonus: dict các chỉ số cần cộng (vd: {"ad": 10, "max_hp": 200})
     - include_equips: nếu True → trả về thêm giá trị đã cộng bonus từ equips (không ghi equips vào DB)
     Trả về dict text_fight (kết quả, nhưng nếu include_equips thì đó là bản tính toán, không ghi equips).
     """
-    tf = get_user_textfight(user_id)
+    tf = await get_user_textfight(user_id)
 
     if bonus and isinstance(bonus, dict):
         for stat, value in bonus.items():
@@ -191,12 +279,12 @@ def apply_stat_bonus(user_id: str, bonus: Dict[str, float] = None, include_equip
         # Lưu lại các thay đổi 'permanent bonus' (chỉ những stat đã chỉnh)
         try:
             # Ghi only changed keys
-            update_textfight(user_id, {k: tf[k] for k in bonus.keys()})
+            await update_textfight(user_id, {k: tf[k] for k in bonus.keys()})
         except Exception as e:
             print(f"[apply_stat_bonus] Lỗi ghi DB cho {user_id}: {e}")
 
     if include_equips:
-        equips = _get_equips(user_id)
+        equips = await _get_equips(user_id)
         equip_bonus = _aggregate_bonuses(equips)
         # trả về bản tính toán tạm (không ghi equip bonuses vào DB)
         combined = tf.copy()
@@ -206,13 +294,13 @@ def apply_stat_bonus(user_id: str, bonus: Dict[str, float] = None, include_equip
 
     return tf
 
-def remove_stat_bonus(user_id: str, bonus: Dict[str, float] = None, include_equips: bool = False):
+async def remove_stat_bonus(user_id: str, bonus: Dict[str, float] = None, include_equips: bool = False):
     """
     Trừ các chỉ số permanent (vd: lúc tháo buff) khỏi text_fight.
     - bonus: dict các chỉ số cần trừ
     - include_equips: nếu True → trả về bản tính toán sau khi trừ equip bonuses (không ghi)
     """
-    tf = get_user_textfight(user_id)
+    tf = await get_user_textfight(user_id)
 
     if bonus and isinstance(bonus, dict):
         for stat, value in bonus.items():
@@ -220,12 +308,12 @@ def remove_stat_bonus(user_id: str, bonus: Dict[str, float] = None, include_equi
             tf[stat] = tf.get(stat, 0) - val
 
         try:
-            update_textfight(user_id, {k: tf[k] for k in bonus.keys()})
+            await update_textfight(user_id, {k: tf[k] for k in bonus.keys()})
         except Exception as e:
             print(f"[remove_stat_bonus] Lỗi ghi DB cho {user_id}: {e}")
 
     if include_equips:
-        equips = _get_equips(user_id)
+        equips = await _get_equips(user_id)
         equip_bonus = _aggregate_bonuses(equips)
         combined = tf.copy()
         for stat, v in equip_bonus.items():
@@ -235,82 +323,150 @@ def remove_stat_bonus(user_id: str, bonus: Dict[str, float] = None, include_equi
     return tf
 
 # === FULL STATS (computed on-the-fly) ===
-def get_full_stats(user_id: str) -> Dict:
+_FULL_STATS_PROJECTION = {"text_fight": 1, "fight_equips": 1}
+
+def _full_stats_from_doc(doc: Optional[Dict]) -> Dict:
+    """Tính chỉ số đầy đủ từ document đã đọc (text_fight + fight_equips)."""
+    doc = doc or {}
+    total = dict(DEFAULT_TEXTFIGHT)
+    total.update(doc.get("text_fight") or {})
+    equips = ((doc.get("fight_equips") or []) + [None] * EQUIP_SLOTS)[:EQUIP_SLOTS]
+    for stat, val in _aggregate_bonuses(equips).items():
+        total[stat] = total.get(stat, 0) + val
+    total["equips"] = equips
+    return total
+
+async def get_full_stats(user_id: str) -> Dict:
     """
     Trả về chỉ số đầy đủ của người chơi:
     - base = text_fight (những gì lưu trong DB)
     - equips bonuses được tính ở runtime, không ghi vào DB
-    Trả về dict kết hợp và kèm key "equips" (list các key).
+    Trả về dict kết hợp và kèm key "equips" (list các key). 1 truy vấn (projection).
     """
-    tf = get_user_textfight(user_id)
-    equips = _get_equips(user_id)
-    equip_bonus = _aggregate_bonuses(equips)
+    doc = await users_col.find_one({"_id": user_id}, _FULL_STATS_PROJECTION)
+    return _full_stats_from_doc(doc)
 
-    total = tf.copy()
-    for stat, val in equip_bonus.items():
-        total[stat] = total.get(stat, 0) + val
-
-    total["equips"] = equips
-    return total
+async def get_full_stats_many(user_ids: List[str]) -> Dict[str, Dict]:
+    """Như get_full_stats cho nhiều người chơi, chỉ 1 truy vấn $in. Trả về {user_id: stats}."""
+    docs = {
+        doc["_id"]: doc
+        async for doc in users_col.find({"_id": {"$in": list(user_ids)}}, _FULL_STATS_PROJECTION)
+    }
+    return {uid: _full_stats_from_doc(docs.get(uid)) for uid in user_ids}
 
 # === BACKWARDS-COMPATIBLE ALIAS ===
-def update_user_stats(user_id: str, data: dict):
+async def update_user_stats(user_id: str, data: dict):
     """Alias cho update_textfight (giữ tên cũ nếu code khác gọi)."""
-    return update_textfight(user_id, data)
-
-# === AUTO CHECK hp/DEATH ===
-@tasks.loop(minutes=1)
+    return await update_textfight(user_id, data)
+
+# === SINH TỬ ===
+# Chết được ghi ngay khi HP về 0 (record_death) và hẹn hồi sinh đúng death_time bằng
+# scheduler (min-heap trong process). Lúc khởi động nạp lại lịch hồi sinh bằng 1 truy vấn
+# (partial index death_time_partial). auto_check_life_and_death chỉ còn là lượt quét an toàn:
+# 2 lệnh set-based trên server, dùng partial index của data_handler.ensure_indexes.
+REVIVE_DELAY = timedelta(hours=1)
+# Hồi sinh: HP về max_hp (pipeline update, đọc max_hp của chính user)
+_REVIVE_PIPELINE = [{"$set": {
+    "death": False,
+    "death_time": "$$REMOVE",
+    "text_fight.hp": {"$toInt": {"$ifNull": ["$text_fight.max_hp", DEFAULT_TEXTFIGHT["max_hp"]]}}
+}}]
+
+life_death_stats = {"runs": 0, "died": 0, "revived": 0, "last_ms": 0.0}
+
+def _doc_hp(doc: Dict) -> int:
+    return (doc.get("text_fight") or {}).get("hp", DEFAULT_TEXTFIGHT["max_hp"])
+
+def _schedule_revive(user_id: str, death_time) -> None:
+    schedule_at(death_time, ("revive", user_id), revive_user, user_id)
+
+async def revive_user(user_id: str) -> bool:
+    """Hồi sinh user nếu đã tới death_time (việc hẹn giờ của scheduler)."""
+    doc = await users_col.find_one_and_update(
+        {"_id": user_id, "death": True, "death_time": {"$lte": datetime.now(timezone.utc)}},
+        _REVIVE_PIPELINE, projection={"text_fight.hp": 1}, return_document=ReturnDocument.AFTER
+    )
+    if doc is None:
+        return False
+    life_death_stats["revived"] += 1
+    # Đồng bộ bản cache (pipeline chạy thẳng trên Mongo)
+    apply_cached(user_id, {
+        "$set": {"death": False, "text_fight.hp": _doc_hp(doc)},
+        "$unset": {"death_time": ""},
+    })
+    return True
+
+async def record_death(user_id: str) -> bool:
+    """Đánh dấu chết (nếu HP <= 0 và chưa chết) và hẹn hồi sinh sau REVIVE_DELAY."""
+    death_time = datetime.now(timezone.utc) + REVIVE_DELAY
+    result = await users_col.update_one(
+        {"_id": user_id, "text_fight.hp": {"$lte": 0}, "death": {"$ne": True}},
+        {"$set": {"death": True, "death_time": death_time}}
+    )
+    if not result.modified_count:
+        return False
+    life_death_stats["died"] += 1
+    apply_cached(user_id, {"$set": {"death": True, "death_time": death_time}})
+    _schedule_revive(user_id, death_time)
+    return True
+
+async def load_revivals() -> int:
+    """Nạp lịch hồi sinh của mọi user đang chết (gọi khi khởi động). Trả về số lịch đã hẹn."""
+    count = 0
+    # Điều kiện trên death_time để dùng được partial index death_time_partial (không quét cả collection)
+    async for doc in users_col.find({"death": True, "death_time": {"$exists": True}}, {"death_time": 1}):
+        _schedule_revive(doc["_id"], _ensure_dt_aware(doc.get("death_time")) or datetime.now(timezone.utc))
+        count += 1
+    return count
+
+def _hp_depleted(doc: Dict) -> bool:
+    return isinstance(doc.get("text_fight"), dict) and _doc_hp(doc) <= 0
+
+async def revive_due(until: datetime) -> int:
+    """Hồi sinh (1 lệnh update_many) mọi user có death_time <= until; dùng cho lô chết của đợt quét."""
+    result = await users_col.update_many({"death": True, "death_time": {"$lte": until}}, _REVIVE_PIPELINE)
+    if result.modified_count:
+        life_death_stats["revived"] += result.modified_count
+        forget_users_where(_hp_depleted)  # không biết id => bỏ các bản cache còn 0 HP
+    return result.modified_count
+
+@tasks.loop(minutes=10)
+@timed_task("life_death_sweep")
 async def auto_check_life_and_death():
-    """Kiểm tra trạng thái sinh tử của người chơi (theo text_fight)."""
+    """
+    Quét an toàn: bắt các user HP <= 0 chưa được đánh dấu chết và các lượt hồi sinh bị lỡ.
+    Đúng 2 lệnh update_many; cả lô chết trong đợt có chung death_time nên chỉ cần hẹn
+    1 việc revive_due cho cả lô (không phải kéo danh sách id về bot).
+    """
+    started = time.perf_counter()
     now = datetime.now(timezone.utc)
+    death_time = now + REVIVE_DELAY
     try:
-        cursor = users_col.find(
-            {"$or": [
-                {"text_fight.hp": {"$lte": 0}},
-                {"death": True}
-            ]},
-            {
-                "_id": 1,
-                "text_fight.hp": 1,
-                "text_fight.max_hp": 1,
-                "death": 1,
-                "death_time": 1
-            }
+        died = await users_col.update_many(
+            {"text_fight.hp": {"$lte": 0}, "death": {"$ne": True}},
+            {"$set": {"death": True, "death_time": death_time}}
+        )
+        revived = await users_col.update_many(
+            {"death": True, "death_time": {"$lte": now}},
+            _REVIVE_PIPELINE
         )
-
-        for user in cursor:
-            user_id = user["_id"]
-            text_fight = user.get("text_fight", {}) or {}
-            hp = _to_number(text_fight.get("hp", 0))
-            max_hp = _to_number(text_fight.get("max_hp", DEFAULT_TEXTFIGHT["max_hp"]))
-            death = bool(user.get("death", False))
-            death_time = _ensure_dt_aware(user.get("death_time"))
-
-            # Khi người chơi chết (chỉ đặt cờ + time)
-            if hp <= 0 and not death:
-                try:
-                    users_col.update_one(
-                        {"_id": user_id},
-                        {"$set": {"death": True, "death_time": now + timedelta(hours=1)}}
-                    )
-                except Exception as e:
-                    print(f"[auto_check] Lỗi set death cho {user_id}: {e}")
-
-            # Khi người chơi hồi sinh
-            elif death and death_time is not None and now >= death_time:
-                try:
-                    users_col.update_one(
-                        {"_id": user_id},
-                        {
-                            "$set": {"death": False, "text_fight.hp": int(max_hp)},
-                            "$unset": {"death_time": ""}
-                        }
-                    )
-                except Exception as e:
-                    print(f"[auto_check] Lỗi revive {user_id}: {e}")
-
     except Exception as e:
         print(f"[auto_check_life_and_death] Lỗi tổng: {e}")
+        return
+    if died.modified_count:
+        schedule_at(death_time, ("revive_batch", death_time), revive_due, death_time)
+    if died.modified_count or revived.modified_count:
+        forget_users_where(_hp_depleted)  # bản cache của user vừa chết / vừa hồi sinh đã cũ
+
+    died_count = died.modified_count
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    life_death_stats["runs"] += 1
+    life_death_stats["died"] += died_count
+    life_death_stats["revived"] += revived.modified_count
+    life_death_stats["last_ms"] = elapsed_ms
+    if died_count or revived.modified_count:
+        print(f"[auto_check] chết: {died_count:,}, hồi sinh: {revived.modified_count:,}, "
+              f"{elapsed_ms:.1f}ms")
 
 # === STARTUP UTILS ===
 def reapply_equipment_stats_on_startup():
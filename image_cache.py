@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+import aiohttp
+
+# === CACHE ẢNH NHIỀU TẦNG ===
+# - raw_cache: bytes ảnh tải về (avatar, nền, emoji) kèm validator HTTP (ETag/Last-Modified)
+#   và thời điểm kiểm tra gần nhất, LRU giới hạn theo tổng số byte.
+# - decoded_cache: ảnh đã giải mã + resize sẵn (layer nền CCCD, avatar 120x120, emoji PIL),
+#   tách riêng để ảnh nóng không phải giải mã lại mỗi lần.
+# - card_cache: PNG CCCD đã render xong theo user (kèm digest các đầu vào).
+# - disk_cache (tuỳ chọn, bật bằng IMAGE_DISK_CACHE_DIR): bytes ảnh gốc trên đĩa, còn lại
+#   sau khi restart, có giới hạn dung lượng riêng.
+
+IMAGE_CACHE_MB = float(os.getenv("IMAGE_CACHE_MB", "32"))
+IMAGE_DECODED_CACHE_MB = float(os.getenv("IMAGE_DECODED_CACHE_MB", "32"))
+IMAGE_CARD_CACHE_MB = float(os.getenv("IMAGE_CARD_CACHE_MB", "16"))
+IMAGE_DISK_CACHE_DIR = os.getenv("IMAGE_DISK_CACHE_DIR", "")
+IMAGE_DISK_CACHE_MB = float(os.getenv("IMAGE_DISK_CACHE_MB", "256"))
+IMAGE_FRESH_SECONDS = float(os.getenv("IMAGE_FRESH_SECONDS", "600"))  # quá hạn thì hỏi lại server (conditional GET)
+
+class ByteLRU:
+    """LRU giới hạn theo tổng kích thước (byte) thay vì số phần tử."""
+
+    def __init__(self, name: str, max_bytes: int):
+        self.name = name
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (value, size)
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key: Hashable) -> Any:
+        item = self._items.get(key)
+        if item is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        self._items.move_to_end(key)
+        return item[0]
+
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None) -> None:
+        size = len(value) if size is None else size
+        self.pop(key)
+        if size > self.max_bytes:
+            return  # lớn hơn cả ngân sách: không cache
+        self._items[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, old_size) = self._items.popitem(last=False)
+            self.bytes -= old_size
+            self.stats["evictions"] += 1
+
+    def keys(self):
+        return list(self._items)
+
+    def peek(self, key: Hashable) -> Any:
+        """Xem giá trị mà không tính hit/miss và không đổi thứ tự LRU."""
+        item = self._items.get(key)
+        return item[0] if item is not None else None
+
+    def pop(self, key: Hashable) -> Any:
+        item = self._items.pop(key, None)
+        if item is None:
+            return None
+        self.bytes -= item[1]
+        return item[0]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "items": len(self._items), "bytes": self.bytes, "max_bytes": self.max_bytes}
+
+class DiskCache:
+    """Bytes ảnh trên đĩa, tên file = sha1(key). Vượt max_bytes thì xoá file dùng lâu nhất (mtime)."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()  # get/put chạy trong thread pool (asyncio.to_thread)
+        os.makedirs(directory, exist_ok=True)
+        self._sizes: Dict[str, int] = {}
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+            elif os.path.isfile(path):
+                self._sizes[name] = os.path.getsize(path)
+        self.bytes = sum(self._sizes.values())
+
+    def _name(self, key: str) -> str:
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._get(key)
+
+    def put(self, key: str, data: bytes) -> None:
+        with self._lock:
+            self._put(key, data)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        name = self._name(key)
+        if name not in self._sizes:
+            self.stats["misses"] += 1
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # đánh dấu vừa dùng
+        except OSError:
+            self.bytes -= self._sizes.pop(name, 0)
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return data
+
+    def _put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        name = self._name(key)
+        path = os.path.join(self.directory, name)
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[ImageCache] ❌ Lỗi ghi đĩa: {e}")
+            return
+        self.bytes += len(data) - self._sizes.get(name, 0)
+        self._sizes[name] = len(data)
+        if self.bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self) -> None:
+        def mtime(name):
+            try:
+                return os.path.getmtime(os.path.join(self.directory, name))
+            except OSError:
+                return 0
+        for name in sorted(self._sizes, key=mtime):
+            if self.bytes <= self.max_bytes * 0.9:  # xoá dư 10% để không phải dọn mỗi lần ghi
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            self.bytes -= self._sizes.pop(name)
+            self.stats["evictions"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "items": len(self._sizes), "bytes": self.bytes, "max_bytes": self.max_bytes}
+
+raw_cache = ByteLRU("raw", int(IMAGE_CACHE_MB * 1024 * 1024))
+decoded_cache = ByteLRU("decoded", int(IMAGE_DECODED_CACHE_MB * 1024 * 1024))
+card_cache = ByteLRU("card", int(IMAGE_CARD_CACHE_MB * 1024 * 1024))
+disk_cache = DiskCache(IMAGE_DISK_CACHE_DIR, int(IMAGE_DISK_CACHE_MB * 1024 * 1024)) if IMAGE_DISK_CACHE_DIR else None
+
+# Entry raw: {"data": bytes, "etag": str|None, "last_modified": str|None, "checked_at": epoch}
+def _pack(entry: Dict[str, Any]) -> bytes:
+    meta = {k: entry.get(k) for k in ("etag", "last_modified", "checked_at")}
+    return json.dumps(meta).encode() + b"\n" + entry["data"]
+
+def _unpack(blob: bytes) -> Optional[Dict[str, Any]]:
+    head, sep, data = blob.partition(b"\n")
+    if not sep:
+        return None
+    try:
+        meta = json.loads(head)
+    except ValueError:
+        return None
+    return {**meta, "data": data}
+
+def is_fresh(entry: Dict[str, Any]) -> bool:
+    return time.time() - (entry.get("checked_at") or 0) < IMAGE_FRESH_SECONDS
+
+async def get_raw(url: str) -> Optional[Dict[str, Any]]:
+    """Entry ảnh đã cache: RAM trước, rồi đĩa (đọc trong thread, chép lên RAM nếu có)."""
+    entry = raw_cache.get(url)
+    if entry is None and disk_cache is not None:
+        blob = await asyncio.to_thread(disk_cache.get, url)
+        entry = _unpack(blob) if blob is not None else None
+        if entry is not None:
+            raw_cache.put(url, entry, len(entry["data"]))
+    return entry
+
+async def put_raw(url: str, entry: Dict[str, Any]) -> None:
+    old = raw_cache.peek(url)
+    if old is not None and old["data"] != entry["data"]:
+        invalidate_url(url)  # cùng URL nhưng nội dung mới: bỏ các bản đã giải mã
+    raw_cache.put(url, entry, len(entry["data"]))
+    if disk_cache is not None:
+        await asyncio.to_thread(disk_cache.put, url, _pack(entry))
+
+def invalidate_url(url: str) -> None:
+    """Bỏ các ảnh đã giải mã sinh ra từ url (key dạng (loại, url, ...))."""
+    for key in [k for k in decoded_cache.keys() if isinstance(k, tuple) and len(k) > 1 and k[1] == url]:
+        decoded_cache.pop(key)
+
+def image_version(data: bytes) -> str:
+    """Phiên bản nội dung ảnh (crc32), dùng làm khoá cho các bản đã giải mã/đã render từ ảnh đó."""
+    return f"{zlib.crc32(data):08x}"
+
+# ---- Tải ảnh (conditional GET + gộp các lần tải trùng URL) ----
+_inflight: Dict[str, asyncio.Future] = {}  # url -> Future: các lệnh cùng tải 1 URL chờ chung 1 lần tải
+
+async def fetch_raw_image(session: aiohttp.ClientSession, url: str, timeout_sec: int = 5,
+                          cache: bool = True) -> Optional[bytes]:
+    """
+    Tải bytes ảnh (chưa giải mã), có cache và timeout. Trả None nếu lỗi/chậm.
+    Bản cache còn mới (IMAGE_FRESH_SECONDS) dùng luôn; cũ thì hỏi lại server bằng
+    If-None-Match / If-Modified-Since (304 => dùng tiếp bản cache, không tải lại).
+    """
+    if not url or not url.startswith(("http://", "https://")):
+        return None
+    if not cache:
+        return await _download(session, url, None, timeout_sec, cache)
+    entry = await get_raw(url)
+    if entry is not None and is_fresh(entry):
+        return entry["data"]
+    fut = _inflight.get(url)
+    if fut is not None:
+        return await asyncio.shield(fut)
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[url] = fut
+    data = None
+    try:
+        data = await _download(session, url, entry, timeout_sec, cache)
+        return data
+    finally:
+        del _inflight[url]
+        fut.set_result(data)
+
+async def _download(session: aiohttp.ClientSession, url: str, entry, timeout_sec: int, cache: bool):
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    try:
+        async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout_sec)) as resp:
+            if resp.status == 304 and entry is not None:
+                await put_raw(url, {**entry, "checked_at": time.time()})
+                return entry["data"]
+            if resp.status != 200:
+                print("fetch_image status", resp.status, url)
+                return entry["data"] if entry is not None else None
+            data = await resp.read()
+            etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+        if cache:
+            await put_raw(url, {
+                "data": data, "etag": etag, "last_modified": last_modified, "checked_at": time.time()
+            })
+        return data
+    except Exception as e:
+        print("fetch_image error:", e, url)
+        # Lỗi mạng: dùng tạm bản cache cũ nếu có
+        return entry["data"] if entry is not None else None
+
+def image_size(img) -> int:
+    """Kích thước ước tính (byte) của 1 PIL.Image đã giải mã."""
+    return img.width * img.height * len(img.getbands())
+
+def image_cache_stats() -> Dict[str, Any]:
+    stats = {"raw": raw_cache.snapshot(), "decoded": decoded_cache.snapshot(), "card": card_cache.snapshot()}
+    if disk_cache is not None:
+        stats["disk"] = disk_cache.snapshot()
+    return stats
@@ -1,13 +1,19 @@
-from flask import Flask
+from flask import Flask, Response
 from threading import Thread
 import os
 
+from metrics import render_metrics_threadsafe
+
 app = Flask(__name__)
 
 @app.route('/')
 def home():
     return "✅ Bot is running on Render!"
 
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics_threadsafe(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
 def run():
     port = int(os.environ.get("PORT", 8080))  # Render cấp port tự động
     app.run(host="0.0.0.0", port=port)
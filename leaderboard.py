@@ -0,0 +1,105 @@
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from discord.ext import tasks
+
+from data_handler import users_col, add_user_listener, company_balance_now, flush_users
+from names import resolve_names, fallback_name
+from metrics import timed_task
+
+# === BẢNG XẾP HẠNG GIỮ SẴN TRONG RAM ===
+# Mỗi field giữ top LEADERBOARD_CANDIDATES (dư so với top 10 hiển thị, để khi vài người
+# tụt hạng vẫn còn người thay). Cập nhật từng user qua listener của data_handler,
+# và nạp lại toàn bộ từ Mongo mỗi LEADERBOARD_REFRESH giây (bắt các lệnh ghi thẳng DB,
+# giá trị công ty trôi theo thị trường). Tên hiển thị lấy qua names.py và lưu kèm bảng.
+
+LEADERBOARD_FIELDS = ("points", "company_balance", "smart")
+LEADERBOARD_SIZE = 10
+LEADERBOARD_CANDIDATES = 50
+LEADERBOARD_REFRESH = float(os.getenv("LEADERBOARD_REFRESH", "60"))  # giây
+
+_boards: Dict[str, Dict[str, int]] = {field: {} for field in LEADERBOARD_FIELDS}
+_names: Dict[str, str] = {}
+_loaded = False
+
+leaderboard_stats = {"refreshes": 0, "offers": 0, "refresh_ms": 0.0}
+
+def _score(field: str, doc: Dict[str, Any]) -> Optional[int]:
+    if field == "company_balance":
+        return company_balance_now(doc)
+    value = doc.get(field)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+def offer(user_id: str, doc: Dict[str, Any]) -> None:
+    """Listener: cập nhật điểm của user trên các bảng khi biết document mới."""
+    leaderboard_stats["offers"] += 1
+    for field in LEADERBOARD_FIELDS:
+        board = _boards[field]
+        score = _score(field, doc)
+        if score is None:
+            board.pop(user_id, None)
+        elif user_id in board or len(board) < LEADERBOARD_CANDIDATES:
+            board[user_id] = score
+        else:
+            lowest = min(board, key=board.get)
+            if score > board[lowest]:
+                del board[lowest]
+                board[user_id] = score
+
+add_user_listener(offer)
+
+async def refresh_leaderboards(bot=None) -> None:
+    """Nạp lại top ứng viên của mọi bảng từ Mongo (dùng index của từng field)."""
+    global _loaded, _names
+    start = time.perf_counter()
+    await flush_users()  # để Mongo thấy cả các thay đổi đang chờ trong cache
+    for field in LEADERBOARD_FIELDS:
+        projection = {field: 1}
+        if field == "company_balance":
+            # Giá trị công ty tính lười: lấy ứng viên theo số dư đã lưu rồi tính giá trị hiện tại
+            projection.update(company_updated_at=1, company_seed=1)
+        docs = await users_col.find(
+            {field: {"$exists": True}}, projection
+        ).sort(field, -1).limit(LEADERBOARD_CANDIDATES).to_list(LEADERBOARD_CANDIDATES)
+        board = {}
+        for doc in docs:
+            score = _score(field, doc)
+            if score is not None:
+                board[str(doc["_id"])] = score
+        _boards[field] = board
+    _loaded = True
+
+    if bot is not None:
+        shown = {uid for field in LEADERBOARD_FIELDS for uid, _ in top(field)}
+        # Dựng dict mới rồi mới gán: get_leaderboard chạy xen giữa lúc await không thấy _names rỗng
+        _names = await resolve_names(bot, shown)
+
+    leaderboard_stats["refreshes"] += 1
+    leaderboard_stats["refresh_ms"] = (time.perf_counter() - start) * 1000
+
+def top(field: str, n: int = LEADERBOARD_SIZE) -> List[Tuple[str, int]]:
+    board = _boards[field]
+    return sorted(board.items(), key=lambda item: item[1], reverse=True)[:n]
+
+async def get_leaderboard(field: str, bot, n: int = LEADERBOARD_SIZE,
+                          guild=None) -> List[Tuple[str, str, int]]:
+    """Trả về [(user_id, tên, điểm)] từ bảng trong RAM; chỉ chạm Mongo nếu chưa nạp lần nào."""
+    if not _loaded:
+        await refresh_leaderboards()
+    entries = top(field, n)
+    missing = [uid for uid, _ in entries if uid not in _names]
+    if missing:
+        _names.update(await resolve_names(bot, missing, guild))
+    # refresh có thể vừa thay _names trong lúc await ở trên => không được giả định có đủ tên
+    return [(uid, _names.get(uid) or fallback_name(uid), score) for uid, score in entries]
+
+@tasks.loop(seconds=LEADERBOARD_REFRESH)
+@timed_task("leaderboard_refresh")
+async def leaderboard_refresher(bot):
+    try:
+        await refresh_leaderboards(bot)
+    except Exception as e:
+        print(f"[LB] ❌ Lỗi làm mới bảng xếp hạng: {e}")
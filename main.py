@@ -1,10 +1,14 @@
 import os
 import io
+import copy
 import json
 import math
 import random
-from datetime import datetime, timedelta, timezone
+from datetime import datetime
 import asyncio
+import hashlib
+import signal
+import time
 import traceback
 from typing import List, Optional
 
@@ -12,11 +16,10 @@ import discord
 from discord.ext import commands
 
 import aiohttp
-from PIL import Image, ImageDraw, ImageFont
 import re
 
 # ==== DB & internal ====
-from pymongo import MongoClient
+from pymongo import UpdateOne
 from keep_alive import keep_alive
 
 # ---- ENV & Secrets ----
@@ -28,26 +31,79 @@ if not DISCORD_TOKEN:
 if not MONGO_URI:
     raise RuntimeError("Thiếu biến môi trường MONGO_URI")
 
-# ---- Mongo ----
-client = MongoClient(MONGO_URI)
-
-# Load dữ liệu & handler
+# Load dữ liệu & handler (Mongo async, không chặn event loop)
 from data_handler import (
     get_user, update_user, create_user,
-    get_jackpot, update_jackpot, set_jackpot,
-    users_col, backgrounds_col, auto_halve_jackpot
+    get_jackpot, update_jackpot, take_jackpot, jackpot_flusher, flush_jackpot,
+    buy_item, sell_item, adjust_points, transfer_points, invest_company, withdraw_company,
+    users_col, backgrounds_col, ensure_indexes,
+    user_cache_flusher, flush_users, forget_user, add_user_listener, user_cache_stats,
+    company_balance_now, company_seed, company_version, rebase_company, utc_now_ms
 )
 
 # Load hàm từ fight
 from fight import (
-    _get_equips, _set_equips, _gear_bonuses,
-    _item_display, get_full_stats, update_user_stats,
-    auto_check_life_and_death, apply_stat_bonus, remove_stat_bonus
+    _get_equips, _item_display, get_full_stats, get_full_stats_many,
+    equip_item, unequip_item, apply_hp_delta, record_death, load_revivals,
+    auto_check_life_and_death, apply_stat_bonus, remove_stat_bonus, life_death_stats
+)
+
+from leaderboard import get_leaderboard, leaderboard_refresher, leaderboard_stats
+from names import name_stats
+
+# Render CCCD trong process pool
+from cccd_render import (
+    format_currency, decode_image, build_background_layer, build_avatar_layer, render_cccd, run_render,
+    shutdown_render_pool, CCCD_RENDER_VERSION, CCCD_FILENAME
+)
+from scheduler import start_scheduler, scheduler_stats, pending_count
+from cooldowns import (
+    cached_remaining, remaining, last_used, mark_used, consume_skip, migrate_cooldown_fields, cooldown_stats
 )
+from user_locks import user_lock, locked_ctx, lock_stats, lock_count
+from tuvi_roles import compile_tuvi, best_tuvi_role, queue_tuvi_role, tuvi_role_reconciler, role_stats
+from image_cache import (
+    fetch_raw_image, image_version, decoded_cache, card_cache, image_size, image_cache_stats
+)
+from metrics import before_command, after_command, observe_task, register_stats, bind_loop
 
 # ---- Discord ----
+class AlphaBot(commands.Bot):
+    async def setup_hook(self):
+        # Render dừng worker bằng SIGTERM: đóng bot đàng hoàng để kịp flush cache
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except NotImplementedError:
+            pass
+
+    async def close(self):
+        # Ghi nốt các thay đổi user / jackpot còn nằm trong RAM trước khi tắt
+        try:
+            await flush_users()
+        except Exception:
+            traceback.print_exc()
+        try:
+            await flush_jackpot(release=True)
+        except Exception:
+            traceback.print_exc()
+        shutdown_render_pool()
+        await super().close()
+
 intents = discord.Intents.all()
-bot = commands.Bot(command_prefix='$', intents=intents, help_command=None)
+bot = AlphaBot(command_prefix='$', intents=intents, help_command=None)
+
+# ---- Metrics (/metrics trên keep_alive) ----
+bot.before_invoke(before_command)
+bot.after_invoke(after_command)
+register_stats("user_cache", lambda: user_cache_stats)
+register_stats("image_cache", image_cache_stats)
+register_stats("cooldown", lambda: cooldown_stats)
+register_stats("lock", lambda: {**lock_stats, "held": lock_count()})
+register_stats("scheduler", lambda: {**scheduler_stats, "pending": pending_count()})
+register_stats("leaderboard", lambda: leaderboard_stats)
+register_stats("names", lambda: name_stats)
+register_stats("tuvi_role", lambda: role_stats)
+register_stats("life_death", lambda: life_death_stats)
 
 # ---- Constants ----
 ALLOWED_CHANNEL_ID = 1411177026588643369
@@ -81,104 +137,34 @@ save_shop_data = lambda data: save_json('shop_data.json', data)
 
 tu_vi = load_json('tu_vi.json')
 save_tu_vi = lambda data: save_json('tu_vi.json', data)
+compile_tuvi(tu_vi)
 
 gacha_data = load_json('gacha_data.json')
 save_gacha_data = lambda data: save_json('gacha_data.json', data)
 
-def get_user_background(user_id: str) -> str:
-    doc = backgrounds_col.find_one({"_id": user_id})
+async def get_user_background(user_id: str) -> str:
+    doc = await backgrounds_col.find_one({"_id": user_id})
     return doc.get("background", None) if doc else None
 
-def set_user_background(user_id: str, background: str):
-    backgrounds_col.update_one(
+async def set_user_background(user_id: str, background: str):
+    invalidate_cccd(user_id)
+    await backgrounds_col.update_one(
         {"_id": user_id},
         {"$set": {"background": background}},
         upsert=True
     )
 
-def remove_user_background(user_id: str):
-    backgrounds_col.delete_one({"_id": user_id})
+async def remove_user_background(user_id: str):
+    invalidate_cccd(user_id)
+    await backgrounds_col.delete_one({"_id": user_id})
 
 # ---- Image/Text helpers ----
-def draw_text_with_outline(draw, text, position, font, outline_color="black", fill_color="white"):
-    x, y = position
-    offsets = [(-2, 0), (2, 0), (0, -2), (0, 2), (-2, -2), (2, -2), (-2, 2), (2, 2)]
-    for ox, oy in offsets:
-        draw.text((x + ox, y + oy), text, font=font, fill=outline_color)
-    draw.text((x, y), text, font=font, fill=fill_color)
-
-def format_currency(amount):
-    try:
-        return f"{int(amount):,}".replace(",", " ")
-    except Exception:
-        return str(amount)
-
 def count_items(items):
     counts = {}
     for name in items or {}:
         counts[name] = counts.get(name, 0) + 1
     return counts
 
-# --- Server image & font cache ---
-_SERVER_IMG_CACHE = None
-_FONT_CACHE = {}
-
-def _get_font(sz: int):
-    key = ("Roboto-Black.ttf", sz)
-    if key in _FONT_CACHE:
-        return _FONT_CACHE[key]
-    try:
-        font = ImageFont.truetype("Roboto-Black.ttf", sz)
-    except IOError:
-        font = ImageFont.load_default()
-    _FONT_CACHE[key] = font
-    return font
-
-async def _ensure_server_img():
-    global _SERVER_IMG_CACHE
-    if _SERVER_IMG_CACHE is None:
-        try:
-            _SERVER_IMG_CACHE = Image.open("1.png").convert("RGBA").resize((80, 80))
-        except Exception:
-            _SERVER_IMG_CACHE = None
-
-def _render_cccd_canvas(canvas, user_name, user_id, smart, level, role_name,
-                        progress_pct, next_smart):
-    draw = ImageDraw.Draw(canvas)
-    font_small = _get_font(12)
-    font_large = _get_font(13)
-
-    # Header
-    draw_text_with_outline(
-        draw,
-        "CỘNG HÒA XÃ HỘI CHỦ NGHĨA MEME\n          Độc lập - Tự do - Hạnh phúc\n\n                 CĂN CƯỚC CƯ DÂN",
-        (100, 20), font_large
-    )
-
-    # Thông tin cơ bản
-    draw_text_with_outline(
-        draw,
-        f"Tên: {user_name}\nID: {user_id}\nHọc vấn: {format_currency(smart)}\n"
-        f"lv: {format_currency(level)}\nTrình độ: {role_name}",
-        (160, 85), font_large
-    )
-
-    # Thanh tiến độ học vấn
-    pct = max(0.0, min(1.0, (progress_pct or 0) / 100.0))
-    bar_left, bar_top, bar_right, bar_bottom = 160, 185, 360, 205
-    draw.rectangle((bar_left, bar_top, bar_right, bar_bottom), outline="black", width=3)
-    inner_left, inner_top = bar_left + 3, bar_top + 3
-    inner_right = inner_left + int((bar_right - bar_left - 6) * pct)
-    inner_bottom = bar_bottom - 3
-    if inner_right > inner_left:
-        draw.rectangle((inner_left, inner_top, inner_right, inner_bottom), fill="#1E90FF")
-    draw_text_with_outline(draw, f"{smart}/{next_smart}", (inner_left + 2, inner_top), font_small)
-
-    bio = io.BytesIO()
-    canvas.save(bio, "PNG")
-    bio.seek(0)
-    return bio
-
 # ---- Gacha ----
 def roll_gacha_from_pool():
     rarity_list = list(gacha_data["rarity_chance"].keys())
@@ -195,28 +181,10 @@ def calculate_level_and_progress(smart):
     progress_percentage = min((smart / next_level_needed_smart) * 100, 100) if next_level_needed_smart > 0 else 0
     return level, round(progress_percentage, 2), next_level_needed_smart
 
-def _best_tuvi_role(level: int):
-    """Trả về (role_name, role_id) tốt nhất theo level, hoặc ('None', None) nếu không có."""
-    best_name, best_id, best_min = "None", None, -1
-    for name, info in tu_vi.items():
-        lvmin = int(info.get("level_min", 0))
-        if level >= lvmin and lvmin > best_min:
-            best_name, best_id, best_min = name, int(info.get("id", 0)), lvmin
-    return best_name, (best_id if best_id != 0 else None)
-
-async def _ensure_server_img():
-    """Đảm bảo _SERVER_IMG_CACHE đã được load & resize sẵn."""
-    global _SERVER_IMG_CACHE
-    if _SERVER_IMG_CACHE is None:
-        try:
-            _SERVER_IMG_CACHE = Image.open("1.png").convert("RGBA").resize((80, 80))
-        except Exception:
-            _SERVER_IMG_CACHE = None
-
 # ---- Permissions & user checks ----
 async def check_permission(ctx, user_id):
 
-    if not get_user(user_id):
+    if not await get_user(user_id):
         await ctx.reply("Có vẻ bạn chưa chơi lần nào trước đây vui lòng dùng `$start` để tạo tài khoản.")
         return False
 
@@ -224,104 +192,172 @@ async def check_permission(ctx, user_id):
 
 # ---- HTTP session (reused) ----
 http_session: aiohttp.ClientSession | None = None
+HTTP_CONN_LIMIT = int(os.getenv("HTTP_CONN_LIMIT", "50"))
+HTTP_CONN_PER_HOST = int(os.getenv("HTTP_CONN_PER_HOST", "8"))
 
-# --- Image cache & timeout for fetch_image ---
-_IMG_BYTES_CACHE = {}  # url -> bytes (avatar/bg)
+# --- Image cache & timeout for fetch_image (cache nhiều tầng: image_cache.py) ---
 
-async def fetch_image(url: str, timeout_sec: int = 5, cache: bool = True):
-    """Tải ảnh RGBA, có cache và timeout. Trả None nếu lỗi/chậm."""
-    if not url or not url.startswith(("http://", "https://")):
+async def fetch_image_bytes(url: str, timeout_sec: int = 5, cache: bool = True):
+    """Tải bytes ảnh (chưa giải mã) qua session dùng chung, có cache + revalidate (image_cache.py)."""
+    assert http_session is not None
+    return await fetch_raw_image(http_session, url, timeout_sec, cache)
+
+async def fetch_image(url: str, timeout_sec: int = 5, cache: bool = True, size=None):
+    """
+    Tải ảnh RGBA, có cache và timeout. Trả None nếu lỗi/chậm.
+    size=(w, h): giải mã thẳng về gần kích thước đích (decode_image) rồi resize đúng size.
+    """
+    data = await fetch_image_bytes(url, timeout_sec, cache)
+    if data is None:
         return None
     try:
-        if cache and url in _IMG_BYTES_CACHE:
-            return Image.open(io.BytesIO(_IMG_BYTES_CACHE[url])).convert("RGBA")
-        assert http_session is not None
-        async with http_session.get(
-            url, timeout=aiohttp.ClientTimeout(total=timeout_sec)
-        ) as resp:
-            if resp.status != 200:
-                print("fetch_image status", resp.status, url)
-                return None
-            data = await resp.read()
-        if cache:
-            _IMG_BYTES_CACHE[url] = data
-        return Image.open(io.BytesIO(data)).convert("RGBA")
+        return decode_image(data, size)
     except Exception as e:
         print("fetch_image error:", e, url)
         return None
 
+# --- Ảnh CCCD đã giải mã sẵn (decoded_cache): layer nền 400x225 đã dán logo, avatar 120x120 ---
+async def _decoded_layer(kind: str, url: str, build, timeout_sec: int = 6, data: bytes = None):
+    # Luôn lấy bytes qua fetch_image_bytes (còn mới: đọc RAM; cũ: hỏi lại server) rồi mới tra
+    # layer theo phiên bản nội dung => ảnh mới cùng URL không bao giờ dùng nhầm layer cũ
+    if data is None:
+        data = await fetch_image_bytes(url, timeout_sec)
+    if data is None:
+        return None
+    key = (kind, url, image_version(data))
+    layer = decoded_cache.get(key)
+    if layer is not None:
+        return layer
+    try:
+        layer = await run_render(build, data)
+    except Exception as e:
+        print(f"{kind} layer error:", e, url)
+        return None
+    decoded_cache.put(key, layer)
+    return layer
+
+async def get_background_layer(url: str, timeout_sec: int = 6, data: bytes = None):
+    return await _decoded_layer("bg", url, build_background_layer, timeout_sec, data)
+
+async def get_avatar_layer(url: str, timeout_sec: int = 6, data: bytes = None):
+    return await _decoded_layer("avatar", url, build_avatar_layer, timeout_sec, data)
+
+# --- Ảnh CCCD đã render (card_cache): user_id -> (digest đầu vào, smart, PNG bytes) ---
+def _cccd_digest(*inputs) -> str:
+    return hashlib.sha1(repr((CCCD_RENDER_VERSION,) + inputs).encode()).hexdigest()
+
+def invalidate_cccd(user_id: str) -> None:
+    card_cache.pop(user_id)
+
+def _cccd_on_user_change(user_id: str, doc) -> None:
+    # Listener của data_handler: học vấn đổi thì bỏ ảnh CCCD cũ
+    entry = card_cache.peek(user_id)
+    if entry is not None and entry[1] != int(doc.get("smart") or 0):
+        card_cache.pop(user_id)
+
+add_user_listener(_cccd_on_user_change)
+
 # ---- Background tasks ----
+COMPANY_COMPACT_BATCH = 1000  # số công ty xử lý mỗi lô (1 bulk_write / lô)
+COMPANY_COMPACT_HOURS = float(os.getenv("COMPANY_COMPACT_HOURS", "6"))  # 0 = tắt
+
+async def _compact_company_batch(batch, now) -> int:
+    """Ghi giá trị công ty hiện tại + mốc thời gian mới cho 1 lô bằng 1 bulk_write."""
+    ops = []
+    for doc in batch:
+        update = {"$set": {
+            "company_balance": company_balance_now(doc, now),
+            "company_updated_at": now,
+            "company_seed": company_seed(doc["_id"], doc),
+        }}
+        # Chỉ ghi nếu chưa có lệnh nào re-base công ty này trong lúc đang nén
+        ops.append(UpdateOne({"_id": doc["_id"], **company_version(doc)}, update))
+    result = await users_col.bulk_write(ops, ordered=False)
+    # bulk_write không cho biết lệnh nào khớp điều kiện => bỏ bản cache sạch để lần đọc sau lấy từ DB.
+    # Bản cache còn field chờ ghi vẫn đúng: cặp (balance, mốc thời gian) cũ tính ra cùng giá trị hiện tại.
+    for doc in batch:
+        forget_user(doc["_id"])
+    return result.modified_count
+
 async def update_company_balances():
-    """Cứ 60s: biến động ngẫu nhiên từ -5% → +5%, và thuế -10% mỗi giờ."""
-    last_tax_time = datetime.now(timezone.utc)
+    """
+    Nén định kỳ (tuỳ chọn) giá trị công ty. Giá trị được tính lười khi đọc (xem data_handler),
+    job này chỉ ghi lại để lần tính sau ngắn hơn và bắt đầu tính giờ cho công ty dữ liệu cũ.
+    """
+    if COMPANY_COMPACT_HOURS <= 0:
+        return
 
     while True:
+        started = time.perf_counter()
         try:
+            now = utc_now_ms()
             cursor = users_col.find(
                 {"company_balance": {"$gt": 0}},
-                {"company_balance": 1}
+                {"company_balance": 1, "company_updated_at": 1, "company_seed": 1},
+                batch_size=COMPANY_COMPACT_BATCH
             )
 
-            # --- Kiểm tra thuế mỗi giờ ---
-            now = datetime.now(timezone.utc)
-            apply_tax = False
-            if (now - last_tax_time) >= timedelta(hours=1):
-                apply_tax = True
-                last_tax_time = now
-                print(f"\n💰 [TAX] Thuế 10% công ty được áp dụng lúc {now.strftime('%H:%M:%S UTC')}")
-
-            # --- Lặp qua từng công ty ---
-            for doc in cursor:
-                uid = doc["_id"]
-                balance = doc.get("company_balance", 0)
-
-                # Biến động ngẫu nhiên -5 → +5%
-                percent_change = random.randint(-5, 5)
-                new_balance = int(balance * (1 + percent_change / 100))
-
-                # Áp dụng thuế nếu đến giờ
-                if apply_tax:
-                    tax_amount = int(new_balance * 0.10)
-                    new_balance -= tax_amount
-
-                # Không âm
-                new_balance = max(0, new_balance)
-
-                # Cập nhật nếu có thay đổi
-                if new_balance != balance:
-                    update_user(uid, {"company_balance": new_balance})
-                    msg = f"[COMPANY] {uid}: {balance:,} → {new_balance:,} ({percent_change:+d}%)"
-                    if apply_tax:
-                        msg += " [đã trừ 10% thuế]"
-                    print(msg)
+            # --- Xử lý theo lô ---
+            scanned = changed = 0
+            batch = []
+            async for doc in cursor:
+                batch.append(doc)
+                if len(batch) >= COMPANY_COMPACT_BATCH:
+                    changed += await _compact_company_batch(batch, now)
+                    scanned += len(batch)
+                    batch = []
+            if batch:
+                changed += await _compact_company_batch(batch, now)
+                scanned += len(batch)
+
+            print(f"[COMPANY] nén {time.perf_counter() - started:.2f}s: "
+                  f"{scanned:,} công ty, {changed:,} cập nhật")
+            observe_task("company_compact", time.perf_counter() - started)
 
         except Exception:
             traceback.print_exc()
+            observe_task("company_compact", time.perf_counter() - started, error=True)
 
-        await asyncio.sleep(60)
+        await asyncio.sleep(COMPANY_COMPACT_HOURS * 3600)
         
+ZERO_ITEM_SWEEP_HOURS = 6  # item về 0 đã được xoá ngay lúc ghi, đây chỉ là lưới an toàn
+
 async def clean_zero_items():
-    """Cứ 10s: xoá item có số lượng <= 0 để gọn DB."""
+    """
+    Lưới an toàn: định kỳ xoá item có số lượng <= 0 còn sót (vd dữ liệu cũ).
+    Chạy hoàn toàn phía server bằng 1 lệnh update_many, không kéo document nào về bot.
+    """
+    items_array = {"$objectToArray": "$items"}
     while True:
+        started = time.perf_counter()
         try:
-            cursor = users_col.find({"items": {"$exists": True}})
-            for doc in cursor:
-                uid = doc["_id"]
-                items = doc.get("items", {}) or {}
-                new_items = {k: v for k, v in items.items() if isinstance(v, int) and v > 0}
-                if new_items != items:
-                    update_user(uid, {"items": new_items})
+            result = await users_col.update_many(
+                {
+                    "items": {"$type": "object"},
+                    "$expr": {"$anyElementTrue": [{"$map": {
+                        "input": items_array, "as": "it",
+                        "in": {"$not": [{"$and": [{"$isNumber": "$$it.v"}, {"$gt": ["$$it.v", 0]}]}]}
+                    }}]}
+                },
+                [{"$set": {"items": {"$arrayToObject": {"$filter": {
+                    "input": items_array, "as": "it",
+                    "cond": {"$and": [{"$isNumber": "$$it.v"}, {"$gt": ["$$it.v", 0]}]}
+                }}}}}]
+            )
+            print(f"[ITEMS] dọn item <= 0: {result.modified_count:,} user, "
+                  f"{time.perf_counter() - started:.2f}s")
+            observe_task("zero_item_sweep", time.perf_counter() - started)
         except Exception:
             traceback.print_exc()
-        await asyncio.sleep(10)
+            observe_task("zero_item_sweep", time.perf_counter() - started, error=True)
+        await asyncio.sleep(ZERO_ITEM_SWEEP_HOURS * 3600)
 
 _CUSTOM_EMOJI_RE = re.compile(r"<a?:[A-Za-z0-9_]+:(\d+)>")
-_EMOJI_IMG_CACHE = {}  # (emoji_id, size) -> PIL.Image
 
 async def icon_to_image(icon_str: str, size: int = 24):
     """
     Trả về PIL.Image (RGBA) từ icon custom emoji <:...:id> / <a:...:id>.
-    Dùng Discord CDN. Có cache theo (id, size).
+    Dùng Discord CDN. Có cache theo (id, size) trong decoded_cache.
     """
     if not icon_str:
         return None
@@ -330,34 +366,64 @@ async def icon_to_image(icon_str: str, size: int = 24):
         return None  # không phải custom emoji
 
     emoji_id = m.group(1)
-    cache_key = (emoji_id, size)
-    if cache_key in _EMOJI_IMG_CACHE:
-        return _EMOJI_IMG_CACHE[cache_key]
+    cache_key = ("emoji", emoji_id, size)
+    cached = decoded_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
     # Ưu tiên PNG (fallback WEBP)
     for ext in ("png", "webp"):
         url = f"https://cdn.discordapp.com/emojis/{emoji_id}.{ext}?size={size}&quality=lossless"
-        img = await fetch_image(url)  # hàm async của bạn, trả PIL.Image RGBA
+        img = await fetch_image(url, size=(size, size))
         if img:
-            img = img.resize((size, size))
-            _EMOJI_IMG_CACHE[cache_key] = img
+            decoded_cache.put(cache_key, img, image_size(img))
             return img
     return None
 
 # ==== EVENTS ====
+_role_task = None  # task nền sửa role tu_vi
 @bot.event
 async def on_ready():
-    global http_session
+    global http_session, _role_task
     print(f'Bot đã đăng nhập với tên {bot.user}')
-    http_session = aiohttp.ClientSession()
+    bind_loop(asyncio.get_running_loop())
+    # Giới hạn số kết nối đồng thời, nhất là tới cùng 1 host (CDN Discord, trang ảnh nền)
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=HTTP_CONN_LIMIT, limit_per_host=HTTP_CONN_PER_HOST, ttl_dns_cache=300
+        ))
+    await ensure_indexes()
+    migrated = await migrate_cooldown_fields()
+    if migrated:
+        print(f"[COOLDOWN] đã đổi {migrated:,} mốc thời gian dạng chuỗi sang datetime")
+    if not user_cache_flusher.is_running():
+        user_cache_flusher.start()
+    if not jackpot_flusher.is_running():
+        jackpot_flusher.start()
+    if not leaderboard_refresher.is_running():
+        leaderboard_refresher.start(bot)
 
     bot.loop.create_task(update_company_balances())
     bot.loop.create_task(clean_zero_items())
+    if not _role_task or _role_task.done():
+        _role_task = bot.loop.create_task(tuvi_role_reconciler(bot))
+    start_scheduler()
+    print(f"[SCHEDULER] đã hẹn {await load_revivals():,} lượt hồi sinh")
     if not auto_check_life_and_death.is_running():
         auto_check_life_and_death.start()
-    auto_halve_jackpot.start()
     print(f"✅ Bot đã khởi động: {bot.user}")
 
+@bot.event
+async def on_user_update(before, after):
+    # Đổi avatar => URL avatar (hash) đổi: bỏ ảnh CCCD cũ
+    if before.avatar != after.avatar:
+        invalidate_cccd(str(after.id))
+
+@bot.event
+async def on_member_update(before, after):
+    if before.guild_avatar != after.guild_avatar:
+        invalidate_cccd(str(after.id))
+
 @bot.event
 async def on_command_error(ctx, error):
 
@@ -400,12 +466,12 @@ async def start(ctx):
     user_id = str(ctx.author.id)
     member = ctx.author
 
-    if get_user(user_id):
+    if await get_user(user_id):
         await ctx.reply(f"Bạn đã có tài khoản rồi, {ctx.author.mention} ơi! Không cần tạo lại nữa.")
         return
 
     user_data = {"points": 10000, "items": {}, "smart": 100}
-    create_user(user_id, user_data)
+    await create_user(user_id, user_data)
 
     role_id = 1316985467853606983
     role = ctx.guild.get_role(role_id)
@@ -427,7 +493,7 @@ async def info(ctx):
 
 @bot.command(name="jar", help='`$jar`\n> xem hũ jackpot')
 async def jp(ctx):
-    jackpot_amount = format_currency(get_jackpot() or 0)
+    jackpot_amount = format_currency(await get_jackpot() or 0)
     await ctx.reply(f"💰 **Jackpot hiện tại:** {jackpot_amount} {coin}")
 
 @bot.command(name="shop", help='`$shop`\n> xem cửa hàng')
@@ -465,26 +531,14 @@ async def buy(ctx, item_id: str, quantity: int):
 
     item_data = shop_data[item_id]
     item_name = item_data['name']
-    user = get_user(user_id)
-    if not user:
-        await ctx.reply("Không tìm thấy dữ liệu người dùng.")
-        return
-
-    user_items = user.get('items', {}) or {}
     total_price = int(item_data['price']) * int(quantity)
 
-    if total_price > user.get('points', 0):
+    # Trừ tiền + cộng hàng trong 1 thao tác có điều kiện (chỉ thành công khi đủ tiền)
+    user = await buy_item(user_id, item_name, int(quantity), total_price, init_company=(item_id == "01"))
+    if user is None:
         await ctx.reply("Bạn không đủ tiền để mua món này.")
         return
 
-    if item_id == "01" and "company_balance" not in user:
-        user["company_balance"] = 0
-
-    user['points'] = user.get('points', 0) - total_price
-    user_items[item_name] = int(user_items.get(item_name, 0)) + int(quantity)
-    user['items'] = user_items
-    update_user(user_id, user)
-
     await ctx.reply(f"Bạn đã mua {quantity} {item_name}.")
 
 @bot.command(name="sell")
@@ -506,26 +560,16 @@ async def sell(ctx, item_id: str, quantity: int):
     item_name = item_data['name']
     selling_price = round(int(item_data['price']) * int(quantity) * 0.9)
 
-    user = get_user(user_id)
-    if not user:
-        await ctx.reply("Không tìm thấy dữ liệu người dùng.")
-        return
-
-    user_items = user.get('items', {}) or {}
-    current_quantity = int(user_items.get(item_name, 0))
-
-    if current_quantity < quantity:
+    # Trừ hàng + cộng tiền trong 1 thao tác có điều kiện (chỉ thành công khi đủ hàng)
+    user = await sell_item(user_id, item_name, int(quantity), selling_price)
+    if user is None:
         await ctx.reply("Bạn không có đủ mặt hàng này để bán.")
         return
 
-    user_items[item_name] = current_quantity - quantity
-
-    if item_id == "01" and user_items.get(":office: Công ty", 0) == 0:
-        user.pop("company_balance", None)
-
-    user['points'] = int(user.get('points', 0)) + selling_price
-    user['items'] = user_items
-    update_user(user_id, user)
+    if item_id == "01" and (user.get('items') or {}).get(item_name, 0) <= 0:
+        await update_user(user_id, {"$unset": {
+            "company_balance": "", "company_updated_at": "", "company_seed": ""
+        }})
 
     await ctx.reply(f"Bạn đã bán {quantity} {item_name} và nhận {format_currency(selling_price)} {coin}.")
 
@@ -559,7 +603,7 @@ async def set_background(ctx, member: discord.Member, background_url: str):
     user_id = str(member.id)
 
     # Lưu vào DB Mongo
-    set_user_background(user_id, background_url)
+    await set_user_background(user_id, background_url)
 
     await ctx.reply(f"✅ Đã thay đổi nền của **{member.display_name}** thành: {background_url}")
 
@@ -573,70 +617,71 @@ async def cccd(ctx, member: discord.Member = None, size: int = 128):
         return
 
     # ===== DB & chỉ số học vấn =====
-    data = get_user(user_id) or {}
+    data = await get_user(user_id) or {}
     smart = int(data.get("smart", 0))
     user_name = member.name
 
-    avatar_asset = member.display_avatar.with_size(size)
+    # Avatar chỉ vẽ 120x120: không tải bản lớn hơn 128
+    avatar_asset = member.display_avatar.with_size(min(size, 128))
     if hasattr(avatar_asset, "with_static_format"):
         avatar_asset = avatar_asset.with_static_format("webp")
     avatar_url = avatar_asset.url
 
     level, progress_pct, next_smart = calculate_level_and_progress(smart)
 
-    # ===== Role tu_vi =====
-    def _best_tuvi_role(level: int):
-        best_name, best_id, best_min = "None", None, -1
-        for name, info in tu_vi.items():
-            lvmin = int(info.get("level_min", 0))
-            if level >= lvmin and lvmin > best_min:
-                best_name, best_id, best_min = name, int(info.get("id", 0)), lvmin
-        return best_name, (best_id if best_id else None)
-
-    role_name, role_id = _best_tuvi_role(level)
-    wanted = ctx.guild.get_role(role_id) if role_id else None
-    tuvi_role_ids = {int(info.get("id", 0)) for info in tu_vi.values() if "id" in info}
-    current_tuvi_roles = [r for r in member.roles if r.id in tuvi_role_ids]
-    try:
-        to_remove = [r for r in current_tuvi_roles if (not wanted or r.id != wanted.id)]
-        if to_remove:
-            await member.remove_roles(*to_remove, reason="Update cấp bậc tu_vi")
-        if wanted and wanted not in member.roles:
-            await member.add_roles(wanted, reason="Assign cấp bậc tu_vi")
-    except discord.Forbidden:
-        pass
-
-    # ===== Tải ảnh (song song) =====
-    bg_url = get_user_background(user_id)
+    # ===== Role tu_vi (sửa role chạy nền, không chờ REST) =====
+    role_name, role_id = best_tuvi_role(level)
+    queue_tuvi_role(member, role_id)
+
+    bg_url = await get_user_background(user_id)
     if not bg_url:
         bg_url = "https://wallpaperaccess.com/full/1556608.jpg"  # default
-    await _ensure_server_img()
-    avatar_img, bg_img = await asyncio.gather(
-        fetch_image(avatar_url, timeout_sec=6),
-        fetch_image(bg_url, timeout_sec=6),
+
+    # ===== Tải ảnh (song song; bản cache còn mới thì không ra mạng, cũ thì revalidate) =====
+    avatar_bytes, bg_bytes = await asyncio.gather(
+        fetch_image_bytes(avatar_url, timeout_sec=6),
+        fetch_image_bytes(bg_url, timeout_sec=6),
     )
-    if not avatar_img:
+    if not avatar_bytes:
         await ctx.reply("Lỗi tải ảnh avatar.")
         return
-    if not bg_img:
+    if not bg_bytes:
         await ctx.reply("Lỗi tải ảnh nền.")
         return
 
-    # ===== Ghép ảnh =====
-    avatar_img = avatar_img.resize((120, 120))
-    canvas = bg_img.resize((400, 225)).copy()
-    if _SERVER_IMG_CACHE:
-        canvas.paste(_SERVER_IMG_CACHE, (10, 10), mask=_SERVER_IMG_CACHE)
-    canvas.paste(avatar_img, (20, 85), mask=avatar_img)
-
-    # ===== Render CCCD (chỉ thông tin cơ bản + học vấn) =====
-    bio = await asyncio.to_thread(
-        _render_cccd_canvas,
-        canvas, user_name, user_id, smart, level, role_name,
-        progress_pct, next_smart
+    # ===== Ảnh đã render với đúng các đầu vào này (kể cả nội dung ảnh): gửi luôn, không vẽ lại =====
+    digest = _cccd_digest(avatar_url, image_version(avatar_bytes), bg_url, image_version(bg_bytes),
+                          user_name, user_id, smart, level, role_name)
+    cached = card_cache.get(user_id)
+    if cached is not None and cached[0] == digest:
+        await ctx.reply(file=discord.File(fp=io.BytesIO(cached[2]), filename=CCCD_FILENAME))
+        return
+
+    avatar, layer = await asyncio.gather(
+        get_avatar_layer(avatar_url, data=avatar_bytes),
+        get_background_layer(bg_url, data=bg_bytes),
     )
+    if not avatar:
+        await ctx.reply("Lỗi tải ảnh avatar.")
+        return
+    if not layer:
+        await ctx.reply("Lỗi tải ảnh nền.")
+        return
+
+    # ===== Ghép ảnh + render CCCD (process pool, không chặn event loop) =====
+    try:
+        png = await run_render(
+            render_cccd,
+            layer, avatar, user_name, user_id, smart, level, role_name,
+            progress_pct, next_smart
+        )
+    except Exception as e:
+        print("render cccd error:", e)
+        await ctx.reply("Lỗi tạo ảnh CCCD.")
+        return
+    card_cache.put(user_id, (digest, smart, png), len(png))
 
-    await ctx.reply(file=discord.File(fp=bio, filename="cccd.png"))
+    await ctx.reply(file=discord.File(fp=io.BytesIO(png), filename=CCCD_FILENAME))
 
 @bot.command(name="bag", help='`$bag`\n> mở túi')
 async def bag(ctx, member: discord.Member = None):
@@ -648,10 +693,10 @@ async def bag(ctx, member: discord.Member = None):
         return
 
     # Lấy dữ liệu người dùng từ MongoDB
-    data = get_user(user_id)
+    data = await get_user(user_id)
     points = format_currency(data.get('points', 0))
     items = data.get('items', {})
-    company_balance = data.get("company_balance")
+    company_balance = company_balance_now(data)
 
     # Định dạng danh sách item
     if not items:
@@ -678,58 +723,69 @@ async def bag(ctx, member: discord.Member = None):
 async def tx(ctx, bet: str, choice: str):
     try:
         user_id = str(ctx.author.id)
-        data = get_user(user_id)
 
         if not await check_permission(ctx, user_id):
             return
 
-        # Lấy jackpot hiện tại
-        jackpot_amount = int(get_jackpot() or 0)
-        jackpot_display = format_currency(jackpot_amount)
+        # Kiểm tra lựa chọn
+        choice = choice.lower()
+        if choice not in ["t", "x"]:
+            await ctx.reply("Bạn phải chọn 't' (Tài) hoặc 'x' (Xỉu).")
+            return
 
-        # Xử lý tiền cược
-        if bet.lower() == "all":
-            bet_val = int(data.get("points", 0))
-        else:
+        if bet.lower() != "all":
             try:
-                bet_val = int(bet)
+                int(bet)
             except:
                 await ctx.reply("Số tiền cược không hợp lệ.")
                 return
 
-        if bet_val <= 0 or bet_val > int(data.get("points", 0)):
-            await ctx.reply("Bạn không đủ tiền để cược.")
-            return
-
-        # Kiểm tra lựa chọn
-        choice = choice.lower()
-        if choice not in ["t", "x"]:
-            await ctx.reply("Bạn phải chọn 't' (Tài) hoặc 'x' (Xỉu).")
-            return
+        # ===== Đọc số dư + gieo + ghi DB: chỉ giữ khoá user trong đoạn này, tin nhắn gửi sau khi nhả =====
+        async with user_lock(ctx.author.id):
+            data = await get_user(user_id)
+
+            # Lấy jackpot hiện tại
+            jackpot_amount = int(await get_jackpot() or 0)
+            jackpot_display = format_currency(jackpot_amount)
+
+            # Xử lý tiền cược
+            bet_val = int(data.get("points", 0)) if bet.lower() == "all" else int(bet)
+            enough = 0 < bet_val <= int(data.get("points", 0))
+
+            if enough:
+                # ===== Gieo xúc xắc =====
+                dice1, dice2, dice3 = random.randint(1, 6), random.randint(1, 6), random.randint(1, 6)
+                total = dice1 + dice2 + dice3
+
+                # ===== KẾT QUẢ =====
+                jackpot_won = False
+                win = (3 <= total <= 10 and choice == "x") or (11 <= total <= 18 and choice == "t")
+
+                if bet_val * 1000 >= jackpot_amount and total in (3, 18) and jackpot_amount > 0:
+                    # Ăn jackpot: lấy cả hũ và đặt về 0 trong 1 thao tác
+                    jackpot_amount = await take_jackpot()
+                    jackpot_won = jackpot_amount > 0
+                    jackpot_display = format_currency(jackpot_amount)
+
+                if jackpot_won:
+                    delta = jackpot_amount
+                elif win:
+                    # Thắng
+                    delta = bet_val
+                else:
+                    delta = -bet_val
 
-        # ===== Gieo xúc xắc =====
-        dice1, dice2, dice3 = random.randint(1, 6), random.randint(1, 6), random.randint(1, 6)
-        total = dice1 + dice2 + dice3
-
-        # ===== KẾT QUẢ =====
-        jackpot_won = False
-        lose_protected = False
-        win = (3 <= total <= 10 and choice == "x") or (11 <= total <= 18 and choice == "t")
-
-        if bet_val * 1000 >= jackpot_amount and total in (3, 18) and jackpot_amount > 0:
-            # Ăn jackpot
-            data["points"] += jackpot_amount
-            set_jackpot(0)
-            jackpot_won = True
-        elif win:
-            # Thắng
-            data["points"] += bet_val
-        else:
-            data["points"] -= bet_val
-            update_jackpot(bet_val)
+                # ===== Cập nhật DB (chỉ khi vẫn còn đủ tiền cược) =====
+                if await adjust_points(user_id, delta, min_balance=bet_val) is None:
+                    if jackpot_won:
+                        await update_jackpot(jackpot_amount)  # trả lại hũ
+                    enough = False
+                elif not jackpot_won and not win:
+                    await update_jackpot(bet_val)
 
-        # ===== Cập nhật DB =====
-        update_user(user_id, data)
+        if not enough:
+            await ctx.reply("Bạn không đủ tiền để cược.")
+            return
 
         # ===== Animation xúc xắc =====
         def _emoji(i):
@@ -777,26 +833,21 @@ async def tx(ctx, bet: str, choice: str):
 
 @bot.command(name="daily", help='`$daily`\n> nhận quà hằng ngày')
 async def daily(ctx):
-    user_id = str(ctx.author.id)
-    data = get_user(user_id)
-
-    if not await check_permission(ctx, user_id):
-        return
-
-    now = datetime.now().date()
+    async with locked_ctx(ctx, ctx.author.id) as ctx:
+        user_id = str(ctx.author.id)
+        left = cached_remaining("daily", user_id)  # đã nhận hôm nay (biết sẵn trong RAM): không đọc DB
+        if not left:
+            data = await get_user(user_id)
+            original = copy.deepcopy(data)
 
-    last_daily_str = data.get("last_daily")
-    streak = data.get("streak", 0)
+            if not await check_permission(ctx, user_id):
+                return
 
-    if last_daily_str:
-        last_daily = datetime.strptime(last_daily_str, "%Y-%m-%d").date()
+            left = remaining("daily", user_id, data)
 
-        if last_daily == now:
+        if left:
             # Đã nhận hôm nay
-            next_daily = last_daily + timedelta(days=1)
-            time_remaining = datetime.combine(next_daily, datetime.min.time()) - datetime.now()
-
-            hours, remainder = divmod(time_remaining.seconds, 3600)
+            hours, remainder = divmod(int(left), 3600)
             minutes, seconds = divmod(remainder, 60)
 
             return await ctx.reply(
@@ -804,103 +855,97 @@ async def daily(ctx):
                 f"{hours} giờ {minutes} phút {seconds} giây."
             )
 
-        elif (now - last_daily).days == 1:
+        now = datetime.now().date()
+
+        last_daily = last_used("daily", data)
+        streak = data.get("streak", 0)
+
+        if last_daily and (now - last_daily.astimezone().date()).days == 1:
             streak += 1
         else:
             streak = 1
-    else:
-        streak = 1
 
-    data["streak"] = streak
+        data["streak"] = streak
 
-    base_reward = 5000
-    streak_bonus = streak * 100
-    total_reward = base_reward + streak_bonus
+        base_reward = 5000
+        streak_bonus = streak * 100
+        total_reward = base_reward + streak_bonus
 
-    data["points"] = data.get("points", 0) + total_reward
-    data["last_daily"] = now.strftime("%Y-%m-%d")
+        data["points"] = data.get("points", 0) + total_reward
+        data.update(mark_used("daily", user_id))
 
-    update_user(user_id, data)
+        await update_user(user_id, data, original)
 
-    await ctx.reply(
-        f"Bạn đã nhận được {format_currency(total_reward)} {coin}! "
-        f"(Thưởng streak: {format_currency(streak_bonus)} {coin}, chuỗi ngày: {streak} ngày)"
-    )
+        await ctx.reply(
+            f"Bạn đã nhận được {format_currency(total_reward)} {coin}! "
+            f"(Thưởng streak: {format_currency(streak_bonus)} {coin}, chuỗi ngày: {streak} ngày)"
+        )
 
 @bot.command(name="beg", help='`$beg`\n> ăn xin')
 async def beg(ctx):
+    async with locked_ctx(ctx, ctx.author.id) as ctx:
+        user_id = str(ctx.author.id)
+        left = cached_remaining("beg", user_id)
+        if not left:
+            data = await get_user(user_id)
+            original = copy.deepcopy(data)
 
-    user_id = str(ctx.author.id)
-    data = get_user(user_id)
-
-    if not await check_permission(ctx, user_id):
-        return
-
-    now = datetime.now(timezone.utc)
-
-    last_beg_str = data.get("last_beg")
-    cooldown = 3 * 60  # 3 phút
+            if not await check_permission(ctx, user_id):
+                return
 
-    if last_beg_str:
-        last_beg = datetime.strptime(last_beg_str, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-        elapsed = (now - last_beg).total_seconds()
+            left = remaining("beg", user_id, data)
 
-        if elapsed < cooldown:
-            remaining = int(cooldown - elapsed)
-            minutes, seconds = divmod(remaining, 60)
+        if left:
+            minutes, seconds = divmod(int(left), 60)
             return await ctx.reply(
                 f"Bạn đã ăn xin rồi, vui lòng thử lại sau {minutes} phút {seconds} giây."
             )
 
-    # Điều kiện giàu không được ăn xin
-    if data.get('points', 0) >= 100_000:
-        return await ctx.reply('giàu mà còn đi ăn xin đéo thấy nhục à')
+        # Điều kiện giàu không được ăn xin
+        if data.get('points', 0) >= 100_000:
+            return await ctx.reply('giàu mà còn đi ăn xin đéo thấy nhục à')
 
-    beg_amount = random.randint(0, 5000)
-    data['points'] = data.get('points', 0) + beg_amount
+        beg_amount = random.randint(0, 5000)
+        data['points'] = data.get('points', 0) + beg_amount
 
-    data['last_beg'] = now.strftime("%Y-%m-%d %H:%M:%S")
-    update_user(user_id, data)
+        data.update(mark_used("beg", user_id))
+        await update_user(user_id, data, original)
 
-    await ctx.reply(f"Bạn đã nhận được {format_currency(beg_amount)} {coin} từ việc ăn xin!")
+        await ctx.reply(f"Bạn đã nhận được {format_currency(beg_amount)} {coin} từ việc ăn xin!")
 
 @bot.command(name="dn", help='`$dn <điểm> <người chơi>`\n> donate điểm cho người khác')
 async def give(ctx, amount: int, member: discord.Member):
+    async with locked_ctx(ctx, ctx.author.id, member.id) as ctx:
+        giver_id = str(ctx.author.id)
+        receiver_id = str(member.id)
 
-    giver_id = str(ctx.author.id)
-    receiver_id = str(member.id)
+        giver_data = await get_user(giver_id)
+        receiver_data = await get_user(receiver_id)
 
-    giver_data = get_user(giver_id)
-    receiver_data = get_user(receiver_id)
-    
-    if giver_id == "1243079760062709854":
-            receiver_data['points'] += amount
-    else:
-        if not giver_data:
-            await ctx.reply("Có vẻ bạn chưa chơi lần nào trước đây vui lòng dùng `$start` để tạo tài khoản.")
-            return
+        is_admin = giver_id == "1243079760062709854"
+        if not is_admin:
+            if not giver_data:
+                await ctx.reply("Có vẻ bạn chưa chơi lần nào trước đây vui lòng dùng `$start` để tạo tài khoản.")
+                return
 
-        if not receiver_data:
-            await ctx.reply("Có vẻ đối tượng chưa chơi lần nào trước đây vui lòng dùng `$start` để tạo tài khoản.")
-            return
+            if not receiver_data:
+                await ctx.reply("Có vẻ đối tượng chưa chơi lần nào trước đây vui lòng dùng `$start` để tạo tài khoản.")
+                return
 
-        if amount <= 0:
-            await ctx.reply(f"Số {coin} phải lớn hơn 0!")
-            return
+            if amount <= 0:
+                await ctx.reply(f"Số {coin} phải lớn hơn 0!")
+                return
+
+            if amount > giver_data.get('points', 0):
+                await ctx.reply(f"Bạn không đủ {coin} để tặng!")
+                return
 
-        if amount > giver_data.get('points', 0):
+        # Trừ điểm người gửi (có điều kiện đủ tiền), cộng điểm người nhận
+        if not await transfer_points(giver_id, receiver_id, amount, check_balance=not is_admin):
             await ctx.reply(f"Bạn không đủ {coin} để tặng!")
             return
 
-    # Trừ điểm người gửi, cộng điểm người nhận
-    giver_data['points'] -= amount
-    receiver_data['points'] += amount
-
-    # Lưu dữ liệu
-    update_user(giver_id, giver_data)
-    update_user(receiver_id, receiver_data)
-
-    await ctx.reply(f"Bạn đã tặng {format_currency(amount)} {coin} cho {member.mention}!")
+        await ctx.reply(f"Bạn đã tặng {format_currency(amount)} {coin} cho {member.mention}!")
 
 @bot.command(name="?", aliases=["help"], help="Hiển thị danh sách lệnh hoặc thông tin chi tiết về một lệnh.")
 async def help(ctx, command=None):
@@ -930,375 +975,364 @@ async def help(ctx, command=None):
 
 @bot.command(name="rob", help='`$rob <người chơi> [công cụ]`\n> trộm 50% điểm của người khác')
 async def rob(ctx, member: discord.Member, tool: str = None):
+    async with locked_ctx(ctx, ctx.author.id, member.id) as ctx:
+        robber_id = str(ctx.author.id)
+        victim_id = str(member.id)
+        status = member.status
 
-    robber_id = str(ctx.author.id)
-    victim_id = str(member.id)
-    status = member.status
-
-    robber_data = get_user(robber_id)
-    victim_data = get_user(victim_id)
-
-    if not robber_data:
-        await ctx.reply("Bạn chưa có tài khoản. Dùng `$start` để tạo.")
-        return
-    if not victim_data:
-        await ctx.reply("Nạn nhân chưa có tài khoản.")
-        return
-    if victim_id == '1243079760062709854':
-        await ctx.reply("Định làm gì với Admin Bot đấy?")
-        return
-    if status == discord.Status.online:
-        await ctx.reply("Nó đang online đấy, cẩn thận không nó đấm!")
-        return
-
-    now = datetime.now(timezone.utc)
-    last_rob = robber_data.get("last_rob")
+        robber_data = await get_user(robber_id)
+        victim_data = await get_user(victim_id)
 
-    if last_rob:
-        last_rob_dt = datetime.strptime(last_rob, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-        elapsed = (now - last_rob_dt).total_seconds()
+        if not robber_data:
+            await ctx.reply("Bạn chưa có tài khoản. Dùng `$start` để tạo.")
+            return
+        if not victim_data:
+            await ctx.reply("Nạn nhân chưa có tài khoản.")
+            return
+        if victim_id == '1243079760062709854':
+            await ctx.reply("Định làm gì với Admin Bot đấy?")
+            return
+        if status == discord.Status.online:
+            await ctx.reply("Nó đang online đấy, cẩn thận không nó đấm!")
+            return
 
-        if elapsed < 3600:
-            skip = robber_data.get("items", {}).get(":fast_forward: Skip", 0)
-            if skip > 0:
-                update_user(robber_id, {"$inc": {"items.:fast_forward: Skip": -1}})
+        left = remaining("rob", robber_id, robber_data)
+        if left:
+            if await consume_skip("rob", robber_id):
                 await ctx.reply("Bạn đã dùng :fast_forward: Skip để bỏ qua thời gian chờ!")
             else:
-                remaining = int(3600 - elapsed)
-                h, rem = divmod(remaining, 3600)
+                h, rem = divmod(int(left), 3600)
                 m, s = divmod(rem, 60)
                 await ctx.reply(f"Bạn phải chờ {h} giờ {m} phút {s} giây nữa.")
                 return
 
-    items_r = robber_data.get("items", {})
-    items_v = victim_data.get("items", {})
-    has_lock = items_v.get(":lock: Ổ khóa", 0) > 0
-    pet_guard = items_v.get(":dog: Pet bảo vệ", 0) > 0
-    pet_thief = items_r.get(":cat: Pet trộm", 0) > 0
-
-    if has_lock:
-        tools = {
-            "b": { "emoji": ":bomb: Bom", "chance": 0.75 },
-            "w": { "emoji": ":wrench: Kìm", "chance": 0.5 },
-            "c": { "emoji": "<:cleaner:1347560866291257385> máy hút bụi", "chance": 0.85 }
-        }
+        items_r = robber_data.get("items", {})
+        items_v = victim_data.get("items", {})
+        has_lock = items_v.get(":lock: Ổ khóa", 0) > 0
+        pet_guard = items_v.get(":dog: Pet bảo vệ", 0) > 0
+        pet_thief = items_r.get(":cat: Pet trộm", 0) > 0
+
+        if has_lock:
+            tools = {
+                "b": { "emoji": ":bomb: Bom", "chance": 0.75 },
+                "w": { "emoji": ":wrench: Kìm", "chance": 0.5 },
+                "c": { "emoji": "<:cleaner:1347560866291257385> máy hút bụi", "chance": 0.85 }
+            }
 
-        chosen_tool = tool.lower() if tool else None
-        if chosen_tool in tools:
-            tool_data = tools[chosen_tool]
-            emoji = tool_data["emoji"]
-            if items_r.get(emoji, 0) <= 0:
-                await ctx.reply("Bạn không có công cụ đó.")
-                return
-            chance = tool_data["chance"]
-            if pet_guard:
-                chance -= 0.1
-            if pet_thief:
-                chance += 0.1
-            success = random.random() < chance
-            if success:
-                update_user(victim_id, {"$inc": {f"items.:lock: Ổ khóa": -1}})
-                update_user(robber_id, {"$inc": {f"items.{emoji}": -1}})
-                if chosen_tool == "c":
-                    if items_v:
-                        random_item = random.choice(list(items_v.keys()))
-                        update_user(victim_id, {"$inc": {f"items.{random_item}": -2000}})
-                        await ctx.reply(f"Dùng {emoji} phá khóa và hút 2000 {random_item} của {member.mention}!")
+            chosen_tool = tool.lower() if tool else None
+            if chosen_tool in tools:
+                tool_data = tools[chosen_tool]
+                emoji = tool_data["emoji"]
+                if items_r.get(emoji, 0) <= 0:
+                    await ctx.reply("Bạn không có công cụ đó.")
+                    return
+                chance = tool_data["chance"]
+                if pet_guard:
+                    chance -= 0.1
+                if pet_thief:
+                    chance += 0.1
+                success = random.random() < chance
+                if success:
+                    await update_user(victim_id, {"$inc": {f"items.:lock: Ổ khóa": -1}})
+                    await update_user(robber_id, {"$inc": {f"items.{emoji}": -1}})
+                    if chosen_tool == "c":
+                        if items_v:
+                            random_item = random.choice(list(items_v.keys()))
+                            await update_user(victim_id, {"$inc": {f"items.{random_item}": -2000}})
+                            await ctx.reply(f"Dùng {emoji} phá khóa và hút 2000 {random_item} của {member.mention}!")
+                        else:
+                            await ctx.reply("Dùng máy hút bụi phá khoá, nhưng họ không có gì để hút.")
                     else:
-                        await ctx.reply("Dùng máy hút bụi phá khoá, nhưng họ không có gì để hút.")
+                        await ctx.reply(f"Bạn đã dùng {emoji} và phá vỡ Ổ khóa của {member.mention}!")
                 else:
-                    await ctx.reply(f"Bạn đã dùng {emoji} và phá vỡ Ổ khóa của {member.mention}!")
+                    await ctx.reply("Phá khoá thất bại!")
+                    return
             else:
-                await ctx.reply("Phá khoá thất bại!")
+                await ctx.reply("Chọn `b`, `w`, hoặc `c` làm công cụ.")
                 return
-        else:
-            await ctx.reply("Chọn `b`, `w`, hoặc `c` làm công cụ.")
-            return
 
-    victim_points = victim_data.get("points", 0)
-    if victim_points <= 0:
-        await ctx.reply(f"{member.name} không có {coin} để cướp.")
-        return
+        victim_points = victim_data.get("points", 0)
+        if victim_points <= 0:
+            await ctx.reply(f"{member.name} không có {coin} để cướp.")
+            return
 
-    stolen = round(victim_points * 0.5)
-    update_user(victim_id, {"$inc": {"points": -stolen}})
-    update_user(robber_id, {
-        "$inc": {"points": stolen},
-        "$set": {"last_rob": now.strftime("%Y-%m-%d %H:%M:%S")}
-    })
-    await ctx.reply(f"Bạn đã cướp {format_currency(stolen)} {coin} từ {member.name}!")
+        stolen = round(victim_points * 0.5)
+        await update_user(victim_id, {"$inc": {"points": -stolen}})
+        await update_user(robber_id, {
+            "$inc": {"points": stolen},
+            "$set": mark_used("rob", robber_id)
+        })
+        await ctx.reply(f"Bạn đã cướp {format_currency(stolen)} {coin} từ {member.name}!")
 
 @bot.command(name="hunt", help='`$hunt <weapon>`\n> đi săn kiếm tiền')
 async def hunt(ctx, weapon: str):
+    async with locked_ctx(ctx, ctx.author.id) as ctx:
+        user_id = str(ctx.author.id)
+        left = cached_remaining("hunt", user_id)
+        if left:
+            m, s = divmod(int(left), 60)
+            await ctx.reply(f"Chờ {m} phút {s} giây trước khi săn tiếp!")
+            return
 
-    user_id = str(ctx.author.id)
-    data = get_user(user_id)
-
-    if not await check_permission(ctx, user_id):
-        return
-
-    weapons = {
-        "g": { "emoji": ":gun: Súng săn", "ammo": 1, "range": (0, 50000) },
-        "r": { "emoji": "<:RPG:1413753013473906748> RPG", "ammo": 10, "range": (-2000000, 5000000) },
-        "a": { "emoji": "<:AWM:1413753446846431282> Awm", "ammo": 1, "range": (5000, 1000000) }
-    }
+        data = await get_user(user_id)
 
-    if weapon not in weapons:
-        await ctx.reply("Vũ khí không hợp lệ!")
-        return
+        if not await check_permission(ctx, user_id):
+            return
 
-    now = datetime.now(timezone.utc)
-    last_hunt = data.get("last_hunt")
+        weapons = {
+            "g": { "emoji": ":gun: Súng săn", "ammo": 1, "range": (0, 50000) },
+            "r": { "emoji": "<:RPG:1413753013473906748> RPG", "ammo": 10, "range": (-2000000, 5000000) },
+            "a": { "emoji": "<:AWM:1413753446846431282> Awm", "ammo": 1, "range": (5000, 1000000) }
+        }
 
-    if last_hunt:
-        last_hunt_dt = datetime.strptime(last_hunt, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-        elapsed = (now - last_hunt_dt).total_seconds()
+        if weapon not in weapons:
+            await ctx.reply("Vũ khí không hợp lệ!")
+            return
 
-        if elapsed < 300:
-            remaining = int(300 - elapsed)
-            m, s = divmod(remaining, 60)
+        left = remaining("hunt", user_id, data)
+        if left:
+            m, s = divmod(int(left), 60)
             await ctx.reply(f"Chờ {m} phút {s} giây trước khi săn tiếp!")
             return
 
-    weapon_info = weapons[weapon]
-    items = data.get("items", {})
-    weapon_count = items.get(weapon_info["emoji"], 0)
-    bullet_count = items.get(":bullettrain_side: Viên đạn", 0)
+        weapon_info = weapons[weapon]
+        items = data.get("items", {})
+        weapon_count = items.get(weapon_info["emoji"], 0)
+        bullet_count = items.get(":bullettrain_side: Viên đạn", 0)
 
-    if weapon_count < 1:
-        await ctx.reply(f"Bạn cần {weapon_info['emoji']} để đi săn!")
-        return
-    if bullet_count < weapon_info["ammo"]:
-        await ctx.reply(f"Bạn cần {weapon_info['ammo']} viên đạn để đi săn!")
-        return
+        if weapon_count < 1:
+            await ctx.reply(f"Bạn cần {weapon_info['emoji']} để đi săn!")
+            return
+        if bullet_count < weapon_info["ammo"]:
+            await ctx.reply(f"Bạn cần {weapon_info['ammo']} viên đạn để đi săn!")
+            return
 
-    update = {
-        "$inc": {
-            "points": random.randint(*weapon_info["range"]),
-            "items.:bullettrain_side: Viên đạn": -weapon_info["ammo"]
-        },
-        "$set": { "last_hunt": now.strftime("%Y-%m-%d %H:%M:%S") }
-    }
+        update = {
+            "$inc": {
+                "points": random.randint(*weapon_info["range"]),
+                "items.:bullettrain_side: Viên đạn": -weapon_info["ammo"]
+            },
+            "$set": mark_used("hunt", user_id)
+        }
 
-    if weapon == "c":
-        update["$inc"].pop("items.:bullettrain_side: Viên đạn", None)
-        update["$unset"] = {f"items.{weapon_info['emoji']}": ""}
+        if weapon == "c":
+            update["$inc"].pop("items.:bullettrain_side: Viên đạn", None)
+            update["$unset"] = {f"items.{weapon_info['emoji']}": ""}
 
-    update_user(user_id, update)
-    reward = update["$inc"].get("points", 0)
-    await ctx.reply(f"Bạn đã săn được {format_currency(reward)} {coin}!")
+        await update_user(user_id, update)
+        reward = update["$inc"].get("points", 0)
+        await ctx.reply(f"Bạn đã săn được {format_currency(reward)} {coin}!")
 
 @bot.command(name="in", help='`$in <số điểm>`\n> bơm tiền vào công ty')
 async def invest(ctx, amount: int):
+    async with locked_ctx(ctx, ctx.author.id) as ctx:
+        user_id = str(ctx.author.id)
+        user = await get_user(user_id)
 
-    user_id = str(ctx.author.id)
-    user = get_user(user_id)
-
-    if not await check_permission(ctx, user_id):
-        return
+        if not await check_permission(ctx, user_id):
+            return
 
-    if ':office: Công ty' not in user.get('items', {}):
-        await ctx.reply(f"{ctx.author.mention} Bạn làm đéo gì có :office: Công ty mà đầu tư :rofl:")
-        return
+        if ':office: Công ty' not in user.get('items', {}):
+            await ctx.reply(f"{ctx.author.mention} Bạn làm đéo gì có :office: Công ty mà đầu tư :rofl:")
+            return
 
-    if amount <= 0:
-        await ctx.reply("Số điểm phải lớn hơn 0.")
-        return
+        if amount <= 0:
+            await ctx.reply("Số điểm phải lớn hơn 0.")
+            return
 
-    if user['points'] < amount:
-        await ctx.reply(f"Bạn không có đủ {coin} để đầu tư.")
-        return
+        if user['points'] < amount:
+            await ctx.reply(f"Bạn không có đủ {coin} để đầu tư.")
+            return
 
-    # Cập nhật
-    user['points'] -= amount
-    user['company_balance'] = user.get('company_balance', 0) + amount
-    update_user(user_id, user)
+        # Chuyển tiền vào công ty trong 1 thao tác có điều kiện
+        if await invest_company(user_id, amount, ':office: Công ty') is None:
+            await ctx.reply(f"Bạn không có đủ {coin} để đầu tư.")
+            return
 
-    await ctx.reply(f"Bạn đã đầu tư {format_currency(amount)} {coin} vào công ty.")
+        await ctx.reply(f"Bạn đã đầu tư {format_currency(amount)} {coin} vào công ty.")
 
 @bot.command(name="wi", help='`$wi <số điểm>`\n> rút tiền ra')
 async def withdraw(ctx, amount: int):
+    async with locked_ctx(ctx, ctx.author.id) as ctx:
+        user_id = str(ctx.author.id)
+        user = await get_user(user_id)
 
-    user_id = str(ctx.author.id)
-    user = get_user(user_id)
-
-    if not await check_permission(ctx, user_id):
-        return
+        if not await check_permission(ctx, user_id):
+            return
 
-    if amount <= 0:
-        await ctx.reply("Số điểm phải lớn hơn 0.")
-        return
+        if amount <= 0:
+            await ctx.reply("Số điểm phải lớn hơn 0.")
+            return
 
-    if user.get('company_balance', 0) < amount:
-        await ctx.reply(f"Công ty của bạn không có đủ {coin} để rút.")
-        return
+        if (company_balance_now(user) or 0) < amount:
+            await ctx.reply(f"Công ty của bạn không có đủ {coin} để rút.")
+            return
 
-    # Cập nhật
-    user['company_balance'] -= amount
-    user['points'] += amount
-    update_user(user_id, user)
+        # Rút tiền từ công ty trong 1 thao tác có điều kiện
+        if await withdraw_company(user_id, amount) is None:
+            await ctx.reply(f"Công ty của bạn không có đủ {coin} để rút.")
+            return
 
-    await ctx.reply(f"Bạn đã rút {format_currency(amount)} {coin} từ công ty.")
+        await ctx.reply(f"Bạn đã rút {format_currency(amount)} {coin} từ công ty.")
 
 @bot.command(name="orob", help='`$orob <người chơi>`\n> rút tiền từ công ty thằng bạn')
 async def orob(ctx, member: discord.Member):
+    async with locked_ctx(ctx, ctx.author.id, member.id) as ctx:
+        orobber_id = str(ctx.author.id)
+        victim_id = str(member.id)
+        status = member.status
+
+        left = cached_remaining("orob", orobber_id)
+        if left:
+            hours, rem = divmod(int(left), 3600)
+            minutes, seconds = divmod(rem, 60)
+            await ctx.reply(f"Bạn phải chờ {hours} giờ {minutes} phút {seconds} giây trước khi cướp lại.")
+            return
 
-    orobber_id = str(ctx.author.id)
-    victim_id = str(member.id)
-    status = member.status
-
-    orobber = get_user(orobber_id)
-    victim = get_user(victim_id)
-
-    if orobber is None:
-        await ctx.reply("Có vẻ bạn chưa chơi lần nào trước đây vui lòng dùng `$start` để tạo tài khoản.")
-        return
-
-    if victim is None:
-        await ctx.reply("Nạn nhân ko có trong dữ liệu của trò chơi.")
-        return
+        orobber = await get_user(orobber_id)
+        victim = await get_user(victim_id)
+        orobber_original = copy.deepcopy(orobber)
 
-    now = datetime.now(timezone.utc)
-    last_rob = robber_data.get("last_rob")
-    cooldown_time = 3600  # 1 giờ
+        if orobber is None:
+            await ctx.reply("Có vẻ bạn chưa chơi lần nào trước đây vui lòng dùng `$start` để tạo tài khoản.")
+            return
 
-    if last_rob:
-        last_rob_dt = datetime.strptime(last_rob, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-        elapsed = (now - last_rob_dt).total_seconds()
+        if victim is None:
+            await ctx.reply("Nạn nhân ko có trong dữ liệu của trò chơi.")
+            return
 
-        if elapsed < cooldown_time:
-            remaining = cooldown_time - int(elapsed)
-            hours, rem = divmod(remaining, 3600)
+        left = remaining("orob", orobber_id, orobber)
+        if left:
+            hours, rem = divmod(int(left), 3600)
             minutes, seconds = divmod(rem, 60)
             await ctx.reply(f"Bạn phải chờ {hours} giờ {minutes} phút {seconds} giây trước khi cướp lại.")
             return
 
-    if status == discord.Status.online:
-        await ctx.reply('Nó đang on đếy, cẩn thận ko nó đấm')
-        return
-        
-    if victim_id == "1243079760062709854":
-        await ctx.reply('Định làm gì với công ty của Admin Bot đếy, mày cẩn thận')
-        return
+        if status == discord.Status.online:
+            await ctx.reply('Nó đang on đếy, cẩn thận ko nó đấm')
+            return
 
-    if victim_id == "1361702060071850024":
-        await ctx.reply(f"Bạn đã sử dụng Thẻ giả để rút {coin} của {member.name} nhưng không thành công.")
-        return
+        if victim_id == "1243079760062709854":
+            await ctx.reply('Định làm gì với công ty của Admin Bot đếy, mày cẩn thận')
+            return
 
-    if orobber['items'].get(':credit_card: thẻ công ty giả', 0) > 0:
-        orobber['items'][':credit_card: thẻ công ty giả'] -= 1
-        if random.random() < 0.25:
-            await ctx.reply(f"Bạn đã sử dụng Thẻ giả để rút {coin} của {member.name} và đã thành công!")
+        if victim_id == "1361702060071850024":
+            await ctx.reply(f"Bạn đã sử dụng Thẻ giả để rút {coin} của {member.name} nhưng không thành công.")
+            return
 
-            victim_balance = victim.get('company_balance', 0)
-            if victim_balance <= 0:
-                await ctx.reply(f"{member.name} không có {coin} để cướp!")
-                return
+        if orobber['items'].get(':credit_card: thẻ công ty giả', 0) > 0:
+            orobber['items'][':credit_card: thẻ công ty giả'] -= 1
+            if random.random() < 0.25:
+                await ctx.reply(f"Bạn đã sử dụng Thẻ giả để rút {coin} của {member.name} và đã thành công!")
 
-            stolen_points = round(victim_balance * 0.5)
+                # Rút 50% giá trị công ty hiện tại của nạn nhân (tính lười + ghi lại trong 1 thao tác)
+                victim_doc, victim_balance = await rebase_company(
+                    victim_id, lambda current: current - round(current * 0.5) if current > 0 else None
+                )
+                if victim_doc is None:
+                    await ctx.reply(f"{member.name} không có {coin} để cướp!")
+                    return
 
-            victim['company_balance'] -= stolen_points
-            orobber['points'] += stolen_points
-            orobber['last_rob'] = now.strftime("%Y-%m-%d %H:%M:%S")
+                stolen_points = victim_balance - victim_doc["company_balance"]
+                orobber['points'] += stolen_points
+                orobber.update(mark_used("orob", orobber_id))
 
-            update_user(orobber_id, orobber)
-            update_user(victim_id, victim)
+                await update_user(orobber_id, orobber, orobber_original)
 
-            await ctx.reply(f"Bạn đã rút được {format_currency(stolen_points)} {coin} từ {member.name}!")
+                await ctx.reply(f"Bạn đã rút được {format_currency(stolen_points)} {coin} từ {member.name}!")
+            else:
+                await update_user(orobber_id, orobber, orobber_original)
+                await ctx.reply(f"Bạn đã sử dụng Thẻ giả để rút {coin} của {member.name} nhưng không thành công.")
+                return
         else:
-            update_user(orobber_id, orobber)
-            await ctx.reply(f"Bạn đã sử dụng Thẻ giả để rút {coin} của {member.name} nhưng không thành công.")
-            return
-    else:
-        await ctx.reply("Bạn làm đéo gì có thẻ mà rút")
+            await ctx.reply("Bạn làm đéo gì có thẻ mà rút")
 
 @bot.command(name="op", help='`$op <người chơi> [st<số>]`\n> săn smart, có thể dùng sáng tạo để tăng tỉ lệ')
 async def op(ctx, member: discord.Member, creativity: str = None):
+    async with locked_ctx(ctx, ctx.author.id, member.id) as ctx:
+        oper_id = str(ctx.author.id)
+        victim_id = str(member.id)
 
-    oper_id = str(ctx.author.id)
-    victim_id = str(member.id)
-
-    oper = get_user(oper_id)
-    victim = get_user(victim_id)
-
-    if oper is None:
-        return await ctx.reply("Bạn chưa có tài khoản, vui lòng dùng $start trước.")
-    if victim is None:
-        return await ctx.reply("Nạn nhân không có trong dữ liệu.")
-    if oper_id == victim_id:
-        return await ctx.reply("Bạn không thể tự OP chính mình 🤣")
-
-    # Cooldown 5 phút
-    now = datetime.now(timezone.utc)
-    last_op = oper.get("last_op")
-    cooldown_time = 300  # 5 phút
-
-    if last_op:
-        last_op_dt = datetime.strptime(last_op, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-        elapsed = (now - last_op_dt).total_seconds()
+        left = cached_remaining("op", oper_id)
+        if left:
+            m, s = divmod(int(left), 60)
+            return await ctx.reply(f"⏳ Đang bổ sung kiến thức trong {m} phút {s} giây")
 
-        if elapsed < cooldown_time:
-            remain = int(cooldown_time - elapsed)
-            m, s = divmod(remain, 60)
+        oper = await get_user(oper_id)
+        victim = await get_user(victim_id)
+        oper_original = copy.deepcopy(oper)
+        victim_original = copy.deepcopy(victim)
+
+        if oper is None:
+            return await ctx.reply("Bạn chưa có tài khoản, vui lòng dùng $start trước.")
+        if victim is None:
+            return await ctx.reply("Nạn nhân không có trong dữ liệu.")
+        if oper_id == victim_id:
+            return await ctx.reply("Bạn không thể tự OP chính mình 🤣")
+
+        # Cooldown 5 phút
+        left = remaining("op", oper_id, oper)
+        if left:
+            m, s = divmod(int(left), 60)
             return await ctx.reply(f"⏳ Đang bổ sung kiến thức trong {m} phút {s} giây")
 
-    # --- Tính tỉ lệ thành công ---
-    oper_smart = oper.get("smart", 0)
-    victim_smart = victim.get("smart", 0)
+        # --- Tính tỉ lệ thành công ---
+        oper_smart = oper.get("smart", 0)
+        victim_smart = victim.get("smart", 0)
 
-    base_success = 0.5  # mặc định 50%
-    stolen_ratio = 0.1  # mặc định ăn 10%
+        base_success = 0.5  # mặc định 50%
+        stolen_ratio = 0.1  # mặc định ăn 10%
 
-    if oper_smart >= victim_smart:
-        success_rate = 0.7  # dễ thành công hơn (70%)
-    else:
-        success_rate = 0.3  # khó hơn (30%)
-        stolen_ratio = 0.2  # ăn nhiều hơn
+        if oper_smart >= victim_smart:
+            success_rate = 0.7  # dễ thành công hơn (70%)
+        else:
+            success_rate = 0.3  # khó hơn (30%)
+            stolen_ratio = 0.2  # ăn nhiều hơn
 
-    # --- Nếu có dùng sáng tạo ---
-    creativity_used = 0
-    if creativity and creativity.startswith("st"):
-        try:
-            creativity_used = int(creativity[2:]) if len(creativity) > 2 else 1
-        except ValueError:
-            creativity_used = 1
-
-        available = oper["items"].get(":bulb: sự sáng tạo", 0)
-        if available < creativity_used:
-            return await ctx.reply(f"Bạn không đủ sự sáng tạo (còn {available}).")
-
-        # Trừ sáng tạo
-        oper["items"][":bulb: sự sáng tạo"] -= creativity_used
-        success_rate += 0.1 * creativity_used
-        success_rate = min(success_rate, 0.95)  # cap 95%
-
-    # --- Thử vận may ---
-    if random.random() < success_rate:
-        if victim_smart <= 0:
-            msg = f"{member.name} không có học vấn để húp."
+        # --- Nếu có dùng sáng tạo ---
+        creativity_used = 0
+        if creativity and creativity.startswith("st"):
+            try:
+                creativity_used = int(creativity[2:]) if len(creativity) > 2 else 1
+            except ValueError:
+                creativity_used = 1
+
+            available = oper["items"].get(":bulb: sự sáng tạo", 0)
+            if available < creativity_used:
+                return await ctx.reply(f"Bạn không đủ sự sáng tạo (còn {available}).")
+
+            # Trừ sáng tạo
+            oper["items"][":bulb: sự sáng tạo"] -= creativity_used
+            success_rate += 0.1 * creativity_used
+            success_rate = min(success_rate, 0.95)  # cap 95%
+
+        # --- Thử vận may ---
+        if random.random() < success_rate:
+            if victim_smart <= 0:
+                msg = f"{member.name} không có học vấn để húp."
+            else:
+                stolen = round(victim_smart * stolen_ratio)
+                victim["smart"] -= round(stolen * 0.5)
+                oper["smart"] += stolen
+                oper["points"] += stolen
+                msg = (
+                    f"🎯 Thành công! Bạn đã húp {format_currency(stolen)} {coin} "
+                    f"và học vấn từ {member.name}! "
+                    f"{'(Dùng ' + str(creativity_used) + ' sáng tạo)' if creativity_used else ''}"
+                )
         else:
-            stolen = round(victim_smart * stolen_ratio)
-            victim["smart"] -= round(stolen * 0.5)
-            oper["smart"] += stolen
-            oper["points"] += stolen
             msg = (
-                f"🎯 Thành công! Bạn đã húp {format_currency(stolen)} {coin} "
-                f"và học vấn từ {member.name}! "
-                f"{'(Dùng ' + str(creativity_used) + ' sáng tạo)' if creativity_used else ''}"
+                f"💨 Bạn đã cố ao trình {member.name} nhưng thất bại. "
+                f"{'(Dù đã dùng ' + str(creativity_used) + ' sáng tạo)' if creativity_used else ''}"
             )
-    else:
-        msg = (
-            f"💨 Bạn đã cố ao trình {member.name} nhưng thất bại. "
-            f"{'(Dù đã dùng ' + str(creativity_used) + ' sáng tạo)' if creativity_used else ''}"
-        )
 
-    # Lưu cooldown
-    oper["last_op"] = now.strftime("%Y-%m-%d %H:%M:%S")
+        # Lưu cooldown
+        oper.update(mark_used("op", oper_id))
 
-    update_user(oper_id, oper)
-    update_user(victim_id, victim)
+        await update_user(oper_id, oper, oper_original)
+        await update_user(victim_id, victim, victim_original)
 
-    await ctx.reply(msg)
+        await ctx.reply(msg)
 
 @bot.command(name="lb", help='`$lb`\n> xem bảng xếp hạng')
 async def lb(ctx, kind: str = "a"):
@@ -1319,16 +1353,9 @@ async def lb(ctx, kind: str = "a"):
         )
         return
 
-    top_users = users_col.find().sort(field, -1).limit(10)
+    # Đọc từ bảng giữ sẵn trong RAM (leaderboard.py), tên đã được lưu kèm
     leaderboard = ""
-    for idx, user in enumerate(top_users, start=1):
-        try:
-            member = await bot.fetch_user(int(user['_id']))
-            name = member.name
-        except:
-            name = f"Người chơi {user['_id']}"
-
-        score = user.get(field, 0)
+    for idx, (_, name, score) in enumerate(await get_leaderboard(field, bot, guild=ctx.guild), start=1):
         leaderboard += f"**{idx}.** {name}: `{format_currency(score)}`\n"
 
     embed = discord.Embed(
@@ -1340,121 +1367,113 @@ async def lb(ctx, kind: str = "a"):
 
 @bot.command(name='gacha', help='`$gacha`\n> gacha ra những thứ hay ho')
 async def gacha(ctx):
+    async with locked_ctx(ctx, ctx.author.id) as ctx:
+        user_id = str(ctx.author.id)
+        user_roles = [role.name for role in ctx.author.roles]
+        left = cached_remaining("gacha", user_id)
+        if left:
+            minutes, seconds = divmod(int(left), 60)
+            await ctx.reply(f"Bạn phải chờ {minutes} phút {seconds} giây trước khi quay gacha lại.")
+            return
 
-    user_id = str(ctx.author.id)
-    user_roles = [role.name for role in ctx.author.roles]
-    user = users_col.find_one({"_id": user_id})
+        user = await get_user(user_id)
 
-    if not user:
-        await ctx.reply("Bạn chưa có tài khoản. Dùng `$start` để bắt đầu.")
-        return
+        if not user:
+            await ctx.reply("Bạn chưa có tài khoản. Dùng `$start` để bắt đầu.")
+            return
 
-    # Kiểm tra cooldown
-    now = datetime.now(timezone.utc)
-    last_gacha = user.get('last_gacha')
-    if last_gacha:
-        time_elapsed = (now - datetime.datetime.strptime(last_gacha, "%Y-%m-%d %H:%M:%S")).total_seconds()
-        if time_elapsed < 3600:
-            minutes, seconds = divmod(int(3600 - time_elapsed), 60)
+        # Kiểm tra cooldown
+        left = remaining("gacha", user_id, user)
+        if left:
+            minutes, seconds = divmod(int(left), 60)
             await ctx.reply(f"Bạn phải chờ {minutes} phút {seconds} giây trước khi quay gacha lại.")
             return
 
-    if "Trung học Phổ thông" in user_roles:
-        if user.get('points', 0) < 10_000_000_000:
-            await ctx.reply(f'Bạn không đủ {coin} để gacha!')
-            return
+        if "Trung học Phổ thông" in user_roles:
+            if user.get('points', 0) < 10_000_000_000:
+                await ctx.reply(f'Bạn không đủ {coin} để gacha!')
+                return
 
-        # Trừ tiền và thông minh
-        users_col.update_one(
-            {"_id": user_id},
-            {
-                "$inc": {
-                    "points": -10_000_000_000,
-                    "smart": -1_000_000
-                },
-                "$set": {
-                    "last_gacha": now.strftime("%Y-%m-%d %H:%M:%S")
+            # Trừ tiền và thông minh
+            await update_user(
+                user_id,
+                {
+                    "$inc": {
+                        "points": -10_000_000_000,
+                        "smart": -1_000_000
+                    },
+                    "$set": mark_used("gacha", user_id)
                 }
-            }
-        )
+            )
 
-        result = roll_gacha_from_pool()
-        item_name = result.get("name", "Không rõ")
-        rarity = result.get("rarity", "không xác định")
+            result = roll_gacha_from_pool()
+            item_name = result.get("name", "Không rõ")
+            rarity = result.get("rarity", "không xác định")
 
-        # Cập nhật vật phẩm
-        users_col.update_one(
-            {"_id": user_id},
-            {"$inc": {f"items.{item_name}": 1}}
-        )
+            # Cập nhật vật phẩm
+            await update_user(user_id, {"$inc": {f"items.{item_name}": 1}})
 
-        rarity_colors = {
-            "tốt": discord.Color.green(),
-            "hiếm": discord.Color.blue(),
-            "sử thi": discord.Color.purple(),
-            "huyền thoại": discord.Color.orange()
-        }
+            rarity_colors = {
+                "tốt": discord.Color.green(),
+                "hiếm": discord.Color.blue(),
+                "sử thi": discord.Color.purple(),
+                "huyền thoại": discord.Color.orange()
+            }
 
-        embed = discord.Embed(
-            title="🎲 Gacha Roll 🎲",
-            description=f"Bạn đã quay được: **{item_name}**\n🔹 Độ hiếm: `{rarity.upper()}`",
-            color=rarity_colors.get(rarity, discord.Color.gold())
-        )
-        await ctx.reply(embed=embed)
+            embed = discord.Embed(
+                title="🎲 Gacha Roll 🎲",
+                description=f"Bạn đã quay được: **{item_name}**\n🔹 Độ hiếm: `{rarity.upper()}`",
+                color=rarity_colors.get(rarity, discord.Color.gold())
+            )
+            await ctx.reply(embed=embed)
 
 @bot.command(name='study', help='`$study`\n> Học tăng trình độ')
 async def study(ctx):
-    
-    user_id = str(ctx.author.id)
-    data = get_user(user_id)
-
-    if not data:
-        await ctx.reply("Bạn chưa có tài khoản, dùng `$start` để bắt đầu.")
-        return
+    async with locked_ctx(ctx, ctx.author.id) as ctx:
+        user_id = str(ctx.author.id)
+        left = cached_remaining("study", user_id)
+        if left:
+            m, s = divmod(int(left), 60)
+            await ctx.reply(f"⏳ Thời gian nghỉ giải lao còn **{m} phút {s} giây**")
+            return
 
-    # Check sách vở
-    books = data.get("items", {}).get(":books: Sách vở", 0)
-    if books <= 0:
-        await ctx.send("📚 Bạn cần có ít nhất 1 quyển **sách vở** để học!")
-        return
+        data = await get_user(user_id)
 
-    # Cooldown 5 phút
-    cooldown_time = 300  # 5 phút
-    now = datetime.now(timezone.utc)
+        if not data:
+            await ctx.reply("Bạn chưa có tài khoản, dùng `$start` để bắt đầu.")
+            return
+        original = copy.deepcopy(data)
 
-    last_study_str = data.get("last_study")
+        # Check sách vở
+        books = data.get("items", {}).get(":books: Sách vở", 0)
+        if books <= 0:
+            await ctx.send("📚 Bạn cần có ít nhất 1 quyển **sách vở** để học!")
+            return
 
-    if last_study_str:
-        try:
-            # Parse và ép thành UTC datetime có timezone
-            last_study = datetime.strptime(last_study_str, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-            elapsed = (now - last_study).total_seconds()
-
-            if elapsed < cooldown_time:
-                remain = cooldown_time - elapsed
-                m, s = divmod(int(remain), 60)
-                await ctx.reply(f"⏳ Thời gian nghỉ giải lao còn **{m} phút {s} giây**")
-                return
-        except:
-            pass  # Nếu parse lỗi → coi như chưa học lần nào
+        # Cooldown 5 phút (chuỗi thời gian lỗi => coi như chưa học lần nào)
+        left = remaining("study", user_id, data)
+        if left:
+            m, s = divmod(int(left), 60)
+            await ctx.reply(f"⏳ Thời gian nghỉ giải lao còn **{m} phút {s} giây**")
+            return
 
-    # Lưu lại thời gian học
-    data["last_study"] = now.strftime("%Y-%m-%d %H:%M:%S")
+        # Lưu lại thời gian học
+        data.update(mark_used("study", user_id))
 
-    # Tăng học vấn
-    gain = 10 * books
-    data["smart"] = data.get("smart", 0) + gain
+        # Tăng học vấn
+        gain = 10 * books
+        data["smart"] = data.get("smart", 0) + gain
 
-    # 10% cơ hội nhận "sự sáng tạo"
-    bonus_msg = ""
-    if random.random() < 0.1:
-        creativity = data["items"].get(":bulb: sự sáng tạo", 0)
-        data["items"][":bulb: sự sáng tạo"] = creativity + 1
-        bonus_msg = "✨ Bạn đã nảy ra **một ý tưởng sáng tạo**!"
+        # 10% cơ hội nhận "sự sáng tạo"
+        bonus_msg = ""
+        if random.random() < 0.1:
+            creativity = data["items"].get(":bulb: sự sáng tạo", 0)
+            data["items"][":bulb: sự sáng tạo"] = creativity + 1
+            bonus_msg = "✨ Bạn đã nảy ra **một ý tưởng sáng tạo**!"
 
-    update_user(user_id, data)
+        await update_user(user_id, data, original)
 
-    await ctx.send(f"📖 Bạn học hành chăm chỉ và nhận được **+{gain} học vấn**! {bonus_msg}")
+        await ctx.send(f"📖 Bạn học hành chăm chỉ và nhận được **+{gain} học vấn**! {bonus_msg}")
 
 # === Text fight ===
 @bot.command(name="stats", help="Hiển thị chỉ số chiến đấu của bạn hoặc người khác.")
@@ -1464,7 +1483,7 @@ async def stats(ctx, member: discord.Member = None):
     user_id = str(member.id)
 
     # --- Lấy dữ liệu từ MongoDB ---
-    tf = get_full_stats(user_id)
+    tf = await get_full_stats(user_id)
 
     # --- Lấy chỉ số cơ bản ---
     hp = f"{int(tf.get('hp', 0))}/{int(tf.get('max_hp', 0))}"
@@ -1528,72 +1547,74 @@ async def stats(ctx, member: discord.Member = None):
 @bot.command(name="attack", help="Tấn công người chơi khác (Text Fight).")
 async def attack(ctx, target: discord.Member):
     """Thực hiện một đòn đánh thường giữa hai người chơi."""
-    attacker = ctx.author
-    if target.id == attacker.id:
-        await ctx.send("❌ Bạn không thể tự tấn công chính mình!")
-        return
+    async with locked_ctx(ctx, ctx.author.id, target.id) as ctx:
+        attacker = ctx.author
+        if target.id == attacker.id:
+            await ctx.send("❌ Bạn không thể tự tấn công chính mình!")
+            return
 
-    attacker_id = str(attacker.id)
-    target_id = str(target.id)
+        attacker_id = str(attacker.id)
+        target_id = str(target.id)
 
-    # --- Lấy dữ liệu người chơi ---
-    try:
-        attacker_data = get_full_stats(attacker_id)
-        target_data = get_full_stats(target_id)
-    except Exception as e:
-        await ctx.send(f"❌ Không thể lấy dữ liệu người chơi: {e}")
-        return
+        # --- Lấy dữ liệu người chơi ---
+        try:
+            stats = await get_full_stats_many([attacker_id, target_id])
+            attacker_data, target_data = stats[attacker_id], stats[target_id]
+        except Exception as e:
+            await ctx.send(f"❌ Không thể lấy dữ liệu người chơi: {e}")
+            return
 
-    # --- Lấy các chỉ số cần thiết ---
-    basic_damage = attacker_data.get("basic_damage", 0)
-    attack_speed = attacker_data.get("attack_speed", 1)
-    crit_rate = attacker_data.get("crit_rate", 0)
-    crit_damage = attacker_data.get("crit_damage", 2)
-    lifesteal = attacker_data.get("lifesteal", 0)
-
-    armor = target_data.get("armor", 0)
-    resistance = target_data.get("resistance", 0)
-
-    attacker_hp = attacker_data.get("hp", 0)
-    attacker_max_hp = attacker_data.get("max_hp", 0)
-    target_hp = target_data.get("hp", 0)
-    target_max_hp = target_data.get("max_hp", 0)
-
-    # --- Tính sát thương ---
-    damage = basic_damage * attack_speed
-    is_crit = False
-    if random.random() < crit_rate:
-        damage *= crit_damage
-        is_crit = True
-
-    # --- Giảm sát thương bởi giáp (armor) ---
-    damage *= (100 / (100 + armor))
-    damage = round(damage)
-
-    # --- Áp dụng sát thương ---
-    new_target_hp = max(target_hp - damage, 0)
-
-    # --- Hút máu (lifesteal) ---
-    heal = round(damage * lifesteal)
-    new_attacker_hp = min(attacker_hp + heal, attacker_max_hp)
-
-    # --- Cập nhật MongoDB ---
-    update_user_stats(attacker_id, {"hp": new_attacker_hp})
-    update_user_stats(target_id, {"hp": new_target_hp})
-
-    # --- Tạo tin nhắn kết quả ---
-    msg = (
-        f"⚔️ **{attacker.display_name}** tấn công **{target.display_name}**!\n"
-        f"🗡️ Gây **{damage}** sát thương"
-    )
-    if is_crit:
-        msg += " 💥 (Chí mạng!)"
+        # --- Lấy các chỉ số cần thiết ---
+        basic_damage = attacker_data.get("basic_damage", 0)
+        attack_speed = attacker_data.get("attack_speed", 1)
+        crit_rate = attacker_data.get("crit_rate", 0)
+        crit_damage = attacker_data.get("crit_damage", 2)
+        lifesteal = attacker_data.get("lifesteal", 0)
+
+        armor = target_data.get("armor", 0)
+        resistance = target_data.get("resistance", 0)
+
+        attacker_max_hp = attacker_data.get("max_hp", 0)
+        target_hp = target_data.get("hp", 0)
+        target_max_hp = target_data.get("max_hp", 0)
+
+        # --- Tính sát thương ---
+        damage = basic_damage * attack_speed
+        is_crit = False
+        if random.random() < crit_rate:
+            damage *= crit_damage
+            is_crit = True
+
+        # --- Giảm sát thương bởi giáp (armor) ---
+        damage *= (100 / (100 + armor))
+        damage = round(damage)
+
+        # --- Hút máu (lifesteal) ---
+        heal = round(damage * lifesteal)
+
+        # --- Cập nhật MongoDB: trừ/cộng HP ngay trên server, 1 lệnh atomic mỗi người ---
+        # (tính từ HP hiện tại nên 2 đòn đánh cùng lúc không ghi đè nhau)
+        new_target_hp, _ = await asyncio.gather(
+            apply_hp_delta(target_id, -damage, target_max_hp),
+            apply_hp_delta(attacker_id, heal, attacker_max_hp) if heal else asyncio.sleep(0),
+        )
+        if new_target_hp is None:
+            new_target_hp = max(target_hp - damage, 0)
 
-    # --- Kiểm tra tử vong ---
-    if new_target_hp <= 0:
-        msg += f"\n💀 **{target.display_name}** đã bị hạ gục!"
+        # --- Tạo tin nhắn kết quả ---
+        msg = (
+            f"⚔️ **{attacker.display_name}** tấn công **{target.display_name}**!\n"
+            f"🗡️ Gây **{damage}** sát thương"
+        )
+        if is_crit:
+            msg += " 💥 (Chí mạng!)"
 
-    await ctx.reply(msg)
+        # --- Kiểm tra tử vong (ghi chết + hẹn giờ hồi sinh ngay) ---
+        if new_target_hp <= 0:
+            await record_death(target_id)
+            msg += f"\n💀 **{target.display_name}** đã bị hạ gục!"
+
+        await ctx.reply(msg)
 
 @bot.command(name="equip", help="Trang bị vật phẩm bằng key trong shop_data.json (VD: $equip 11)")
 async def equip(ctx, item_key: str = None):
@@ -1614,42 +1635,19 @@ async def equip(ctx, item_key: str = None):
         await ctx.send(f"❌ `{_item_display(item_key)}` không phải là vật phẩm có thể trang bị.")
         return
 
-    # --- Lấy dữ liệu người chơi ---
-    user = users_col.find_one({"_id": user_id}, {"items": 1, "fight_equips": 1}) or {}
-    items = user.get("items", {})
-    equips = _get_equips(user_id)
-
+    # --- Trừ item + đặt vào ô trống trong 1 lệnh atomic ---
     item_name = item["name"]
+    empty_slot, reason = await equip_item(user_id, item_key, item_name)
 
-    # --- Kiểm tra người chơi có item ---
-    if items.get(item_name, 0) <= 0:
+    if reason == "no_item":
         await ctx.send(f"Bạn không có `{item_name}` trong túi để trang bị!")
         return
-
-    # --- Kiểm tra slot trống ---
-    try:
-        empty_slot = equips.index(None)
-    except ValueError:
-        empty_slot = -1
-
-    if empty_slot == -1:
+    if reason == "full":
         await ctx.send("❌ Bạn đã đầy 3 ô trang bị! Hãy tháo một món trước khi trang bị mới.")
         return
-
-    # --- Trang bị vật phẩm ---
-    equips[empty_slot] = item_key
-    _set_equips(user_id, equips)
-
-    # --- Giảm số lượng trong túi ---
-    items[item_name] -= 1
-    if items[item_name] <= 0:
-        del items[item_name]
-
-    users_col.update_one(
-        {"_id": user_id},
-        {"$set": {"items": items}},
-        upsert=False
-    )
+    if reason:
+        await ctx.send("⚠️ Túi đồ đang được thay đổi, vui lòng thử lại.")
+        return
 
     await ctx.send(
         f"✅ Bạn đã trang bị **{_item_display(item_key)}** vào ô **#{empty_slot + 1}**!\n"
@@ -1665,8 +1663,7 @@ async def unequip(ctx, slot: int = None):
         await ctx.send("⚠️ Vui lòng nhập số ô hợp lệ (1-3).")
         return
 
-    equips = _get_equips(user_id)
-    item_key = equips[slot - 1]
+    item_key = (await _get_equips(user_id))[slot - 1]
 
     if not item_key:
         await ctx.send(f"⚠️ Ô {slot} hiện đang trống, không có gì để tháo.")
@@ -1677,21 +1674,10 @@ async def unequip(ctx, slot: int = None):
         await ctx.send("⚠️ Vật phẩm này không còn tồn tại trong shop_data.json!")
         return
 
-    # --- Xóa trang bị khỏi slot ---
-    equips[slot - 1] = None
-    _set_equips(user_id, equips)
-
-    # --- Trả lại vật phẩm vào túi ---
-    user = users_col.find_one({"_id": user_id}, {"items": 1}) or {}
-    items = user.get("items", {})
-    item_name = item["name"]
-    items[item_name] = items.get(item_name, 0) + 1
-
-    users_col.update_one(
-        {"_id": user_id},
-        {"$set": {"items": items}},
-        upsert=False
-    )
+    # --- Xóa khỏi ô + trả lại vào túi trong 1 lệnh atomic ---
+    if not await unequip_item(user_id, slot - 1, item_key, item["name"]):
+        await ctx.send(f"⚠️ Ô {slot} hiện đang trống, không có gì để tháo.")
+        return
 
     await ctx.send(
         f"🧰 Bạn đã tháo **{_item_display(item_key)}** khỏi ô **#{slot}** và trả lại vào túi.\n"
@@ -1707,5 +1693,12 @@ async def clear_messages(ctx, amount: int):
     await ctx.channel.purge(limit=amount)
 
 # ==== RUN ====
-keep_alive()
-bot.run(DISCORD_TOKEN)
+def run():
+    keep_alive()
+    bot.run(DISCORD_TOKEN)
+
+# Chạy bằng `python run.py` (Procfile): worker render (spawn) import lại file chạy chính dưới tên
+# __mp_main__; run.py không có gì ở cấp module nên worker không dựng lại Mongo client / bot / dữ liệu.
+# `python main.py` vẫn chạy được nhưng mỗi worker sẽ import lại toàn bộ file này.
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,185 @@
+import time
+import asyncio
+import functools
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+# === METRICS (định dạng text của Prometheus, phục vụ ở /metrics trong keep_alive.py) ===
+# - Lệnh Discord: histogram thời gian chạy + số lần chạy theo kết quả (bot.before/after_invoke).
+# - Mongo: mỗi lệnh gửi xuống server được đếm theo "nguồn" đang chạy (lệnh Discord hoặc task nền,
+#   lấy từ contextvar) + histogram thời gian theo loại lệnh (CommandListener của PyMongo).
+# - Task nền: histogram thời gian mỗi lượt + số lượt lỗi.
+# - Các bộ đếm *_stats sẵn có của từng module (cache, khoá, scheduler...) đăng ký bằng register_stats.
+# Mọi số liệu chỉ được sửa/đọc trên event loop; Flask (thread khác) nhờ loop render hộ.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_IGNORED_MONGO_COMMANDS = frozenset({
+    "hello", "ismaster", "isMaster", "ping", "saslStart", "saslContinue", "endSessions", "buildInfo",
+})
+
+_source: ContextVar[str] = ContextVar("metrics_source", default="other")
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series: Dict[str, List[float]] = {}  # nhãn -> [đếm từng bucket..., +Inf, sum]
+
+    def observe(self, label_value: str, seconds: float) -> None:
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, seconds)] += 1
+        series[-1] += seconds
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, series in sorted(self._series.items()):
+            label = f'{self.label}="{_escape(value)}"'
+            total = 0
+            for bound, count in zip(self.buckets, series):
+                total += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {total}')
+            total += series[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {total}')
+            lines.append(f"{self.name}_sum{{{label}}} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{{{label}}} {total}")
+        return lines
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], int] = {}
+
+    def inc(self, *label_values: str) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, count in sorted(self._values.items()):
+            labels = ",".join(f'{k}="{_escape(v)}"' for k, v in zip(self.labels, values))
+            lines.append(f"{self.name}{{{labels}}} {count}")
+        return lines
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+command_latency = Histogram("alphabot_command_duration_seconds", "Thời gian chạy lệnh Discord", "command")
+command_total = Counter("alphabot_commands_total", "Số lần chạy lệnh Discord", ("command", "status"))
+mongo_ops = Counter("alphabot_mongo_ops_total", "Số lệnh gửi xuống Mongo theo nguồn", ("source", "op"))
+mongo_latency = Histogram("alphabot_mongo_op_duration_seconds", "Thời gian lệnh Mongo", "op")
+mongo_errors = Counter("alphabot_mongo_errors_total", "Số lệnh Mongo lỗi", ("op",))
+task_latency = Histogram("alphabot_task_duration_seconds", "Thời gian mỗi lượt task nền", "task",
+                         buckets=LATENCY_BUCKETS + (30.0, 60.0, 300.0))
+task_errors = Counter("alphabot_task_errors_total", "Số lượt task nền lỗi", ("task",))
+
+# ---- Lệnh Discord ----
+async def before_command(ctx) -> None:
+    ctx.metrics_started = time.perf_counter()
+    _source.set(f"cmd:{ctx.command.qualified_name}")
+
+async def after_command(ctx) -> None:
+    started = getattr(ctx, "metrics_started", None)
+    if started is None:
+        return
+    name = ctx.command.qualified_name
+    command_latency.observe(name, time.perf_counter() - started)
+    command_total.inc(name, "error" if ctx.command_failed else "ok")
+
+# ---- Mongo ----
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Đếm lệnh Mongo theo nguồn (contextvar của task gửi lệnh) và đo thời gian theo loại lệnh."""
+
+    def started(self, event) -> None:
+        if event.command_name not in _IGNORED_MONGO_COMMANDS:
+            mongo_ops.inc(_source.get(), event.command_name)
+
+    def succeeded(self, event) -> None:
+        if event.command_name not in _IGNORED_MONGO_COMMANDS:
+            mongo_latency.observe(event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event) -> None:
+        if event.command_name not in _IGNORED_MONGO_COMMANDS:
+            mongo_errors.inc(event.command_name)
+
+mongo_listener = MongoCommandMetrics()
+
+# ---- Task nền ----
+def observe_task(name: str, seconds: float, error: bool = False) -> None:
+    task_latency.observe(name, seconds)
+    if error:
+        task_errors.inc(name)
+
+def timed_task(name: str):
+    """Decorator cho hàm async chạy định kỳ: đo thời gian mỗi lượt, lệnh Mongo bên trong tính cho task:name."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            token = _source.set(f"task:{name}")
+            started = time.perf_counter()
+            error = False
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                observe_task(name, time.perf_counter() - started, error)
+                _source.reset(token)
+        return wrapper
+    return decorate
+
+# ---- Bộ đếm sẵn có của các module ----
+_stats_sources: List[Tuple[str, Callable[[], Dict[str, Any]]]] = []
+
+def register_stats(prefix: str, fn: Callable[[], Dict[str, Any]]) -> None:
+    """fn() trả về {tên: số} hoặc {nhóm: {tên: số}} (nhóm thành nhãn group=...)."""
+    _stats_sources.append((prefix, fn))
+
+def _render_stats() -> List[str]:
+    lines = []
+    for prefix, fn in _stats_sources:
+        try:
+            stats = fn()
+        except Exception as e:
+            lines.append(f"# lỗi đọc {prefix}: {_escape(e)}")
+            continue
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                for sub, number in value.items():
+                    if isinstance(number, (int, float)):
+                        lines.append(f'alphabot_{prefix}_{sub}{{group="{_escape(key)}"}} {number}')
+            elif isinstance(value, (int, float)):
+                lines.append(f"alphabot_{prefix}_{key} {value}")
+    return lines
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in (command_latency, command_total, mongo_ops, mongo_latency, mongo_errors,
+                   task_latency, task_errors):
+        lines.extend(metric.render())
+    lines.extend(_render_stats())
+    return "\n".join(lines) + "\n"
+
+# ---- Gọi từ thread khác (Flask) ----
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def bind_loop(loop: asyncio.AbstractEventLoop) -> None:
+    global _loop
+    _loop = loop
+
+async def _render_async() -> str:
+    return render_metrics()
+
+def render_metrics_threadsafe(timeout: float = 5.0) -> str:
+    """Render trên event loop của bot (số liệu chỉ bị sửa ở đó) rồi trả kết quả cho thread gọi."""
+    if _loop is None or not _loop.is_running():
+        return render_metrics()
+    return asyncio.run_coroutine_threadsafe(_render_async(), _loop).result(timeout)
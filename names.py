@@ -0,0 +1,119 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import discord
+
+# === TÊN NGƯỜI CHƠI (user_id -> tên hiển thị) ===
+# Thứ tự tra: cache member/user của discord.py -> LRU có TTL các lần tra trước -> gọi Discord.
+# Gọi Discord theo lô: query_members (chunk request qua gateway, 100 id/lần) khi có guild,
+# còn lại fetch_user song song nhưng giới hạn NAME_FETCH_CONCURRENCY request cùng lúc.
+# Nhiều lệnh cùng hỏi 1 id đang tra thì chờ chung 1 future, không gọi lại.
+
+NAME_CACHE_MAX = int(os.getenv("NAME_CACHE_MAX", "10000"))
+NAME_CACHE_TTL = float(os.getenv("NAME_CACHE_TTL", "3600"))  # giây
+NAME_FETCH_CONCURRENCY = int(os.getenv("NAME_FETCH_CONCURRENCY", "5"))
+_QUERY_CHUNK = 100  # giới hạn user_ids của 1 lần query_members
+
+_name_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+_inflight: Dict[str, asyncio.Future] = {}
+_fetch_sem: Optional[asyncio.Semaphore] = None
+
+name_stats = {"discord_cache": 0, "hits": 0, "coalesced": 0, "queried": 0, "fetched": 0, "failed": 0}
+
+def fallback_name(user_id: str) -> str:
+    return f"Người chơi {user_id}"
+
+def _remember(user_id: str, name: str) -> None:
+    _name_cache[user_id] = (name, time.monotonic() + NAME_CACHE_TTL)
+    _name_cache.move_to_end(user_id)
+    while len(_name_cache) > NAME_CACHE_MAX:
+        _name_cache.popitem(last=False)
+
+def _cached_name(bot, guild: Optional[discord.Guild], user_id: str) -> Optional[str]:
+    user = guild.get_member(int(user_id)) if guild is not None else None
+    if user is None:
+        user = bot.get_user(int(user_id))
+    if user is not None:
+        name_stats["discord_cache"] += 1
+        _remember(user_id, user.display_name)
+        return user.display_name
+    item = _name_cache.get(user_id)
+    if item is not None and item[1] > time.monotonic():
+        name_stats["hits"] += 1
+        _name_cache.move_to_end(user_id)
+        return item[0]
+    return None
+
+async def _fetch_one(bot, user_id: str) -> Optional[str]:
+    global _fetch_sem
+    if _fetch_sem is None:
+        _fetch_sem = asyncio.Semaphore(NAME_FETCH_CONCURRENCY)
+    async with _fetch_sem:
+        try:
+            user = await bot.fetch_user(int(user_id))
+        except (discord.NotFound, discord.HTTPException):
+            name_stats["failed"] += 1
+            return None
+    name_stats["fetched"] += 1
+    return user.display_name
+
+async def _fetch_batch(bot, guild: Optional[discord.Guild], user_ids: List[str]) -> Dict[str, str]:
+    found: Dict[str, str] = {}
+    if guild is not None and bot.intents.members:
+        for i in range(0, len(user_ids), _QUERY_CHUNK):
+            chunk = user_ids[i:i + _QUERY_CHUNK]
+            try:
+                # limit mặc định của query_members là 5 => phải truyền đủ cỡ lô
+                members = await guild.query_members(
+                    user_ids=[int(uid) for uid in chunk], limit=len(chunk), cache=True
+                )
+            except (asyncio.TimeoutError, discord.ClientException):
+                continue
+            name_stats["queried"] += len(members)
+            for member in members:
+                found[str(member.id)] = member.display_name
+    rest = [uid for uid in user_ids if uid not in found]
+    if rest:
+        names = await asyncio.gather(*(_fetch_one(bot, uid) for uid in rest))
+        found.update({uid: name for uid, name in zip(rest, names) if name is not None})
+    return found
+
+async def resolve_names(bot, user_ids: Iterable[str],
+                        guild: Optional[discord.Guild] = None) -> Dict[str, str]:
+    """
+    Trả về {user_id: tên} cho mọi id (không tra được thì dùng tên mặc định).
+    Trường hợp thường gặp không tốn request nào; còn thiếu thì gọi Discord theo lô.
+    """
+    result: Dict[str, str] = {}
+    waiting: Dict[str, asyncio.Future] = {}
+    own: List[str] = []
+    for uid in dict.fromkeys(str(u) for u in user_ids):
+        name = _cached_name(bot, guild, uid)
+        if name is not None:
+            result[uid] = name
+        elif uid in _inflight:
+            name_stats["coalesced"] += 1
+            waiting[uid] = _inflight[uid]
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            _inflight[uid] = waiting[uid] = fut
+            own.append(uid)
+
+    if own:
+        found: Dict[str, str] = {}
+        try:
+            found = await _fetch_batch(bot, guild, own)
+            for uid, name in found.items():
+                _remember(uid, name)
+        finally:
+            for uid in own:
+                fut = _inflight.pop(uid)
+                if not fut.done():
+                    fut.set_result(found.get(uid))
+
+    for uid, fut in waiting.items():
+        result[uid] = await asyncio.shield(fut) or fallback_name(uid)
+    return result
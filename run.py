@@ -0,0 +1,5 @@
+# Điểm chạy bot (Procfile). Để trống ở cấp module: worker render CCCD (spawn) import lại file
+# chạy chính, nên mọi thứ nặng (Mongo client, bot, dữ liệu JSON) chỉ nằm sau guard.
+if __name__ == "__main__":
+    import main
+    main.run()
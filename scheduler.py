@@ -0,0 +1,85 @@
+import time
+import heapq
+import asyncio
+import itertools
+import traceback
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+# === HẸN GIỜ TRONG PROCESS (min-heap) ===
+# Mỗi việc hẹn giờ là (thời điểm, seq, key, hàm async, args). Task nền ngủ đúng tới việc
+# sớm nhất rồi chạy nó; không có việc nào thì chờ vô hạn (không tốn gì). Hẹn lại cùng key
+# thì bản cũ bị bỏ (xoá lười: vẫn nằm trong heap nhưng bị bỏ qua khi tới hạn).
+
+_heap: List[Tuple[float, int, Hashable, Callable[..., Awaitable[Any]], tuple]] = []
+_latest: Dict[Hashable, int] = {}  # key -> seq của lần hẹn còn hiệu lực
+_seq = itertools.count()
+_wakeup: Optional[asyncio.Event] = None
+_runner: Optional[asyncio.Task] = None
+_firing: Set[asyncio.Task] = set()  # giữ tham chiếu tới task đang chạy để không bị GC giữa chừng
+
+scheduler_stats = {"scheduled": 0, "fired": 0, "cancelled": 0, "errors": 0, "max_late_ms": 0.0}
+
+def _event() -> asyncio.Event:
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    return _wakeup
+
+def _timestamp(when) -> float:
+    if isinstance(when, datetime):
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)  # datetime từ Mongo là UTC
+        return when.timestamp()
+    return float(when)
+
+def schedule_at(when, key: Hashable, action: Callable[..., Awaitable[Any]], *args) -> None:
+    """Hẹn chạy action(*args) lúc when (datetime hoặc epoch giây). Hẹn lại cùng key sẽ thay bản cũ."""
+    seq = next(_seq)
+    _latest[key] = seq
+    heapq.heappush(_heap, (_timestamp(when), seq, key, action, args))
+    scheduler_stats["scheduled"] += 1
+    if _heap[0][1] == seq:
+        _event().set()  # việc mới sớm hơn việc đang chờ: đánh thức để tính lại thời gian ngủ
+
+def cancel(key: Hashable) -> None:
+    if _latest.pop(key, None) is not None:
+        scheduler_stats["cancelled"] += 1
+
+def pending_count() -> int:
+    return len(_latest)
+
+async def _fire(action, args) -> None:
+    try:
+        await action(*args)
+    except Exception:
+        scheduler_stats["errors"] += 1
+        traceback.print_exc()
+
+async def _run() -> None:
+    wakeup = _event()
+    while True:
+        now = time.time()
+        while _heap and _heap[0][0] <= now:
+            due, seq, key, action, args = heapq.heappop(_heap)
+            if _latest.get(key) != seq:
+                continue  # đã bị huỷ hoặc hẹn lại
+            del _latest[key]
+            scheduler_stats["fired"] += 1
+            scheduler_stats["max_late_ms"] = max(scheduler_stats["max_late_ms"], (now - due) * 1000)
+            task = asyncio.create_task(_fire(action, args))
+            _firing.add(task)
+            task.add_done_callback(_firing.discard)
+        timeout = _heap[0][0] - now if _heap else None
+        wakeup.clear()
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def start_scheduler() -> asyncio.Task:
+    """Khởi động task nền (gọi lại nhiều lần vẫn chỉ có 1 task)."""
+    global _runner
+    if _runner is None or _runner.done():
+        _runner = asyncio.create_task(_run())
+    return _runner
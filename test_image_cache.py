@@ -0,0 +1,83 @@
+"""
+Kiểm tra tải ảnh có cache của image_cache.fetch_raw_image với 1 server HTTP giả (aiohttp):
+    python test_image_cache.py     (hoặc pytest test_image_cache.py)
+- Nhiều lệnh cùng tải 1 URL => chỉ 1 lần tải thật.
+- Bản cache còn mới => không ra mạng; hết hạn => conditional GET, server trả 304 => dùng lại bytes cũ.
+- Ảnh đổi nội dung ở cùng URL => lấy bản mới, image_version đổi (layer/thẻ CCCD cũ không còn khớp).
+- Nền PNG palette / GIF / ảnh 1-bit lớn hơn thẻ >= 2 lần vẫn dựng được layer (reduce() không nhận các mode này).
+"""
+import io
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from PIL import Image
+
+import cccd_render
+import image_cache
+
+def _stub_app(state):
+    async def handler(request):
+        state["requests"] += 1
+        etag = f'"v{state["version"]}"'
+        if request.headers.get("If-None-Match") == etag:
+            state["not_modified"] += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        await asyncio.sleep(0.05)  # đủ lâu để các lệnh tải đồng thời chồng lên nhau
+        return web.Response(body=state["body"], headers={"ETag": etag})
+    app = web.Application()
+    app.router.add_get("/img.png", handler)
+    return app
+
+async def _run():
+    state = {"requests": 0, "not_modified": 0, "version": 1, "body": b"anh-1"}
+    runner = web.AppRunner(_stub_app(state))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}/img.png"
+    try:
+        async with aiohttp.ClientSession() as session:
+            # 10 lệnh cùng lúc => 1 request
+            results = await asyncio.gather(*(image_cache.fetch_raw_image(session, url) for _ in range(10)))
+            assert results == [b"anh-1"] * 10
+            assert state["requests"] == 1
+
+            # Còn mới => không request
+            assert await image_cache.fetch_raw_image(session, url) == b"anh-1"
+            assert state["requests"] == 1
+
+            # Hết hạn => If-None-Match, server trả 304, dùng lại bản cache
+            image_cache.raw_cache.peek(url)["checked_at"] = 0
+            assert await image_cache.fetch_raw_image(session, url) == b"anh-1"
+            assert (state["requests"], state["not_modified"]) == (2, 1)
+            assert image_cache.is_fresh(image_cache.raw_cache.peek(url))
+
+            # Đổi ảnh ở cùng URL => hết hạn thì lấy bản mới, phiên bản nội dung đổi theo
+            old_version = image_cache.image_version(b"anh-1")
+            state["version"], state["body"] = 2, b"anh-2"
+            image_cache.raw_cache.peek(url)["checked_at"] = 0
+            data = await image_cache.fetch_raw_image(session, url)
+            assert data == b"anh-2"
+            assert image_cache.image_version(data) != old_version
+            assert state["requests"] == 3
+    finally:
+        await runner.cleanup()
+
+def test_fetch_raw_image_revalidates():
+    asyncio.run(_run())
+
+def test_decode_image_reduce_unsupported_modes():
+    width, height = cccd_render.CCCD_SIZE
+    for mode, fmt in (("P", "PNG"), ("P", "GIF"), ("1", "PNG"), ("I;16", "PNG")):
+        buf = io.BytesIO()
+        Image.new(mode, (width * 3, height * 3)).save(buf, fmt)
+        img = cccd_render.decode_image(buf.getvalue(), cccd_render.CCCD_SIZE)
+        assert (img.mode, img.size) == ("RGBA", cccd_render.CCCD_SIZE), (mode, fmt)
+
+if __name__ == "__main__":
+    test_fetch_raw_image_revalidates()
+    test_decode_image_reduce_unsupported_modes()
+    print("OK")
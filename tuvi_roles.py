@@ -0,0 +1,91 @@
+import os
+import asyncio
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+
+import discord
+
+# === CẤP BẬC TU_VI ===
+# Bảng tu_vi được biên dịch 1 lần thành mảng ngưỡng level_min tăng dần => tra bằng bisect.
+# Đổi role không làm trong lệnh: lệnh chỉ ghi role mong muốn vào hàng đợi (nhiều lần liên tiếp
+# của 1 member gộp thành 1), task nền so với role hiện có và chỉ gửi phần chênh lệch bằng
+# add_roles/remove_roles (không ghi đè cả danh sách role => không đụng role managed / role
+# cao hơn bot), giãn cách giữa các member để không dính rate limit.
+# Discord không có API sửa role nhiều member trong 1 request nên không gộp được giữa các member.
+
+ROLE_EDIT_INTERVAL = float(os.getenv("ROLE_EDIT_INTERVAL", "0.5"))  # giây giữa 2 lần sửa role
+
+_thresholds: List[int] = []
+_ranks: List[Tuple[str, Optional[int]]] = []
+TUVI_ROLE_IDS = frozenset()
+
+_pending: Dict[Tuple[int, int], Optional[int]] = {}  # (guild_id, member_id) -> role_id mong muốn
+_wakeup: Optional[asyncio.Event] = None
+
+role_stats = {"queued": 0, "edits": 0, "unchanged": 0, "skipped": 0, "errors": 0}
+
+def compile_tuvi(tu_vi: dict) -> None:
+    """Biên dịch bảng tu_vi (gọi lại nếu bảng thay đổi). Cùng level_min thì giữ cấp khai báo trước."""
+    global _thresholds, _ranks, TUVI_ROLE_IDS
+    best: Dict[int, Tuple[str, Optional[int]]] = {}
+    for name, info in tu_vi.items():
+        lvmin = int(info.get("level_min", 0))
+        if lvmin not in best:
+            best[lvmin] = (name, int(info.get("id", 0)) or None)
+    _thresholds = sorted(best)
+    _ranks = [best[lvmin] for lvmin in _thresholds]
+    TUVI_ROLE_IDS = frozenset(int(info["id"]) for info in tu_vi.values() if "id" in info)
+
+def best_tuvi_role(level: int) -> Tuple[str, Optional[int]]:
+    """Trả về (role_name, role_id) tốt nhất theo level, hoặc ('None', None) nếu không có."""
+    i = bisect_right(_thresholds, level)
+    return _ranks[i - 1] if i else ("None", None)
+
+def queue_tuvi_role(member: discord.Member, role_id: Optional[int]) -> None:
+    """Ghi role tu_vi mong muốn của member; nhiều lần liên tiếp thì chỉ giữ lần cuối."""
+    global _wakeup
+    _pending[(member.guild.id, member.id)] = role_id
+    role_stats["queued"] += 1
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    _wakeup.set()
+
+def _role_diff(member: discord.Member, role_id: Optional[int]) -> Tuple[List[discord.Role], List[discord.Role]]:
+    """(role tu_vi cần thêm, role tu_vi cần bỏ) của member; chỉ gồm role bot gán/bỏ được."""
+    wanted = member.guild.get_role(role_id) if role_id else None
+    to_remove = [r for r in member.roles if r.id in TUVI_ROLE_IDS and r != wanted and r.is_assignable()]
+    to_add = [wanted] if wanted and wanted not in member.roles and wanted.is_assignable() else []
+    return to_add, to_remove
+
+async def tuvi_role_reconciler(bot) -> None:
+    """Task nền: xử lý lần lượt các member trong hàng đợi."""
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    while True:
+        await _wakeup.wait()
+        _wakeup.clear()
+        while _pending:
+            key = next(iter(_pending))
+            role_id = _pending.pop(key)
+            guild = bot.get_guild(key[0])
+            member = guild.get_member(key[1]) if guild else None
+            if member is None:
+                role_stats["skipped"] += 1
+                continue
+            to_add, to_remove = _role_diff(member, role_id)
+            if not to_add and not to_remove:
+                role_stats["unchanged"] += 1
+                continue
+            try:
+                if to_remove:
+                    await member.remove_roles(*to_remove, reason="Cập nhật cấp bậc tu_vi")
+                if to_add:
+                    await member.add_roles(*to_add, reason="Cập nhật cấp bậc tu_vi")
+                role_stats["edits"] += 1
+            except discord.Forbidden:
+                role_stats["errors"] += 1
+            except discord.HTTPException as e:
+                role_stats["errors"] += 1
+                print(f"[TU_VI] ❌ Lỗi sửa role {member.id}: {e}")
+            await asyncio.sleep(ROLE_EDIT_INTERVAL)
@@ -0,0 +1,106 @@
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Tuple
+
+# === KHOÁ THEO USER ===
+# Lệnh đọc-sửa-ghi số dư của 1 user (get_user -> sửa -> update_user) chạy tuần tự theo user:
+# 2 lệnh của cùng 1 người không xen nhau, còn user khác nhau vẫn chạy song song hoàn toàn.
+# Lệnh đụng nhiều user (dn, rob, orob, op, attack) khoá tất cả theo thứ tự id tăng dần
+# => không bao giờ deadlock. Khoá chỉ tồn tại khi có người giữ/chờ (đếm tham chiếu), hết thì xoá.
+# Lệnh Discord dùng locked_ctx: khoá chỉ bao phần đọc/kiểm tra/ghi, tin nhắn trả lời (REST call
+# tới Discord) được gom lại và gửi sau khi nhả khoá => lệnh kế tiếp của user không phải chờ mạng.
+
+_locks: Dict[str, asyncio.Lock] = {}
+_refs: Dict[str, int] = {}
+
+lock_stats = {"acquired": 0, "contended": 0, "wait_ms_total": 0.0, "max_wait_ms": 0.0}
+
+async def _acquire(user_id: str) -> None:
+    lock = _locks.get(user_id)
+    if lock is None:
+        lock = _locks[user_id] = asyncio.Lock()
+    _refs[user_id] = _refs.get(user_id, 0) + 1
+    if lock.locked():
+        lock_stats["contended"] += 1
+        start = time.perf_counter()
+        try:
+            await lock.acquire()
+        except BaseException:
+            _release_ref(user_id)
+            raise
+        waited = (time.perf_counter() - start) * 1000
+        lock_stats["wait_ms_total"] += waited
+        lock_stats["max_wait_ms"] = max(lock_stats["max_wait_ms"], waited)
+    else:
+        await lock.acquire()
+    lock_stats["acquired"] += 1
+
+def _release_ref(user_id: str) -> None:
+    _refs[user_id] -= 1
+    if _refs[user_id] == 0:
+        del _refs[user_id]
+        del _locks[user_id]
+
+def _release(user_id: str) -> None:
+    _locks[user_id].release()
+    _release_ref(user_id)
+
+@asynccontextmanager
+async def user_lock(*user_ids):
+    """Giữ khoá của các user (id int/str, trùng nhau được) trong suốt khối async with."""
+    ids = sorted({str(uid) for uid in user_ids})
+    held = []
+    try:
+        for uid in ids:
+            await _acquire(uid)
+            held.append(uid)
+        yield
+    finally:
+        for uid in reversed(held):
+            _release(uid)
+
+class _DeferredReplies:
+    """Bọc ctx: reply/send trong lúc giữ khoá chỉ được ghi lại; các thuộc tính khác lấy thẳng từ ctx."""
+
+    def __init__(self, ctx):
+        self._ctx = ctx
+        self._queued: List[Tuple[str, tuple, Dict[str, Any]]] = []
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._ctx, name)
+
+    async def reply(self, *args, **kwargs):
+        return await self._defer("reply", args, kwargs)
+
+    async def send(self, *args, **kwargs):
+        return await self._defer("send", args, kwargs)
+
+    async def _defer(self, method: str, args: tuple, kwargs: Dict[str, Any]):
+        if self._released:
+            return await getattr(self._ctx, method)(*args, **kwargs)
+        self._queued.append((method, args, kwargs))
+
+    async def _send_queued(self) -> None:
+        self._released = True
+        queued, self._queued = self._queued, []
+        for method, args, kwargs in queued:
+            await getattr(self._ctx, method)(*args, **kwargs)
+
+@asynccontextmanager
+async def locked_ctx(ctx, *user_ids):
+    """
+    user_lock cho lệnh Discord: `async with locked_ctx(ctx, ...) as ctx:` => ctx.reply/ctx.send
+    trong khối chỉ được xếp hàng, gửi theo đúng thứ tự ngay sau khi nhả khoá (kể cả khi khối lỗi).
+    """
+    deferred = _DeferredReplies(ctx)
+    try:
+        async with user_lock(*user_ids):
+            yield deferred
+    finally:
+        await deferred._send_queued()
+
+def lock_count() -> int:
+    """Số user đang có người giữ/chờ khoá."""
+    return len(_locks)